@@ -1,3 +1,6 @@
 from dl.algorithms.qlearning import QLearning
 from dl.algorithms.ppo import PPO
 from dl.algorithms.sac import SAC
+from dl.algorithms.apex import ApeX
+from dl.algorithms.impala import IMPALA
+from dl.algorithms.population import PopulationPPO, PopulationSAC
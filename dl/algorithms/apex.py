@@ -0,0 +1,312 @@
+"""
+Ape-X DQN with local actor processes.
+https://arxiv.org/abs/1803.00933
+"""
+from dl.algorithms.qlearning import QLearning
+from dl.util import ReplayBuffer, logger, find_monitor, memory
+from dl.util.shared_weights import SharedWeights
+from dl.util.inference_server import InferenceServer, InferenceClient
+import gin, os, time, copy, queue, tempfile
+import torch
+import torch.multiprocessing as mp
+import numpy as np
+from collections import deque
+
+
+def _make_block(buffer, idxes, pad_idx, net, criterion, gamma):
+    """
+    Packs the transitions stored at idxes in the actor's local buffer into a
+    sequence that can be stored in the central replay buffer. The sequence is
+    preceded by frame_history_len - 1 context frames and followed by the
+    frame after the last transition. Context and padding frames have priority 0
+    so they are never sampled.
+    """
+    k = buffer.frame_history_len
+    ctx = [(idxes[0] - j) % buffer.size for j in range(k-1, 0, -1)]
+    all_idxes = ctx + idxes + [pad_idx]
+    frames = buffer.obs[all_idxes]
+    actions = buffer.action[all_idxes]
+    rewards = buffer.reward[all_idxes]
+    dones = buffer.done[all_idxes]
+    # Context frames from before the first frame stored by the actor.
+    nstored = buffer.num_in_buffer - len(idxes) - 1
+    for j in range(k-1):
+        if k - 1 - j > nstored:
+            frames[j] = 0
+            dones[j] = True
+    actions[-1] = 0
+    rewards[-1] = 0
+    dones[-1] = True
+
+    ob, ac, rew, next_ob, done = [torch.from_numpy(x) for x in buffer._encode_sample(idxes)]
+    with torch.no_grad():
+        q = net(ob, ac).value
+        target = rew + (1.0 - done) * gamma * net(next_ob).max_q
+        err = criterion(target, q).numpy()
+    priorities = np.zeros(len(all_idxes), dtype=np.float32)
+    priorities[k-1:-1] = err + 1e-6
+    return {'frames': frames, 'actions': actions, 'rewards': rewards,
+            'dones': dones, 'priorities': priorities, 'nsteps': len(idxes)}
+
+
+def _actor(rank, env_fn, net, weights, q, stop, eps, frame_stack, block_size,
+           gamma, huber_loss, sync_period, server_path=None):
+    torch.set_num_threads(1)
+    env = env_fn(rank=rank)
+    # act with the learner's inference server if there is one, net is then only used for priorities.
+    actor = InferenceClient(server_path) if server_path else net
+    monitor = find_monitor(env)
+    buffer = ReplayBuffer(2 * (block_size + frame_stack), frame_stack)
+    if huber_loss:
+        criterion = torch.nn.SmoothL1Loss(reduction='none')
+    else:
+        criterion = torch.nn.MSELoss(reduction='none')
+    version = weights.sync(net)
+    nepisodes = 0
+    idxes = []
+    ob = env.reset()
+    t = 0
+    while not stop.is_set():
+        idx = buffer.store_frame(ob)
+        if len(idxes) == block_size:
+            block = _make_block(buffer, idxes, idx, net, criterion, gamma)
+            if monitor is not None:
+                # the monitor may only keep its last episodes (Monitor.max_history).
+                start = max(len(monitor.episode_rewards) - (monitor.num_episodes - nepisodes), 0)
+                block['episode_rewards'] = list(monitor.episode_rewards[start:])
+                block['episode_lengths'] = list(monitor.episode_lengths[start:])
+                nepisodes = monitor.num_episodes
+            block['version'] = version
+            while not stop.is_set():
+                try:
+                    q.put(block, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            idxes = []
+
+        if eps > np.random.rand():
+            ac = np.array(env.action_space.sample())
+        else:
+            x = torch.from_numpy(buffer.encode_recent_observation())
+            with torch.no_grad():
+                ac = actor(x[None]).action.numpy()[0]
+        ob, r, done, _ = env.step(ac)
+        buffer.store_effect(idx, ac, r, done)
+        if done:
+            ob = env.reset()
+        idxes.append(idx)
+        t += 1
+        if t % sync_period == 0:
+            version = weights.sync(net, version)
+    env.close()
+
+
+@gin.configurable(blacklist=['logdir'])
+class ApeX(QLearning):
+    """
+    A learner which trains a QFunction on transitions generated by nactors
+    actor processes. Each actor runs its own environment with its own epsilon,
+    computes initial priorities with its copy of the network and sends
+    transitions to the learner's prioritized replay buffer in blocks of
+    actor_block_size steps. The learner publishes its weights through shared
+    memory every weight_publish_period updates and actors copy the latest
+    published weights every actor_sync_period steps.
+    If inference_server is True, actors choose actions by sending observations
+    to an InferenceServer in the learner process, which evaluates them on the
+    learner's device in batches of up to inference_max_batch_size.
+    All other arguments are the same as QLearning.
+    """
+    def __init__(self,
+                 logdir,
+                 env_fn,
+                 optimizer,
+                 nactors=4,
+                 actor_eps=0.4,
+                 actor_eps_alpha=7.,
+                 actor_block_size=50,
+                 actor_sync_period=400,
+                 weight_publish_period=100,
+                 queue_size=64,
+                 inference_server=False,
+                 inference_max_batch_size=None,
+                 inference_max_wait_us=1000,
+                 **kwargs
+    ):
+        kwargs['prioritized_replay'] = True
+        kwargs['actor_thread'] = False
+        super().__init__(logdir, env_fn, optimizer, **kwargs)
+        self.nactors = nactors
+        if nactors > 1:
+            self.actor_eps = [actor_eps ** (1 + actor_eps_alpha * i / (nactors - 1)) for i in range(nactors)]
+        else:
+            self.actor_eps = [actor_eps]
+        self.actor_block_size = actor_block_size
+        self.actor_sync_period = actor_sync_period
+        self.weight_publish_period = weight_publish_period
+        self.huber_loss = isinstance(self.criterion, torch.nn.SmoothL1Loss)
+
+        # actors are forked, so only use cpu tensors in shared objects.
+        self.ctx = mp.get_context('fork')
+        self.weights = SharedWeights(self.net, self.ctx)
+        self.queue = self.ctx.Queue(maxsize=queue_size)
+        self.stop_event = self.ctx.Event()
+        self.actors = None
+        self.server = None
+        if inference_server:
+            path = os.path.join(tempfile.gettempdir(), f'apex_inference_{os.getpid()}.sock')
+            self.server = InferenceServer(self.net, path, max_batch_size=inference_max_batch_size or nactors,
+                                          max_wait_us=inference_max_wait_us, device=self.device)
+        self.episode_rewards = deque(maxlen=100)
+        self.episode_lengths = deque(maxlen=100)
+        self.weight_lag = deque(maxlen=100)
+        self._nblocks = 0
+
+    def _start_actors(self):
+        self.weights.publish(self.net)
+        server_path = None
+        if self.server is not None:
+            self.server.sync(self.net)
+            self.server.start()
+            server_path = self.server.path
+        net = copy.deepcopy(self.net).cpu()
+        self.actors = []
+        for i in range(self.nactors):
+            # rank 0 and 1 are used by the learner's env and the eval env.
+            args = (i + 2, self.env_fn, net, self.weights, self.queue, self.stop_event,
+                    self.actor_eps[i], self.frame_stack, self.actor_block_size,
+                    self.gamma, self.huber_loss, self.actor_sync_period, server_path)
+            p = self.ctx.Process(target=_actor, args=args, daemon=True)
+            p.start()
+            self.actors.append(p)
+        self._last_t = self.t
+        self._last_log = (time.monotonic(), self.t, self.nupdates)
+
+    def _make_env(self):
+        # actors step their own environments, the learner's env only provides
+        # the observation and action spaces.
+        return self.env_fn(rank=0)
+
+    def _store_block(self, block):
+        with self.buffer_lock.write():
+            self.buffer.store_sequence(block['frames'], block['actions'], block['rewards'],
+                                       block['dones'], block['priorities'])
+            self.t += block['nsteps']
+        self.episode_rewards.extend(block.get('episode_rewards', []))
+        self.episode_lengths.extend(block.get('episode_lengths', []))
+        self.weight_lag.append(self.weights.version.value - block['version'])
+        self._nblocks += 1
+
+    def _drain_queue(self, block=False):
+        nblocks = 0
+        while nblocks < 2 * self.nactors:
+            try:
+                self._store_block(self.queue.get(block=block, timeout=0.1 if block else None))
+                nblocks += 1
+            except queue.Empty:
+                break
+        return nblocks
+
+    def step(self):
+        if self.actors is None:
+            self._start_actors()
+        for i,p in enumerate(self.actors):
+            assert p.is_alive(), f"Actor {i} died with exitcode {p.exitcode}."
+
+        if self.buffer.num_in_buffer < min(self.learning_starts, self.buffer.size):
+            self._drain_queue(block=True)
+            return
+        self._drain_queue()
+
+        t, last_t = self.t, self._last_t
+        self._last_t = t
+        if t // self.target_update_period > last_t // self.target_update_period:
+            self.target_net.load_state_dict(self.net.state_dict())
+        self.update()
+        if self.nupdates % self.weight_publish_period == 0:
+            self.weights.publish(self.net)
+            if self.server is not None:
+                self.server.sync(self.net)
+        if t // self.log_period > last_t // self.log_period:
+            self.log()
+
+    def log(self):
+        meanloss = self.losses.means().get('loss', np.nan)
+        now, last_t, last_nupdates = self._last_log
+        fps = (self.t - last_t) / (time.monotonic() - now)
+        ups = (self.nupdates - last_nupdates) / (time.monotonic() - now)
+        self._last_log = (time.monotonic(), self.t, self.nupdates)
+        logger.log("========================|  Timestep: {}  |========================".format(self.t))
+        logger.logkv('Loss', meanloss)
+        logger.logkv('timesteps', self.t)
+        logger.logkv('fps', int(fps))
+        logger.logkv('updates per second', ups)
+        logger.logkv('time_elapsed', time.monotonic() - self.time_start)
+        logger.logkv('queue size', self.queue.qsize())
+        logger.logkv('weight version lag', np.mean(self.weight_lag))
+        logger.logkv('mean episode length', np.mean(self.episode_lengths))
+        logger.logkv('mean episode reward', np.mean(self.episode_rewards))
+        if self.server is not None:
+            for k,v in self.server.stats().items():
+                logger.logkv(k, v)
+                logger.add_scalar(f'inference/{k}', v, self.t, time.time())
+        memory.log_memory(self.t, buffer=self.buffer, nets=[self.net, self.target_net], opt=self.opt)
+        self.timer.log(self.t)
+        logger.dumpkvs()
+        logger.add_scalar('alg/loss', meanloss, self.t, time.time())
+        logger.add_scalar('alg/fps', fps, self.t, time.time())
+        logger.add_scalar('alg/updates_per_second', ups, self.t, time.time())
+        if len(self.episode_rewards) > 0:
+            logger.add_scalar('env/mean_episode_reward', np.mean(self.episode_rewards), self.t, time.time())
+            logger.add_scalar('env/mean_episode_length', np.mean(self.episode_lengths), self.t, time.time())
+
+    def stop(self):
+        # blocks sent before the actors stop are stored, so they are in the final checkpoint.
+        if self.actors is not None:
+            self.stop_event.set()
+            # unblock actors waiting on a full queue.
+            while any(p.is_alive() for p in self.actors):
+                self._drain_queue()
+                for p in self.actors:
+                    p.join(timeout=0.1)
+            while self._drain_queue() > 0:
+                pass
+            self.actors = None
+
+    def close(self):
+        self.stop()
+        if self.server is not None and self.server.sock is not None:
+            self.server.close()
+        super().close()
+
+
+
+import unittest, shutil
+from dl.util import atari_env, load_gin_configs
+
+class TestApeX(unittest.TestCase):
+    def test_apex(self):
+        env = lambda rank: atari_env('Pong', rank=rank)
+        apex = ApeX('logs', env, nactors=2, learning_starts=200, actor_block_size=20, maxt=1000, eval=False)
+        assert len(apex.actor_eps) == 2
+        apex.train()
+        assert apex.nupdates > 0
+        assert apex.buffer.num_in_buffer >= 1000
+        apex = ApeX('logs', env, nactors=2, learning_starts=200, actor_block_size=20, maxt=2000, eval=False)
+        apex.train() # loads checkpoint
+        assert apex.t >= 2000
+        shutil.rmtree('logs')
+
+    def test_inference_server(self):
+        env = lambda rank: atari_env('Pong', rank=rank)
+        apex = ApeX('logs', env, nactors=4, learning_starts=200, actor_block_size=20, inference_server=True, maxt=1000, eval=False)
+        apex.train()
+        assert apex.nupdates > 0
+        assert len(apex.server.batch_sizes) > 0
+        assert apex.server.batch_size_histogram()[1:5].sum() == len(apex.server.batch_sizes)
+        shutil.rmtree('logs')
+
+
+if __name__=='__main__':
+    load_gin_configs(['../configs/apex.gin'])
+    unittest.main()
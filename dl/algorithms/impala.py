@@ -0,0 +1,322 @@
+"""
+IMPALA with V-trace off-policy correction.
+https://arxiv.org/abs/1802.01561
+"""
+from dl import Trainer
+from dl.modules import Policy
+from dl.util import RolloutStorage, SharedWeights, MetricsAccumulator
+from dl.util import logger, find_monitor, memory
+from dl.eval import rl_evaluate, rl_record, rl_plot
+from baselines.common.vec_env.dummy_vec_env import DummyVecEnv
+import gin, os, time, copy, queue
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+import numpy as np
+from collections import deque
+
+
+def _actor(ranks, env_fn, net, weights, q, stop, steps):
+    """
+    Collects trajectories of length steps with the most recent weights
+    available and sends them to the learner.
+    """
+    torch.set_num_threads(1)
+    env = DummyVecEnv([lambda rank=rank: env_fn(rank=rank) for rank in ranks])
+    nenv = len(ranks)
+    rollout = RolloutStorage(steps, nenv, other_keys=['logp'])
+    rews = np.zeros(nenv, dtype=np.float32)
+    lens = np.zeros(nenv, dtype=np.int32)
+    ob = torch.from_numpy(env.reset())
+    mask = torch.zeros(nenv)
+    while not stop.is_set():
+        version = weights.sync(net)
+        episode_rewards, episode_lengths = [], []
+        for _ in range(steps):
+            with torch.no_grad():
+                outs = net(ob)
+            next_ob, r, done, _ = env.step(outs.action.numpy())
+            rollout.insert({'ob': ob, 'ac': outs.action, 'r': torch.from_numpy(r).float(),
+                            'mask': mask, 'vpred': outs.value, 'logp': outs.logp})
+            ob = torch.from_numpy(next_ob)
+            mask = torch.from_numpy(1.0 - done.astype(np.float32))
+            rews += r
+            lens += 1
+            for i in np.nonzero(done)[0]:
+                episode_rewards.append(rews[i])
+                episode_lengths.append(lens[i])
+            rews[done] = 0.
+            lens[done] = 0
+
+        traj = {k: v.numpy().copy() for k,v in rollout.data.items() if k in rollout.keys}
+        traj['next_ob'] = ob.numpy()
+        traj['next_mask'] = mask.numpy()
+        traj['version'] = version
+        traj['episode_rewards'] = episode_rewards
+        traj['episode_lengths'] = episode_lengths
+        while not stop.is_set():
+            try:
+                q.put(traj, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+    env.close()
+
+
+@gin.configurable(blacklist=['logdir'])
+class IMPALA(Trainer):
+    """
+    Actor processes collect trajectories of steps_per_iter steps from
+    nenv_per_actor environments with possibly stale weights and send them to
+    the learner through a queue. The learner updates the policy on batches of
+    batch_size trajectories, correcting for the policy lag with V-trace, and
+    publishes its weights through shared memory.
+    Only feed forward policies are supported.
+    """
+    def __init__(self,
+                 logdir,
+                 env_fn,
+                 optimizer,
+                 policy=Policy,
+                 nactors=8,
+                 nenv_per_actor=1,
+                 steps_per_iter=20,
+                 batch_size=8,
+                 max_grad_norm=40.,
+                 ent_coef=0.01,
+                 vf_coef=0.5,
+                 gamma=0.99,
+                 lambda_=1.0,
+                 rho_bar=1.0,
+                 c_bar=1.0,
+                 norm_observations=False,
+                 norm_advantages=False,
+                 queue_size=None,
+                 log_period=10000,
+                 eval_nepisodes=100,
+                 eval_nenv=1,
+                 gpu=True,
+                 **trainer_kwargs
+    ):
+        super().__init__(logdir, **trainer_kwargs)
+        self.env_fn = env_fn
+        self.nactors = nactors
+        self.nenv_per_actor = nenv_per_actor
+        self.nenv = nactors * nenv_per_actor
+        self.steps_per_iter = steps_per_iter
+        self.batch_size = batch_size
+        self.max_grad_norm = max_grad_norm
+        self.ent_coef = ent_coef
+        self.vf_coef = vf_coef
+        self.gamma = gamma
+        self.lambda_ = lambda_
+        self.rho_bar = rho_bar
+        self.c_bar = c_bar
+        self.norm_observations = norm_observations
+        self.norm_advantages = norm_advantages
+        self.log_period = log_period
+        self.eval_nepisodes = eval_nepisodes
+        self.eval_nenv = eval_nenv
+
+        env = self.env_fn(rank=self.nenv+1)
+        self.net = policy(env.observation_space.shape, env.action_space, norm_observations=norm_observations)
+        env.close()
+        assert self.net.recurrent_state_size() is None, "IMPALA only supports feed forward policies."
+        self.device = torch.device("cuda:0" if gpu and torch.cuda.is_available() else "cpu")
+        self.net.to(self.device)
+        self.opt = optimizer(self.net.parameters())
+        self.rollout = RolloutStorage(steps_per_iter, batch_size * nenv_per_actor, device=self.device, other_keys=['logp'])
+
+        self.t, self.t_start = 0,0
+        self.losses = MetricsAccumulator()
+        self.episode_rewards = deque(maxlen=100)
+        self.episode_lengths = deque(maxlen=100)
+        self.policy_lag = deque(maxlen=100)
+
+        # actors are forked, so only use cpu tensors in shared objects.
+        self.ctx = mp.get_context('fork')
+        self.weights = SharedWeights(self.net, self.ctx)
+        self.queue = self.ctx.Queue(maxsize=queue_size or 2 * nactors)
+        self.stop_event = self.ctx.Event()
+        self.actors = None
+
+    def state_dict(self):
+        return {
+            'net': self.net.state_dict(),
+            'opt': self.opt.state_dict(),
+            't':   self.t,
+        }
+
+    def load_state_dict(self, state_dict):
+        self.net.load_state_dict(state_dict['net'])
+        self.opt.load_state_dict(state_dict['opt'])
+        self.t = state_dict['t']
+
+    def load(self, t=None):
+        super().load(t)
+        self.t_start = self.t
+
+    def _start_actors(self):
+        self.weights.publish(self.net)
+        net = copy.deepcopy(self.net).cpu()
+        self.actors = []
+        for i in range(self.nactors):
+            ranks = list(range(i * self.nenv_per_actor, (i+1) * self.nenv_per_actor))
+            args = (ranks, self.env_fn, net, self.weights, self.queue, self.stop_event, self.steps_per_iter)
+            p = self.ctx.Process(target=_actor, args=args, daemon=True)
+            p.start()
+            self.actors.append(p)
+        self._last_log = (time.monotonic(), self.t)
+
+    def _get_trajectories(self):
+        trajs = []
+        while len(trajs) < self.batch_size:
+            for i,p in enumerate(self.actors):
+                assert p.is_alive(), f"Actor {i} died with exitcode {p.exitcode}."
+            try:
+                trajs.append(self.queue.get(timeout=1.0))
+            except queue.Empty:
+                pass
+        for traj in trajs:
+            self.episode_rewards.extend(traj['episode_rewards'])
+            self.episode_lengths.extend(traj['episode_lengths'])
+            self.policy_lag.append(self.weights.version.value - traj['version'])
+        return trajs
+
+    def _to_tensor(self, trajs, key):
+        return torch.from_numpy(np.concatenate([traj[key] for traj in trajs], axis=0)).to(self.device)
+
+    def loss(self, next_ob, next_mask):
+        data = self.rollout.data
+        T, N = data['r'].shape[:2]
+        ob = torch.cat([data['ob'], next_ob[None]], dim=0)
+        outs = self.net(ob.view(-1, *ob.shape[2:]))
+        # the bootstrap observation has no action, so reuse the last one and drop its log prob.
+        ac = torch.cat([data['ac'], data['ac'][-1:]], dim=0)
+        logp = outs.dist.log_prob(ac.view(-1, *ac.shape[2:])).view(T + 1, N)[:-1]
+        values = outs.value.view(T + 1, N)
+        ent = outs.dist.entropy().view(T + 1, N)[:-1]
+        assert logp.shape == data['logp'].shape
+
+        # V-trace targets are computed from the learner's value estimates.
+        with torch.no_grad():
+            data['vpred'] = values[:-1].detach()
+            log_rhos = logp.detach() - data['logp']
+            self.rollout.compute_vtrace_targets(values[-1].detach(), next_mask, log_rhos, self.gamma,
+                                                rho_bar=self.rho_bar, c_bar=self.c_bar,
+                                                lambda_=self.lambda_, norm_advantages=self.norm_advantages)
+
+        pi_loss = -(logp * data['atarg']).mean()
+        vf_loss = 0.5 * ((values[:-1] - data['vtarg']) ** 2).mean()
+        ent_loss = ent.mean()
+        loss = pi_loss + self.vf_coef * vf_loss - self.ent_coef * ent_loss
+        self.losses.add('pi', pi_loss)
+        self.losses.add('value', vf_loss)
+        self.losses.add('ent', ent_loss)
+        self.losses.add('tot', loss)
+        return loss
+
+    def step(self):
+        if self.actors is None:
+            self._start_actors()
+        trajs = self._get_trajectories()
+        for step in range(self.steps_per_iter):
+            self.rollout.insert({k: torch.from_numpy(np.concatenate([traj[k][step] for traj in trajs], axis=0))
+                                 for k in self.rollout.keys})
+        next_ob = self._to_tensor(trajs, 'next_ob')
+        next_mask = self._to_tensor(trajs, 'next_mask')
+
+        if self.norm_observations:
+            with torch.no_grad():
+                batch_mean, batch_var, batch_count = self.rollout.compute_ob_stats()
+                self.net.running_norm.update(batch_mean, batch_var, batch_count)
+
+        self.opt.zero_grad()
+        loss = self.loss(next_ob, next_mask)
+        loss.backward()
+        if self.max_grad_norm:
+            nn.utils.clip_grad_norm_(self.net.parameters(), self.max_grad_norm)
+        self.opt.step()
+        self.weights.publish(self.net)
+
+        last_t = self.t
+        self.t += self.steps_per_iter * self.rollout.num_processes
+        if self.t // self.log_period > last_t // self.log_period:
+            self.log()
+
+    def log(self):
+        logger.log("========================|  Timestep: {}  |========================".format(self.t))
+        means = self.losses.means()
+        for ln, name in [('tot', 'Total'), ('pi', 'Policy'), ('value', 'Value'), ('ent', 'Entropy')]:
+            logger.logkv(f'Loss - {name}', means[ln])
+            logger.add_scalar(f'loss/{ln}', means[ln], self.t, time.time())
+
+        now, last_t = self._last_log
+        fps = (self.t - last_t) / (time.monotonic() - now)
+        self._last_log = (time.monotonic(), self.t)
+        logger.logkv('timesteps', self.t)
+        logger.logkv('fps', int(fps))
+        logger.logkv('time_elapsed', time.monotonic() - self.time_start)
+        logger.logkv('queue size', self.queue.qsize())
+        logger.logkv('policy lag', np.mean(self.policy_lag))
+        logger.logkv('mean episode length', np.mean(self.episode_lengths))
+        logger.logkv('mean episode reward', np.mean(self.episode_rewards))
+        logger.add_scalar('alg/fps', fps, self.t, time.time())
+        logger.add_scalar('alg/policy_lag', np.mean(self.policy_lag), self.t, time.time())
+        if len(self.episode_rewards) > 0:
+            logger.add_scalar('env/mean_episode_reward', np.mean(self.episode_rewards), self.t, time.time())
+            logger.add_scalar('env/mean_episode_length', np.mean(self.episode_lengths), self.t, time.time())
+        memory.log_memory(self.t, rollout=self.rollout, net=self.net, opt=self.opt)
+        self.timer.log(self.t)
+        logger.dumpkvs()
+
+    def evaluate(self):
+        self.net.train(False)
+        os.makedirs(os.path.join(self.logdir, 'eval'), exist_ok=True)
+        outfile = os.path.join(self.logdir, 'eval', self.ckptr.format.format(self.t) + '.json')
+        stats = rl_evaluate(self.env_fn, self.net, self.eval_nepisodes, outfile, self.device, nenv=self.eval_nenv, rank=self.nenv+1)
+        logger.add_scalar('eval/mean_episode_reward', stats['mean_reward'], self.t, time.time())
+        logger.add_scalar('eval/mean_episode_length', stats['mean_length'], self.t, time.time())
+
+        os.makedirs(os.path.join(self.logdir, 'video'), exist_ok=True)
+        outfile = os.path.join(self.logdir, 'video', self.ckptr.format.format(self.t) + '.mp4')
+        # create new env to access true reward function and episode lenghts from the Monitor wrapper (if it exists)
+        eval_env = self.env_fn(rank=self.nenv+1)
+        rl_record(eval_env, self.net, 5, outfile, self.device)
+
+        if find_monitor(eval_env):
+            rl_plot(os.path.join(self.logdir, 'logs'), eval_env.spec.id, self.t)
+        self.net.train(True)
+
+    def close(self):
+        if self.actors is not None:
+            self.stop_event.set()
+            # unblock actors waiting on a full queue.
+            while any(p.is_alive() for p in self.actors):
+                try:
+                    self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            for p in self.actors:
+                p.join()
+            self.actors = None
+        logger.reset()
+
+
+
+import unittest, shutil
+from dl.util import atari_env, load_gin_configs
+
+class TestIMPALA(unittest.TestCase):
+    def test_impala(self):
+        env_fn = lambda rank: atari_env('Pong', rank=rank)
+        impala = IMPALA('logs', env_fn, nactors=2, nenv_per_actor=2, batch_size=2, maxt=1000, eval=True, eval_nepisodes=1, eval_period=1000)
+        impala.train()
+        assert impala.t >= 1000
+        assert impala.rollout.data['vtarg'].shape[:2] == (impala.steps_per_iter, 4)
+        shutil.rmtree('logs')
+
+
+if __name__=='__main__':
+    load_gin_configs(['../configs/impala.gin'], ['IMPALA.gpu=False'])
+    unittest.main()
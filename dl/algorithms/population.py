@@ -0,0 +1,508 @@
+"""
+Train populations of independent agents, e.g. several seeds of one config,
+in a single process with batched networks.
+"""
+from dl.algorithms.ppo import PPO
+from dl.algorithms.sac import SAC, soft_target_update
+from dl.modules import Population
+from dl.util import RolloutStorage, Checkpointer, PopulationVecMonitor
+from dl.util import logger, FrameStack, memory
+from dl.eval import rl_evaluate
+from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
+from baselines.common.vec_env.dummy_vec_env import DummyVecEnv
+import gin, os, time, functools
+import torch
+import torch.nn as nn
+import numpy as np
+
+
+def _make_population_env(env_fn, nenv, population_size, tstart):
+    def _env(rank):
+        def _thunk():
+            return env_fn(rank=rank)
+        return _thunk
+    n = nenv * population_size
+    if n > 1:
+        env = SubprocVecEnv([_env(i) for i in range(n)])
+    else:
+        env = DummyVecEnv([_env(0)])
+    return PopulationVecMonitor(env, population_size, max_history=100, tstart=tstart, tbX=True)
+
+
+def _log_episode_stats(env):
+    for i in range(env.population_size):
+        logger.logkv(f'member{i} mean episode length', np.mean(env.episode_lengths[i]))
+        logger.logkv(f'member{i} mean episode reward', np.mean(env.episode_rewards[i]))
+
+
+@gin.configurable(blacklist=['logdir'])
+class PopulationPPO(PPO):
+    """
+    Trains population_size independent PPO agents. The policies of all
+    members act and are updated with one vmapped forward and backward pass.
+    Each member has its own environments, optimizer and logs, and is
+    checkpointed in logdir/member{i} in the format of PPO, so it can be
+    evaluated or resumed on its own.
+    Recurrent policies, observation normalization, distributed training,
+    remote environments, and worker inference are not supported.
+    """
+    def __init__(self, logdir, population_size=4, **kwargs):
+        self.population_size = population_size
+        super().__init__(logdir, **kwargs)
+        assert self.world_size == 1, "PopulationPPO does not support distributed training."
+        assert not self.worker_inference, "PopulationPPO does not support worker inference."
+        assert not self.recurrent, "PopulationPPO does not support recurrent policies."
+        members = [self.net] + [self.policy_fn().to(self.device) for _ in range(population_size - 1)]
+        self.nets = Population(members)
+        self.opts = [self.opt] + [self.optimizer_fn(net.parameters()) for net in members[1:]]
+        self.member_ckptrs = [Checkpointer(os.path.join(logdir, f'member{i}', 'ckpts')) for i in range(population_size)]
+        self.rollout = RolloutStorage(self.steps_per_iter, population_size * self.nenv, device=self.device, other_keys=['logp'])
+        self._mask = torch.zeros(population_size * self.nenv, device=self.device)
+
+    def _make_env(self, env_fn, nenv, endpoints=None):
+        assert endpoints is None, "PopulationPPO does not support remote environments."
+        tstart = max(self.ckptr.ckpts()) if len(self.ckptr.ckpts()) > 0 else 0
+        return _make_population_env(env_fn, nenv, self.population_size, tstart)
+
+    def member_state_dict(self, i):
+        return {
+            'net': self.nets[i].state_dict(),
+            'opt': self.opts[i].state_dict(),
+            't':   self.t,
+        }
+
+    def load_member_state_dict(self, i, state_dict):
+        self.nets[i].load_state_dict(state_dict['net'])
+        self.opts[i].load_state_dict(state_dict['opt'])
+
+    def state_dict(self):
+        # members are saved separately.
+        return {'t': self.t}
+
+    def load_state_dict(self, state_dict):
+        self.t = state_dict['t']
+
+    def save(self):
+        for i, ckptr in enumerate(self.member_ckptrs):
+            ckptr.save(self.member_state_dict(i), self.t)
+        super().save()
+
+    def load(self, t=None):
+        super().load(t)
+        for i, ckptr in enumerate(self.member_ckptrs):
+            self.load_member_state_dict(i, ckptr.load(self.t))
+
+    def _split(self, x):
+        """
+        Reshapes (steps, population_size * nenv, ...) rollout data to
+        (population_size, steps * nenv, ...).
+        """
+        T, N = x.shape[0], self.population_size
+        x = x.view(T, N, self.nenv, *x.shape[2:]).transpose(0, 1)
+        return x.reshape(N, T * self.nenv, *x.shape[3:])
+
+    def act(self):
+        def _act(net, ob):
+            outs = net(ob)
+            return outs.action, outs.value, outs.logp
+
+        with torch.no_grad():
+            ob = self._ob.view(self.population_size, self.nenv, *self._ob.shape[1:])
+            ac, value, logp = [x.view(-1, *x.shape[2:]) for x in self.nets.vmap(_act, ob)]
+        ob, r, done, _ = self.env.step(ac.cpu().numpy())
+        data = {}
+        data['ob'] = self._ob
+        data['ac'] = ac
+        data['r']  = torch.from_numpy(r).float()
+        data['mask'] = self._mask
+        data['vpred'] = value
+        data['logp'] = logp
+        self.rollout.insert(data)
+        self._ob = torch.from_numpy(ob).to(self.device)
+        self._mask = torch.from_numpy(1. - done.astype(np.float32)).to(self.device)
+        self.t += self.nenv
+
+    def _member_loss(self, net, batch):
+        return self._loss_terms(net(batch['ob']), batch)
+
+    def step(self):
+        logger.log("========================|  Iteration: {}  |========================".format(self.t // (self.steps_per_iter*self.nenv)))
+
+        # collect rollout data
+        for _ in range(self.steps_per_iter):
+            self.act()
+
+        # compute advatage and value targets
+        with torch.no_grad():
+            ob = self._ob.view(self.population_size, self.nenv, *self._ob.shape[1:])
+            next_value = self.nets.vmap(lambda net, ob: net(ob).value, ob).view(-1)
+            self.rollout.compute_targets(next_value, self._mask, self.gamma, use_gae=True, lambda_=self.lambda_, norm_advantages=False)
+            if self.norm_advantages:
+                self._normalize_advantages()
+
+        # update models
+        data = {k: self._split(v) for k,v in self.rollout.data.items()}
+        n = self.steps_per_iter * self.nenv
+        assert self.batch_size <= n
+        for _ in range(self.epochs_per_iter):
+            for inds in torch.randperm(n, device=self.device).split(self.batch_size):
+                batch = {k: v[:, inds] for k,v in data.items()}
+                for opt in self.opts:
+                    opt.zero_grad()
+                pi_loss, vf_loss, ent_loss = self.nets.vmap(self._member_loss, batch)
+                loss = pi_loss + self.vf_coef * vf_loss - self.ent_coef * ent_loss
+                loss.sum().backward()
+                for net, opt in zip(self.nets.members, self.opts):
+                    if self.max_grad_norm:
+                        nn.utils.clip_grad_norm_(net.parameters(), self.max_grad_norm)
+                    opt.step()
+                for k,v in zip(['tot', 'pi', 'value', 'ent'], [loss, pi_loss, vf_loss, ent_loss]):
+                    self.losses.add(k, v)
+            self.log_losses()
+        self.log()
+
+    def _normalize_advantages(self):
+        """
+        Normalizes the advantages of each member separately.
+        """
+        N = self.population_size
+        atarg = self.rollout.data['atarg'].view(self.steps_per_iter, N, self.nenv)
+        mean = atarg.mean(dim=(0, 2), keepdim=True)
+        std = atarg.std(dim=(0, 2), keepdim=True)
+        self.rollout.data['atarg'] = ((atarg - mean) / (std + 1e-5)).view(self.steps_per_iter, N * self.nenv)
+
+    def log_losses(self):
+        s = 'Losses:  '
+        means = self.losses.means()
+        for ln in ['tot', 'pi', 'value', 'ent']:
+            self.meanlosses[ln].append(means[ln])
+            s += '{}: {:08f}  '.format(ln, np.mean(self.meanlosses[ln][-1]))
+        logger.log(s)
+
+    def log(self):
+        names = {'tot': 'Total', 'pi': 'Policy', 'value': 'Value', 'ent': 'Entropy'}
+        tags = {'tot': 'total', 'pi': 'policy', 'value': 'value', 'ent': 'entropy'}
+        for ln in names:
+            losses = np.mean(self.meanlosses[ln], axis=0)
+            logger.logkv(f'Loss - {names[ln]}', np.mean(losses))
+            for i in range(self.population_size):
+                logger.add_scalar(f'member{i}/loss/{tags[ln]}', losses[i], self.t, time.time())
+        self.meanlosses = {'tot':[], 'pi':[], 'value':[], 'ent':[]}
+        # Logging stats...
+        logger.logkv('timesteps', self.t)
+        logger.logkv('fps', int(self.population_size * (self.t - self.t_start) / (time.monotonic() - self.time_start)))
+        logger.logkv('time_elapsed', time.monotonic() - self.time_start)
+        _log_episode_stats(self.env)
+        vpred = self._split(self.rollout.data['vpred'])
+        for i in range(self.population_size):
+            logger.add_scalar(f'member{i}/alg/v_max', torch.max(vpred[i]).cpu().numpy(), self.t, time.time())
+            logger.add_scalar(f'member{i}/alg/v_mean', torch.mean(vpred[i]).cpu().numpy(), self.t, time.time())
+        memory.log_memory(self.t, rollout=self.rollout, nets=self.nets, opt=self.opts)
+        self.timer.log(self.t)
+        logger.dumpkvs()
+
+    def evaluate(self):
+        eval_env = self.env_fn(rank=self.population_size*self.nenv+1)
+        for i, net in enumerate(self.nets.members):
+            net.train(False)
+            os.makedirs(os.path.join(self.logdir, f'member{i}', 'eval'), exist_ok=True)
+            outfile = os.path.join(self.logdir, f'member{i}', 'eval', self.ckptr.format.format(self.t) + '.json')
+            stats = rl_evaluate(eval_env, net, self.eval_nepisodes, outfile, self.device)
+            logger.add_scalar(f'member{i}/eval/mean_episode_reward', stats['mean_reward'], self.t, time.time())
+            logger.add_scalar(f'member{i}/eval/mean_episode_length', stats['mean_length'], self.t, time.time())
+            net.train(True)
+
+
+@gin.configurable(blacklist=['logdir'])
+class PopulationSAC(SAC):
+    """
+    Trains population_size independent SAC agents. The networks of all members
+    act and compute their losses in one vmapped pass, and all losses are
+    backpropagated together. Each member has its own environments, replay
+    buffer, optimizers and logs, and is checkpointed in logdir/member{i} in the
+    format of SAC, so it can be evaluated or resumed on its own.
+    Unlike SAC, the entropy coefficient used in the value and policy losses is
+    the one from before the alpha update of the same step.
+    Observation normalization and actor threads are not supported.
+    """
+    def __init__(self, logdir, population_size=4, **kwargs):
+        self.population_size = population_size
+        self.buffers = []
+        super().__init__(logdir, **kwargs)
+        assert not self.actor_thread, "PopulationSAC does not support actor threads."
+        assert not self.ensemble, "PopulationSAC does not support ensemble Q-functions."
+        assert self.vf is not None, "PopulationSAC requires a value function."
+        self.buffers = [self.buffer] + [self.buffer_fn() for _ in range(population_size - 1)]
+        members = [nn.ModuleDict({'pi': self.pi, 'qf1': self.qf1, 'qf2': self.qf2, 'vf': self.vf, 'target_vf': self.target_vf})]
+        self.opts = [self.opt]
+        self.alpha_opts = [self.opt_alpha]
+        self.log_alphas = [self.log_alpha]
+        for _ in range(population_size - 1):
+            member = nn.ModuleDict({'pi': self.policy_fn(), 'qf1': self.qf_fn(), 'qf2': self.qf_fn(),
+                                    'vf': self.vf_fn(), 'target_vf': self.vf_fn()}).to(self.device)
+            member['target_vf'].load_state_dict(member['vf'].state_dict())
+            if self.automatic_entropy_tuning:
+                log_alpha = torch.zeros(1, requires_grad=True, device=self.device)
+                opt_alpha = self.optimizer_fn([log_alpha], lr=self.policy_lr)
+            else:
+                log_alpha, opt_alpha = None, None
+            members.append(member)
+            self.opts.append(self._make_optimizer(member['pi'], [member['qf1'], member['qf2']], member['vf']))
+            self.alpha_opts.append(opt_alpha)
+            self.log_alphas.append(log_alpha)
+        self.nets = Population(members)
+        self.member_ckptrs = [Checkpointer(os.path.join(logdir, f'member{i}', 'ckpts')) for i in range(population_size)]
+        self._ent = None
+
+    def _make_env(self, env_fn, nenv):
+        tstart = max(self.ckptr.ckpts()) if len(self.ckptr.ckpts()) > 0 else 0
+        return _make_population_env(env_fn, nenv, self.population_size, tstart)
+
+    def _reset(self):
+        for buffer in self.buffers:
+            buffer.env_reset()
+        self._ob = self.env.reset()
+
+    def member_state_dict(self, i):
+        net = self.nets[i]
+        return {
+            'pi': net['pi'].state_dict(),
+            'qf1': net['qf1'].state_dict(),
+            'qf2': net['qf2'].state_dict(),
+            'vf': net['vf'].state_dict(),
+            'opt': self.opts[i].state_dict(),
+            'log_alpha': self.log_alphas[i] if self.automatic_entropy_tuning else None,
+            'opt_alpha': self.alpha_opts[i].state_dict() if self.automatic_entropy_tuning else None,
+            't':   self.t,
+        }
+
+    def load_member_state_dict(self, i, state_dict):
+        net = self.nets[i]
+        for k in ['pi', 'qf1', 'qf2', 'vf']:
+            net[k].load_state_dict(state_dict[k])
+        net['target_vf'].load_state_dict(state_dict['vf'])
+        self.opts[i].load_state_dict(state_dict['opt'])
+        if self.automatic_entropy_tuning:
+            with torch.no_grad():
+                self.log_alphas[i].copy_(state_dict['log_alpha'])
+            self.alpha_opts[i].load_state_dict(state_dict['opt_alpha'])
+
+    def state_dict(self):
+        # members and their buffers are saved separately.
+        return {'t': self.t}
+
+    def load_state_dict(self, state_dict):
+        self.t = state_dict['t']
+
+    def save(self):
+        for i, ckptr in enumerate(self.member_ckptrs):
+            ckptr.save(self.member_state_dict(i), self.t, arrays={'buffer': self.buffers[i].state_dict()})
+        self.ckptr.save(self.state_dict(), self.t)
+
+    def load(self, t=None):
+        self.load_state_dict(self.ckptr.load(t))
+        for i, ckptr in enumerate(self.member_ckptrs):
+            self.load_member_state_dict(i, ckptr.load(self.t))
+            self.buffers[i].load_state_dict(ckptr.load_arrays('buffer'))
+        self._reset()
+        self.t_start = self.t
+
+    def act(self):
+        N = self.population_size
+        idxs, xs = [], []
+        for buffer, ob in zip(self.buffers, np.split(self._ob, N)):
+            idxs.append(buffer.store_frames(ob))
+            xs.append(buffer.encode_recent_observations())
+        with torch.no_grad():
+            x = torch.from_numpy(np.stack(xs)).to(self.device)
+            ac = self.nets.vmap(lambda net, x: net.pi(x).action, x).cpu().numpy()
+        self._ob, r, done, _ = self.env.step(self._unnorm_action(ac.reshape(-1, *ac.shape[2:])))
+        for buffer, idx, ac_, r_, done_ in zip(self.buffers, idxs, ac, np.split(r, N), np.split(done, N)):
+            buffer.store_effects(idx, ac_, r_, done_)
+        self.t += self.nenv
+        return self.nenv
+
+    def _member_loss(self, net, log_alpha, ob, ac, rew, next_ob, done, update_pi):
+        """
+        SAC losses of one member. Gradients of the value and policy losses
+        do not flow into the Q-functions and alpha, so all losses can be
+        backpropagated at once.
+        """
+        pi_out = net.pi(ob, reparameterization_trick=self.rsample)
+        if self.discrete:
+            new_ac = pi_out.action
+            logp = pi_out.logp
+        else:
+            if self.rsample:
+                new_ac, new_pth_ac = pi_out.dist.rsample(return_pretanh_value=True)
+            else:
+                new_ac, new_pth_ac = pi_out.dist.sample(return_pretanh_value=True)
+            logp = pi_out.dist.log_prob(new_ac, new_pth_ac)
+        q1 = net.qf1(ob, ac).value
+        q2 = net.qf2(ob, ac).value
+        v  = net.vf(ob).value
+
+        # alpha loss
+        if self.automatic_entropy_tuning:
+            alpha_loss = -(log_alpha * (logp + self.target_entropy).detach()).mean()
+            alpha = log_alpha.exp().detach()
+        else:
+            alpha = 1
+            alpha_loss = torch.zeros_like(v).mean()
+
+        # qf loss
+        vtarg = net.target_vf.detach()(next_ob).value
+        qtarg = self.reward_scale * rew + (1.0 - done) * self.gamma * vtarg
+        assert qtarg.shape == q1.shape
+        assert qtarg.shape == q2.shape
+        qf1_loss = self.qf_criterion(q1, qtarg.detach())
+        qf2_loss = self.qf_criterion(q2, qtarg.detach())
+
+        # vf loss
+        q1_new = net.qf1.detach()(ob, new_ac).value
+        q2_new = net.qf2.detach()(ob, new_ac).value
+        q = torch.min(q1_new, q2_new)
+        vtarg = q - alpha * logp
+        assert v.shape == vtarg.shape
+        vf_loss = self.vf_criterion(v, vtarg.detach())
+
+        # pi loss
+        if update_pi:
+            if self.rsample:
+                assert q.shape == logp.shape
+                pi_loss = (alpha*logp - q).mean()
+            else:
+                pi_targ = q - v
+                assert pi_targ.shape == logp.shape
+                pi_loss = (logp * (alpha * logp - pi_targ).detach()).mean()
+
+            if not self.discrete: # continuous action space.
+                pi_loss += self.policy_mean_reg_weight * (pi_out.dist.normal.mean**2).mean()
+                pi_loss += self.policy_std_reg_weight * (pi_out.logstd**2).mean()
+        else:
+            pi_loss = torch.zeros_like(vf_loss)
+        return {'pi': pi_loss, 'qf1': qf1_loss, 'qf2': qf2_loss, 'vf': vf_loss, 'alpha': alpha_loss, 'ent': -logp.mean().detach()}
+
+    def update(self):
+        batches = [buffer.sample(self.batch_size) for buffer in self.buffers]
+        ob, ac, rew, next_ob, done = [torch.from_numpy(np.stack(x)).to(self.device) for x in zip(*batches)]
+        if self.automatic_entropy_tuning:
+            log_alpha = torch.stack(self.log_alphas)
+        else:
+            log_alpha = torch.zeros(self.population_size, 1, device=self.device)
+        update_pi = self.nupdates % self.policy_update_period == 0
+        loss_fn = functools.partial(self._member_loss, update_pi=update_pi)
+        losses = self.nets.vmap(loss_fn, log_alpha, ob, ac, rew, next_ob, done)
+
+        keys = ['qf1', 'qf2', 'vf', 'alpha'] if self.automatic_entropy_tuning else ['qf1', 'qf2', 'vf']
+        if update_pi:
+            keys.append('pi')
+        opts = self.opts + self.alpha_opts if self.automatic_entropy_tuning else self.opts
+        for opt in opts:
+            opt.zero_grad()
+        sum(losses[k].sum() for k in keys).backward()
+        for opt in opts:
+            opt.step()
+
+        for k in keys:
+            self.losses.add(k, losses[k])
+        self._ent = losses['ent']
+        self.nupdates += 1
+
+    def step(self):
+        self.act()
+        while self.buffer.num_in_buffer < min(self.learning_starts, self.buffer.size):
+            self.act()
+        for _ in range(self._period_crossings(self.target_update_period)):
+            soft_target_update([net['target_vf'] for net in self.nets.members],
+                               [net['vf'] for net in self.nets.members], self.target_smoothing_coef)
+
+        for _ in range(self._period_crossings(self.update_period)):
+            self.update()
+
+        if self._period_crossings(self.log_period) > 0 and self.t > 0:
+            self.log()
+
+    def log(self):
+        logger.log("========================|  Timestep: {}  |========================".format(self.t))
+        for k,losses in self.losses.means().items():
+            logger.logkv(f'Loss - {k}', np.mean(losses))
+            for i in range(self.population_size):
+                logger.add_scalar(f'member{i}/loss/{k}', losses[i], self.t, time.time())
+        if self._ent is not None:
+            ent = self._ent.cpu().numpy()
+            for i in range(self.population_size):
+                if self.automatic_entropy_tuning:
+                    logger.add_scalar(f'member{i}/ent/log_alpha', self.log_alphas[i].item(), self.t, time.time())
+                    scalars = {"target": self.target_entropy, "entropy": ent[i]}
+                    logger.add_scalars(f'member{i}/ent/entropy', scalars, self.t, time.time())
+                else:
+                    logger.add_scalar(f'member{i}/ent/entropy', ent[i], self.t, time.time())
+        # Logging stats...
+        logger.logkv('timesteps', self.t)
+        logger.logkv('fps', int(self.population_size * (self.t - self.t_start) / (time.monotonic() - self.time_start)))
+        logger.logkv('time_elapsed', time.monotonic() - self.time_start)
+        _log_episode_stats(self.env)
+        memory.log_memory(self.t, buffer=self.buffers, nets=self.nets, opt=self.opts + self.alpha_opts)
+        self.timer.log(self.t)
+        logger.dumpkvs()
+
+    def evaluate(self):
+        eval_env = self.env_fn(rank=self.population_size*self.nenv)
+        if self.frame_stack > 1:
+            eval_env = FrameStack(eval_env, self.frame_stack)
+        for i, net in enumerate(self.nets.members):
+            net.train(False)
+            os.makedirs(os.path.join(self.logdir, f'member{i}', 'eval'), exist_ok=True)
+            outfile = os.path.join(self.logdir, f'member{i}', 'eval', self.ckptr.format.format(self.t) + '.json')
+            stats = rl_evaluate(eval_env, net['pi'], self.eval_nepisodes, outfile, self.device)
+            logger.add_scalar(f'member{i}/eval/mean_episode_reward', stats['mean_reward'], self.t, time.time())
+            logger.add_scalar(f'member{i}/eval/mean_episode_length', stats['mean_length'], self.t, time.time())
+            net.train(True)
+
+
+
+
+import unittest, shutil
+from dl.util import atari_env, make_env, load_gin_configs
+import torch.optim as optim
+
+class TestPopulation(unittest.TestCase):
+    def test_population_ppo(self):
+        env_fn = lambda rank: atari_env('Pong', rank=rank)
+        ppo = PopulationPPO('logs', env_fn=env_fn, nenv=2, population_size=3, maxt=512, eval=False)
+        ppo.train()
+        assert ppo.t == 512
+        assert not torch.allclose(ppo.nets[0].vf.weight, ppo.nets[1].vf.weight)
+
+        # members can be resumed on their own
+        member = PPO('logs/member1', env_fn=env_fn, nenv=2, maxt=512, eval=False)
+        member.load()
+        assert member.t == 512
+        assert torch.allclose(member.net.vf.weight, ppo.nets[1].vf.weight)
+        shutil.rmtree('logs')
+
+    def test_population_sac(self):
+        env_fn = lambda rank: make_env('MountainCarContinuous-v0', rank=rank)
+        kwargs = dict(env_fn=env_fn, optimizer=optim.Adam, normalize_observations=False, learning_starts=300,
+                      buffer_size=500, maxt=1000, eval=False)
+        sac = PopulationSAC('logs', population_size=3, **kwargs)
+        sac.train()
+        assert sac.nupdates > 0
+        assert all(buffer.num_in_buffer == 500 for buffer in sac.buffers)
+        # one loss per member.
+        sac.update()
+        means = sac.losses.means(reset=False)
+        assert 'qf1' in means and all(np.shape(losses) == (3,) for losses in means.values())
+        sac.log()
+
+        member = SAC('logs/member2', **kwargs)
+        member.load()
+        assert member.t == 1000
+        assert torch.allclose(member.log_alpha, sac.log_alphas[2])
+        shutil.rmtree('logs')
+
+
+if __name__=='__main__':
+    load_gin_configs(['../configs/ppo.gin'], ['PPO.gpu=False'])
+    unittest.main()
@@ -4,14 +4,14 @@ PPO RL algorithm.
 https://arxiv.org/abs/1707.06347
 """
 from dl import Trainer
-from dl.modules import Policy
-from dl.util import RolloutStorage
-from dl.util import logger, find_monitor, VecMonitor
+from dl.modules import Policy, ObStatsAccumulator
+from dl.util import RolloutStorage, MetricsAccumulator
+from dl.util import logger, find_monitor, VecMonitor, RemoteVecEnv, PolicyWorkers, distributed, memory
 from dl.eval import rl_evaluate, rl_record, rl_plot
 from baselines.common.schedules import LinearSchedule
 from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
 from baselines.common.vec_env.dummy_vec_env import DummyVecEnv
-import gin, os, time, json
+import gin, os, time, json, functools
 import torch
 import torch.nn as nn
 import numpy as np
@@ -20,6 +20,18 @@ import numpy as np
 
 @gin.configurable(blacklist=['logdir'])
 class PPO(Trainer):
+    """
+    When torch.distributed is initialized, each rank collects nenv * steps_per_iter
+    transitions with its own environments and the gradients of each minibatch
+    are averaged across ranks. Observation statistics and advantage
+    normalization are computed over the data of all ranks.
+    If env_endpoints ('host:port' of EnvServers) is given, environments are
+    stepped remotely and nenv must equal the number of environments they host.
+    With multiple ranks, each rank connects to env_endpoints[rank::world_size].
+    If worker_inference is True, environments are stepped by nworkers processes
+    which act with a cpu copy of the policy, synced before each rollout, and
+    the rollout records the version of the weights used for each step.
+    """
     def __init__(self,
                  logdir,
                  env_fn,
@@ -38,11 +50,20 @@ class PPO(Trainer):
                  norm_observations=True,
                  norm_advantages=True,
                  eval_nepisodes=100,
+                 eval_nenv=1,
+                 env_endpoints=None,
+                 worker_inference=False,
+                 nworkers=None,
                  gpu=True,
                  **trainer_kwargs
     ):
         super().__init__(logdir, **trainer_kwargs)
-        self.env = self._make_env(env_fn, nenv)
+        self.worker_inference = worker_inference
+        if worker_inference:
+            # workers are started once the policy exists, use a temporary env for the spaces.
+            self.env = env_fn(rank=nenv*self.world_size+1)
+        else:
+            self.env = self._make_env(env_fn, nenv, env_endpoints)
         self.nenv = nenv
         self.env_fn = env_fn
         self.batch_size = batch_size
@@ -57,13 +78,28 @@ class PPO(Trainer):
         self.norm_observations = norm_observations
         self.norm_advantages = norm_advantages
         self.eval_nepisodes = eval_nepisodes
+        self.eval_nenv = eval_nenv
 
-        self.net = policy(self.env.observation_space.shape, self.env.action_space,  norm_observations=norm_observations)
+        self.policy_fn = functools.partial(policy, self.env.observation_space.shape, self.env.action_space, norm_observations=norm_observations)
+        self.optimizer_fn = optimizer
+        self.net = self.policy_fn()
         self.device = torch.device("cuda:0" if gpu and torch.cuda.is_available() else "cpu")
         self.net.to(self.device)
+        distributed.broadcast_module(self.net)
         self.opt = optimizer(self.net.parameters())
+        # observations are added to the normalization stats as they are
+        # inserted into the rollout, and applied once per iteration.
+        self.ob_stats = ObStatsAccumulator(self.net.running_norm) if norm_observations else None
+        if worker_inference:
+            self.env.close()
+            ranks = [self.rank * nenv + i for i in range(nenv)]
+            self.env = PolicyWorkers(env_fn, ranks, nworkers or nenv, self.net)
         self.recurrent_state_size = self.net.recurrent_state_size()
-        if self.recurrent_state_size is None:
+        if worker_inference:
+            self.recurrent = False
+            self.rollout = RolloutStorage(steps_per_iter, self.nenv, device=self.device, other_keys=['logp', 'version'])
+            self.init_state = None
+        elif self.recurrent_state_size is None:
             self.recurrent = False
             self.rollout = RolloutStorage(steps_per_iter, self.nenv, device=self.device, other_keys=['logp'])
             self.init_state = None
@@ -76,22 +112,27 @@ class PPO(Trainer):
                 self.init_state.append(torch.zeros(size=[self.nenv] + list(state.shape), device=self.device))
 
         self.t, self.t_start = 0,0
-        self.losses = {'tot':[], 'pi':[], 'value':[], 'ent':[]}
+        self.losses = MetricsAccumulator()
         self.meanlosses = {'tot':[], 'pi':[], 'value':[], 'ent':[]}
 
-        self._ob = torch.from_numpy(self.env.reset()).to(self.device)
+        if not worker_inference:
+            self._ob = torch.from_numpy(self.env.reset()).to(self.device)
         self._mask = torch.Tensor([0. for _ in range(self.nenv)]).to(self.device)
         self._state = self.init_state
 
-    def _make_env(self, env_fn, nenv):
+    def _make_env(self, env_fn, nenv, endpoints=None):
         def _env(rank):
             def _thunk():
                 return env_fn(rank=rank)
             return _thunk
-        if nenv > 1:
-            env = SubprocVecEnv([_env(i) for i in range(nenv)])
+        offset = self.rank * nenv
+        if endpoints:
+            env = RemoteVecEnv(endpoints[self.rank::self.world_size])
+            assert env.num_envs == nenv, f"Remote envs host {env.num_envs} environments but nenv is {nenv}."
+        elif nenv > 1:
+            env = SubprocVecEnv([_env(offset + i) for i in range(nenv)])
         else:
-            env = DummyVecEnv([_env(0)])
+            env = DummyVecEnv([_env(offset)])
         tstart = max(self.ckptr.ckpts()) if len(self.ckptr.ckpts()) > 0 else 0
         return VecMonitor(env, max_history=100, tstart=tstart, tbX=True)
 
@@ -112,12 +153,14 @@ class PPO(Trainer):
         self.t_start = self.t
 
     def act(self):
-        with torch.no_grad():
+        with torch.no_grad(), self.timer('act'):
             if self.recurrent:
                 outs = self.net(self._ob, mask=self._mask, state_in=self._state)
             else:
                 outs = self.net(self._ob)
-        ob, r, done, _ = self.env.step(outs.action.cpu().numpy())
+            ac = outs.action.cpu().numpy()
+        with self.timer('env_step'):
+            ob, r, done, _ = self.env.step(ac)
         data = {}
         data['ob'] = self._ob
         data['ac'] = outs.action
@@ -129,10 +172,25 @@ class PPO(Trainer):
             for i,name in self.recurrent_keys:
                 data[name] = self._state[i]
         self.rollout.insert(data)
+        if self.norm_observations:
+            self.ob_stats.add(self._ob)
         self._ob = torch.from_numpy(ob).to(self.device)
         self._mask = torch.Tensor([0.0 if done_ else 1.0 for done_ in done]).to(self.device)
         self._state = outs.state_out
-        self.t += self.nenv
+        self.t += self.nenv * self.world_size
+
+    def collect_from_workers(self):
+        """
+        Fills the rollout with data collected by the policy workers.
+        """
+        batch = self.env.collect(self.net, self.steps_per_iter)
+        for step in range(self.steps_per_iter):
+            self.rollout.insert({k: torch.from_numpy(batch[k][step]) for k in self.rollout.keys})
+        if self.norm_observations:
+            self.ob_stats.add(batch['ob'].reshape(-1, *batch['ob'].shape[2:]))
+        self._ob = torch.from_numpy(batch['next_ob']).to(self.device)
+        self._mask = torch.from_numpy(batch['next_mask']).to(self.device)
+        self.t += self.steps_per_iter * self.nenv * self.world_size
 
     def loss(self, batch):
         if self.recurrent:
@@ -140,7 +198,20 @@ class PPO(Trainer):
             outs = self.net(batch['ob'], mask=batch['mask'], state_in=state)
         else:
             outs = self.net(batch['ob'])
+        pi_loss, vf_loss, ent_loss = self._loss_terms(outs, batch)
+        self.losses.add('pi', pi_loss)
+        self.losses.add('value', vf_loss)
+        self.losses.add('ent', ent_loss)
 
+        loss = pi_loss + self.vf_coef * vf_loss - self.ent_coef * ent_loss
+        self.losses.add('tot', loss)
+        return loss
+
+    def _loss_terms(self, outs, batch):
+        """
+        Returns the policy, value, and entropy losses for the outputs of the
+        policy on batch.
+        """
         # compute policy loss
         logp = outs.dist.log_prob(batch['ac'])
         assert logp.shape == batch['logp'].shape
@@ -149,7 +220,6 @@ class PPO(Trainer):
         ploss1 = ratio * batch['atarg']
         ploss2 = torch.clamp(ratio, 1.0-self.clip_param, 1.0+self.clip_param) * batch['atarg']
         pi_loss = -torch.min(ploss1, ploss2).mean()
-        self.losses['pi'].append(pi_loss)
 
         # compute value loss
         criterion = torch.nn.MSELoss(reduction='none')
@@ -157,36 +227,38 @@ class PPO(Trainer):
         vpred_clipped = batch['vpred'] + (outs.value - batch['vpred']).clamp(-self.clip_param, self.clip_param)
         vloss2 = 0.5 * criterion(vpred_clipped, batch['vtarg'])
         vf_loss = torch.max(vloss1, vloss2).mean()
-        self.losses['value'].append(vf_loss)
 
         # compute entropy loss
         ent_loss = outs.dist.entropy().mean()
-        self.losses['ent'].append(ent_loss)
-
-        loss = pi_loss + self.vf_coef * vf_loss - self.ent_coef * ent_loss
-        self.losses['tot'].append(loss)
-        return loss
+        return pi_loss, vf_loss, ent_loss
 
     def step(self):
-        logger.log("========================|  Iteration: {}  |========================".format(self.t // (self.steps_per_iter*self.nenv)))
+        logger.log("========================|  Iteration: {}  |========================".format(self.t // (self.steps_per_iter*self.nenv*self.world_size)))
 
         # collect rollout data
-        for _ in range(self.steps_per_iter):
-            self.act()
+        if self.worker_inference:
+            with self.timer('collect'):
+                self.collect_from_workers()
+        else:
+            for _ in range(self.steps_per_iter):
+                self.act()
 
         # compute advatage and value targets
-        with torch.no_grad():
+        with torch.no_grad(), self.timer('compute_targets'):
             if self.recurrent:
                 next_value = self.net(self._ob, mask=self._mask, state_in=self._state).value
             else:
                 next_value = self.net(self._ob).value
-            self.rollout.compute_targets(next_value, self._mask, self.gamma, use_gae=True, lambda_=self.lambda_, norm_advantages=self.norm_advantages)
+            if self.world_size == 1:
+                self.rollout.compute_targets(next_value, self._mask, self.gamma, use_gae=True, lambda_=self.lambda_, norm_advantages=self.norm_advantages)
+            else:
+                self.rollout.compute_targets(next_value, self._mask, self.gamma, use_gae=True, lambda_=self.lambda_, norm_advantages=False)
+                if self.norm_advantages:
+                    self._normalize_advantages()
 
         # update running norm
         if self.norm_observations:
-            with torch.no_grad():
-                batch_mean, batch_var, batch_count = self.rollout.compute_ob_stats()
-                self.net.running_norm.update(batch_mean, batch_var, batch_count)
+            self.ob_stats.flush(reduce=distributed.all_reduce_moments)
 
         # update model
         for _ in range(self.epochs_per_iter):
@@ -197,24 +269,41 @@ class PPO(Trainer):
 
             for batch in sampler:
                 self.opt.zero_grad()
-                loss = self.loss(batch)
-                loss.backward()
-                if self.max_grad_norm:
-                    nn.utils.clip_grad_norm_(self.net.parameters(), self.max_grad_norm)
-                self.opt.step()
+                with self.timer('loss'):
+                    loss = self.loss(batch)
+                with self.timer('backward'):
+                    loss.backward()
+                    distributed.all_reduce_gradients(self.net.parameters())
+                with self.timer('optimizer_step'):
+                    if self.max_grad_norm:
+                        nn.utils.clip_grad_norm_(self.net.parameters(), self.max_grad_norm)
+                    self.opt.step()
             self.log_losses()
         self.log()
 
+    def _normalize_advantages(self):
+        """
+        Normalizes advantages with the mean and std of the advantages of all ranks.
+        """
+        atarg = self.rollout.data['atarg']
+        n = atarg.numel()
+        mean, var, count = distributed.all_reduce_moments(atarg.mean().view(1), atarg.var(unbiased=False).view(1), n)
+        std = torch.sqrt(var * count / (count - 1))
+        self.rollout.data['atarg'] = (atarg - mean) / (std + 1e-5)
+
     def log_losses(self):
         s = 'Losses:  '
+        means = self.losses.means()
         for ln in ['tot', 'pi', 'value', 'ent']:
-            with torch.no_grad():
-                self.meanlosses[ln].append((sum(self.losses[ln]) / len(self.losses[ln])).cpu().numpy())
+            self.meanlosses[ln].append(means[ln])
             s += '{}: {:08f}  '.format(ln, self.meanlosses[ln][-1])
         logger.log(s)
-        self.losses = {'tot':[], 'pi':[], 'value':[], 'ent':[]}
 
     def log(self):
+        if self.rank != 0:
+            self.meanlosses = {'tot':[], 'pi':[], 'value':[], 'ent':[]}
+            self.timer.reset()
+            return
         with torch.no_grad():
             logger.logkv('Loss - Total', np.mean(self.meanlosses['tot']))
             logger.logkv('Loss - Policy', np.mean(self.meanlosses['pi']))
@@ -232,25 +321,36 @@ class PPO(Trainer):
 
         logger.logkv('mean episode length', np.mean(self.env.episode_lengths))
         logger.logkv('mean episode reward', np.mean(self.env.episode_rewards))
+        if isinstance(getattr(self.env, 'venv', None), RemoteVecEnv):
+            for endpoint, stats in self.env.venv.latency().items():
+                logger.logkv(f'latency (ms) {endpoint}', stats['latency_ms'])
+                name = endpoint.replace(':', '_')
+                logger.add_scalar(f'env/latency_ms/{name}', stats['latency_ms'], self.t, time.time())
+                logger.add_scalar(f'env/server_step_ms/{name}', stats['step_ms'], self.t, time.time())
+        if self.worker_inference:
+            lag = self.env.weights.version.value - self.rollout.data['version'].float().mean().item()
+            logger.logkv('policy version lag', lag)
+            logger.add_scalar('alg/policy_version_lag', lag, self.t, time.time())
         vmax = torch.max(self.rollout.data['vpred']).cpu().numpy()
         vmean = torch.mean(self.rollout.data['vpred']).cpu().numpy()
         logger.add_scalar('alg/v_max', vmax, self.t, time.time())
         logger.add_scalar('alg/v_mean', vmean, self.t, time.time())
+        memory.log_memory(self.t, rollout=self.rollout, net=self.net, opt=self.opt)
+        self.timer.log(self.t)
         logger.dumpkvs()
 
     def evaluate(self):
         self.net.train(False)
-        # create new env to access true reward function and episode lenghts from the Monitor wrapper (if it exists)
-        eval_env = self.env_fn(rank=self.nenv+1)
-
         os.makedirs(os.path.join(self.logdir, 'eval'), exist_ok=True)
         outfile = os.path.join(self.logdir, 'eval', self.ckptr.format.format(self.t) + '.json')
-        stats = rl_evaluate(eval_env, self.net, self.eval_nepisodes, outfile, self.device)
+        stats = rl_evaluate(self.env_fn, self.net, self.eval_nepisodes, outfile, self.device, nenv=self.eval_nenv, rank=self.nenv*self.world_size+1)
         logger.add_scalar('eval/mean_episode_reward', stats['mean_reward'], self.t, time.time())
         logger.add_scalar('eval/mean_episode_length', stats['mean_length'], self.t, time.time())
 
         os.makedirs(os.path.join(self.logdir, 'video'), exist_ok=True)
         outfile = os.path.join(self.logdir, 'video', self.ckptr.format.format(self.t) + '.mp4')
+        # create new env to access true reward function and episode lenghts from the Monitor wrapper (if it exists)
+        eval_env = self.env_fn(rank=self.nenv*self.world_size+1)
         rl_record(eval_env, self.net, 5, outfile, self.device)
 
         if find_monitor(eval_env):
@@ -268,8 +368,23 @@ class PPO(Trainer):
 
 
 import unittest, shutil
-from dl.util import atari_env, load_gin_configs
+from dl.util import atari_env, load_gin_configs, Checkpointer
 from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
+import torch.multiprocessing as mp
+
+def _distributed_ppo(rank, world_size):
+    distributed.init_process_group(rank, world_size, master_port=29513)
+    load_gin_configs(['../configs/ppo.gin'], ['PPO.gpu=False'])
+    env_fn = lambda rank: atari_env('Pong', rank=rank)
+    ppo = PPO('logs', env_fn, nenv=2, norm_observations=True, maxt=2048, eval=False)
+    ppo.train()
+    assert ppo.t == 2048
+    params = [p.detach().view(-1) for p in ppo.net.state_dict().values()]
+    params = torch.cat(params)
+    gathered = [torch.empty_like(params) for _ in range(world_size)]
+    distributed.dist.all_gather(gathered, params)
+    assert all(torch.allclose(gathered[0], x) for x in gathered)
+    distributed.dist.destroy_process_group()
 
 class TestPPO(unittest.TestCase):
     def test_feed_forward_ppo(self):
@@ -278,6 +393,19 @@ class TestPPO(unittest.TestCase):
         ppo.train()
         shutil.rmtree('logs')
 
+    def test_worker_inference_ppo(self):
+        env_fn = lambda rank: atari_env('Pong', rank=rank)
+        ppo = PPO('logs', env_fn, nenv=4, worker_inference=True, nworkers=2, maxt=1024, eval=False)
+        ppo.train()
+        assert ppo.t == 1024
+        assert torch.all(ppo.rollout.data['version'] == ppo.env.weights.version.value)
+        shutil.rmtree('logs')
+
+    def test_distributed_ppo(self):
+        mp.spawn(_distributed_ppo, args=(2,), nprocs=2)
+        assert Checkpointer('logs/ckpts').ckpts() == [2048]
+        shutil.rmtree('logs')
+
 
 if __name__=='__main__':
     load_gin_configs(['../configs/ppo.gin'], ['PPO.gpu=False'])
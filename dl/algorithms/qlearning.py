@@ -2,14 +2,24 @@ from dl import Trainer
 from dl.modules import QFunction
 from dl.util import ReplayBuffer, PrioritizedReplayBuffer
 from dl.util import logger, find_monitor, FrameStack, EpsilonGreedy, TBXMonitor
+from dl.util import ActorThread, ReplayRatioController, RWLock, MetricsAccumulator, memory
 from dl.eval import rl_evaluate, rl_record, rl_plot
 from baselines.common.schedules import LinearSchedule
-import gin, os, time, json
+import gin, os, time, json, threading
 import torch
 import numpy as np
 from collections import deque
 
 
+def _eval_env_fn(env_fn, frame_stack, eps):
+    def _env(rank):
+        env = env_fn(rank=rank)
+        if frame_stack > 1:
+            env = FrameStack(env, frame_stack)
+        return EpsilonGreedy(env, eps)
+    return _env
+
+
 @gin.configurable(blacklist=['logdir'])
 class QLearning(Trainer):
     def __init__(self,
@@ -27,6 +37,7 @@ class QLearning(Trainer):
                  final_eps=0.1,
                  eval_eps=0.05,
                  eval_nepisodes=100,
+                 eval_nenv=1,
                  target_update_period=10000,
                  double_dqn=False,
                  buffer=ReplayBuffer,
@@ -37,12 +48,14 @@ class QLearning(Trainer):
                  t_beta_max=int(1e7),
                  gpu=True,
                  log_period=1000,
+                 actor_thread=False,
+                 actor_sync_period=100,
+                 max_actor_lag=1000,
                  **trainer_kwargs
                  ):
         super().__init__(logdir, **trainer_kwargs)
-        tstart = max(self.ckptr.ckpts()) if len(self.ckptr.ckpts()) > 0 else 0
-        self.env = TBXMonitor(env_fn(rank=0), tstart=tstart)
         self.env_fn = env_fn
+        self.env = self._make_env()
         self.gamma = gamma
         self.batch_size = batch_size
         self.update_period = update_period
@@ -52,6 +65,7 @@ class QLearning(Trainer):
         self.double_dqn = double_dqn
         self.eval_eps = eval_eps
         self.eval_nepisodes = eval_nepisodes
+        self.eval_nenv = eval_nenv
         self.log_period = log_period
         self.prioritized_replay = prioritized_replay
         self.buffer = buffer(buffer_size, frame_stack)
@@ -73,10 +87,31 @@ class QLearning(Trainer):
         else:
             self.criterion = torch.nn.MSELoss(reduction='none')
         self.t, self.t_start = 0,0
-        self.losses = []
+        self.nupdates = 0
+        self.losses = MetricsAccumulator()
+
+        # When actor_thread is True, the environment is stepped in a separate
+        # thread using a copy of self.net which is synced every
+        # actor_sync_period updates.
+        self.actor_thread = actor_thread
+        self.actor_sync_period = actor_sync_period
+        self.max_actor_lag = max_actor_lag
+        self.actor = None
+        self.buffer_lock = RWLock()
+        self.act_lock = threading.Lock()
+        if actor_thread:
+            self.act_net = qfunction(ob_shape, self.env.action_space)
+            self.act_net.to(self.device)
+            self.act_net.load_state_dict(self.net.state_dict())
+        else:
+            self.act_net = self.net
 
         self._reset()
 
+    def _make_env(self):
+        tstart = max(self.ckptr.ckpts()) if len(self.ckptr.ckpts()) > 0 else 0
+        return TBXMonitor(self.env_fn(rank=0), tstart=tstart)
+
     def _reset(self):
         self.buffer.env_reset()
         self._ob = self.env.reset()
@@ -98,34 +133,43 @@ class QLearning(Trainer):
         self._reset()
 
     def save(self):
-        state = self.state_dict()
-        # save buffer seperately and only once (because it is huge)
-        buffer_state_dict = state['buffer']
-        state_without_buffer = dict(state)
-        del state_without_buffer['buffer']
-        self.ckptr.save(state_without_buffer, self.t)
-        np.savez(os.path.join(self.ckptr.ckptdir, 'buffer.npz'), **buffer_state_dict)
+        # block the actor thread (if any) so that the buffer and t are consistent.
+        with self.buffer_lock.read():
+            state = self.state_dict()
+            # save buffer seperately and only once (because it is huge)
+            buffer_state_dict = state['buffer']
+            state_without_buffer = dict(state)
+            del state_without_buffer['buffer']
+            self.ckptr.save(state_without_buffer, state['t'], arrays={'buffer': buffer_state_dict})
 
     def load(self, t=None):
         state = self.ckptr.load(t)
-        state['buffer'] = np.load(os.path.join(self.ckptr.ckptdir, 'buffer.npz'))
+        state['buffer'] = self.ckptr.load_arrays('buffer')
         self.load_state_dict(state)
+        self.act_net.load_state_dict(self.net.state_dict())
         self.t_start = self.t
 
     def act(self):
-        idx = self.buffer.store_frame(self._ob)
+        """
+        Take one step in the environment. Returns the number of steps taken.
+        """
+        with self.buffer_lock.write():
+            idx = self.buffer.store_frame(self._ob)
+            x = self.buffer.encode_recent_observation()
         if self.eps_schedule.value(self.t) > np.random.rand():
             ac = np.array(self.env.action_space.sample())
         else:
-            x = self.buffer.encode_recent_observation()
-            with torch.no_grad():
+            with torch.no_grad(), self.act_lock, self.timer('act'):
                 x = torch.from_numpy(x).to(self.device)
-                ac = self.net(x[None]).action.cpu().numpy()[0]
-        self._ob, r, done, _ = self.env.step(ac)
-        self.buffer.store_effect(idx, ac, r, done)
+                ac = self.act_net(x[None]).action.cpu().numpy()[0]
+        with self.timer('env_step'):
+            self._ob, r, done, _ = self.env.step(ac)
+        with self.buffer_lock.write():
+            self.buffer.store_effect(idx, ac, r, done)
+            self.t += 1
         if done:
             self._ob = self.env.reset()
-        self.t += 1
+        return 1
 
     def loss(self, batch):
         if self.prioritized_replay:
@@ -149,42 +193,83 @@ class QLearning(Trainer):
         err = self.criterion(target, q)
 
         if self.prioritized_replay:
-            self.buffer.update_priorities(idx, err.detach().cpu().numpy() + 1e-6)
+            priorities = err.detach().cpu().numpy() + 1e-6
+            with self.buffer_lock.write():
+                self.buffer.update_priorities(idx, priorities)
             assert err.shape == weight.shape
             err = weight * err
         loss = err.mean()
-        self.losses.append(loss)
+        self.losses.add('loss', loss)
         if self.t % self.log_period == 0 and self.t > 0:
             logger.add_scalar('alg/maxq', torch.max(q).detach().cpu().numpy(), self.t, time.time())
 
         return loss
 
-    def step(self):
-        self.act()
-        while self.buffer.num_in_buffer < min(self.learning_starts, self.buffer.size):
-            self.act()
-        if self.t % self.target_update_period == 0:
-            self.target_net.load_state_dict(self.net.state_dict())
-
-        if self.t % self.update_period == 0:
+    def update(self):
+        with self.buffer_lock.read(), self.timer('sample'):
             if self.prioritized_replay:
                 beta = self.beta_schedule.value(self.t)
                 batch = self.buffer.sample(self.batch_size, beta)
             else:
                 batch = self.buffer.sample(self.batch_size)
 
-            self.opt.zero_grad()
+        self.opt.zero_grad()
+        with self.timer('loss'):
             loss = self.loss(batch)
+        with self.timer('backward'):
             loss.backward()
+        with self.timer('optimizer_step'):
             self.opt.step()
+        self.nupdates += 1
+        if self.actor_thread and self.nupdates % self.actor_sync_period == 0:
+            with self.act_lock:
+                self.act_net.load_state_dict(self.net.state_dict())
+
+    def step(self):
+        if self.actor_thread:
+            self._learner_step()
+            return
+        self.act()
+        while self.buffer.num_in_buffer < min(self.learning_starts, self.buffer.size):
+            self.act()
+        if self.t % self.target_update_period == 0:
+            self.target_net.load_state_dict(self.net.state_dict())
+
+        if self.t % self.update_period == 0:
+            self.update()
 
         if self.t % self.log_period == 0 and self.t > 0:
             self.log()
 
+    def _start_actor(self):
+        learning_starts = max(0, min(self.learning_starts, self.buffer.size) - self.buffer.num_in_buffer)
+        self.controller = ReplayRatioController(1. / self.update_period, learning_starts, self.max_actor_lag)
+        self.actor = ActorThread(self.act, self.controller)
+        self._last_t = self.t
+        self.actor.start()
+
+    def _learner_step(self):
+        """
+        Performs one update while the actor thread steps the environment.
+        Returns early if the replay ratio does not allow an update yet so that
+        Trainer.train can check for termination.
+        """
+        if self.actor is None:
+            self._start_actor()
+        self.actor.check()
+        if not self.controller.wait_to_update(timeout=0.1):
+            return
+        t, last_t = self.t, self._last_t
+        self._last_t = t
+        if t // self.target_update_period > last_t // self.target_update_period:
+            self.target_net.load_state_dict(self.net.state_dict())
+        self.update()
+        self.controller.add_update()
+        if t // self.log_period > last_t // self.log_period:
+            self.log()
+
     def log(self):
-        with torch.no_grad():
-            meanloss = (sum(self.losses) / len(self.losses)).cpu().numpy()
-        self.losses = []
+        meanloss = self.losses.means().get('loss', np.nan)
         logger.log("========================|  Timestep: {}  |========================".format(self.t))
         # Logging stats...
         logger.logkv('Loss', meanloss)
@@ -193,11 +278,18 @@ class QLearning(Trainer):
         logger.logkv('fps', fps)
         logger.logkv('time_elapsed', time.monotonic() - self.time_start)
         logger.logkv('time spent exploring', self.eps_schedule.value(self.t))
+        if self.actor is not None:
+            for k,v in self.controller.stats().items():
+                logger.logkv(k, v)
+                logger.add_scalar(f'alg/{k}', v, self.t, time.time())
 
         monitor = find_monitor(self.env)
         if monitor is not None:
-            logger.logkv('mean episode length', np.mean(monitor.episode_lengths[-100:]))
-            logger.logkv('mean episode reward', np.mean(monitor.episode_rewards[-100:]))
+            mean_length, mean_reward = monitor.mean_episode_stats()
+            logger.logkv('mean episode length', mean_length)
+            logger.logkv('mean episode reward', mean_reward)
+        memory.log_memory(self.t, buffer=self.buffer, nets=[self.net, self.target_net, self.act_net], opt=self.opt)
+        self.timer.log(self.t)
         logger.dumpkvs()
         logger.add_scalar('alg/loss', meanloss, self.t, time.time())
         logger.add_scalar('alg/fps', fps, self.t, time.time())
@@ -205,27 +297,26 @@ class QLearning(Trainer):
 
     def evaluate(self):
         self.net.train(False)
-        env = self.env_fn(rank=1)
-        if self.frame_stack > 1:
-            eval_env = EpsilonGreedy(FrameStack(env, self.frame_stack), self.eval_eps)
-        else:
-            eval_env = EpsilonGreedy(env, self.eval_eps)
+        eval_env_fn = _eval_env_fn(self.env_fn, self.frame_stack, self.eval_eps)
 
         os.makedirs(os.path.join(self.logdir, 'eval'), exist_ok=True)
         outfile = os.path.join(self.logdir, 'eval', self.ckptr.format.format(self.t) + '.json')
-        stats = rl_evaluate(eval_env, self.net, self.eval_nepisodes, outfile, self.device)
+        stats = rl_evaluate(eval_env_fn, self.net, self.eval_nepisodes, outfile, self.device, nenv=self.eval_nenv, rank=1)
         logger.add_scalar('eval/mean_episode_reward', stats['mean_reward'], self.t, time.time())
         logger.add_scalar('eval/mean_episode_length', stats['mean_length'], self.t, time.time())
 
         os.makedirs(os.path.join(self.logdir, 'video'), exist_ok=True)
         outfile = os.path.join(self.logdir, 'video', self.ckptr.format.format(self.t) + '.mp4')
-        rl_record(eval_env, self.net, 5, outfile, self.device)
+        rl_record(eval_env_fn(rank=1), self.net, 5, outfile, self.device)
 
         if find_monitor(self.env):
             rl_plot(os.path.join(self.logdir, 'logs'), self.env.spec.id, self.t)
         self.net.train(True)
 
     def close(self):
+        if self.actor is not None:
+            self.actor.stop()
+            self.actor = None
         if hasattr(self.env, 'close'):
             self.env.close()
         logger.reset()
@@ -256,6 +347,16 @@ class TestQLearning(unittest.TestCase):
         ql.train()
         shutil.rmtree('logs')
 
+    def test_actor_thread(self):
+        env = lambda rank: atari_env('Pong', rank=rank)
+        ql = QLearning('logs', env, learning_starts=100, prioritized_replay=True, actor_thread=True, actor_sync_period=10, max_actor_lag=10, maxt=1000)
+        ql.train()
+        c = ql.controller
+        assert c.updates > 0
+        assert c.updates <= (c.steps - 100) / ql.update_period
+        assert c.steps <= 100 + c.updates * ql.update_period + 11
+        shutil.rmtree('logs')
+
     def test_gpu(self):
         if not torch.cuda.is_available():
             return
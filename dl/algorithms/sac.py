@@ -4,32 +4,71 @@ https://arxiv.org/abs/1801.01290
 https://arxiv.org/abs/1812.05905
 """
 from dl import Trainer
-from dl.modules import Policy, QFunction, ValueFunction, TanhDiagGaussian
+from dl.modules import Policy, QFunction, EnsembleQFunction, ValueFunction, TanhDiagGaussian, FunctionalModule
+from dl.modules import ObStatsAccumulator
 from dl.util import ReplayBuffer
-from dl.util import logger, find_monitor, FrameStack, TBXMonitor
+from dl.util import logger, find_monitor, FrameStack, VecMonitor
+from dl.util import ActorThread, ReplayRatioController, RWLock, MetricsAccumulator, memory
 from dl.eval import rl_evaluate, rl_record, rl_plot
-import gin, os, time, json
+from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
+from baselines.common.vec_env.dummy_vec_env import DummyVecEnv
+import gin, os, time, json, threading, functools
 import torch
 import torch.nn as nn
 import numpy as np
 
 
 def soft_target_update(target_net, net, tau):
-    for tp, p in zip(target_net.parameters(), net.parameters()):
-        tp.data.copy_((1. - tau) * tp.data + tau * p.data)
+    """
+    target = (1 - tau) * target + tau * net, for all parameters in one
+    in-place multi-tensor op. target_net and net can also be lists of modules.
+    """
+    if isinstance(target_net, nn.Module):
+        target_net, net = [target_net], [net]
+    tps = [tp for m in target_net for tp in m.parameters()]
+    ps = [p for m in net for p in m.parameters()]
+    with torch.no_grad():
+        torch._foreach_lerp_(tps, ps, tau)
+
+def _eval_env_fn(env_fn, frame_stack):
+    def _env(rank):
+        env = env_fn(rank=rank)
+        if frame_stack > 1:
+            env = FrameStack(env, frame_stack)
+        return env
+    return _env
+
 
 @gin.configurable(blacklist=['logdir'])
 class SAC(Trainer):
+    """
+    If qf is an EnsembleQFunction, it replaces the twin Q-functions qf1 and
+    qf2 and all of its Q-functions are evaluated in one batched pass. The value
+    target then uses the minimum of qf_subset_size randomly chosen members of
+    the ensemble, as in REDQ (https://arxiv.org/abs/2101.05982).
+
+    If vf is None, SAC is trained without a value function, as in
+    https://arxiv.org/abs/1812.05905: the Q-functions are trained towards a
+    soft Bellman backup of target Q-functions, which track the Q-functions
+    the same way target_vf tracks vf.
+
+    The policy, Q-functions and value function share one optimizer with a
+    parameter group for each. Their losses depend on disjoint parameters, so
+    they are backpropagated together and applied in one (foreach) step.
+    """
     def __init__(self,
                  logdir,
                  env_fn,
                  optimizer,
+                 nenv=1,
                  policy=Policy,
                  qf=QFunction,
                  vf=ValueFunction,
                  policy_lr=1e-3,
                  qf_lr=1e-3,
                  vf_lr=1e-3,
+                 qf_subset_size=2,
+                 foreach=True,
                  policy_mean_reg_weight=1e-3,
                  policy_std_reg_weight=1e-3,
                  gamma=0.99,
@@ -40,21 +79,26 @@ class SAC(Trainer):
                  frame_stack=1,
                  learning_starts=50000,
                  eval_nepisodes=100,
+                 eval_nenv=1,
                  target_smoothing_coef=0.005,
                  automatic_entropy_tuning=True,
                  reparameterization_trick=True,
                  normalize_observations=True,
+                 ob_stats_period=128,
                  target_entropy=None,
                  reward_scale=1,
                  buffer=ReplayBuffer,
                  buffer_size=1000000,
                  gpu=True,
                  log_period=1000,
+                 actor_thread=False,
+                 actor_sync_period=100,
+                 max_actor_lag=1000,
                  **trainer_kwargs
     ):
         super().__init__(logdir, **trainer_kwargs)
-        tstart = max(self.ckptr.ckpts()) if len(self.ckptr.ckpts()) > 0 else 0
-        self.env = TBXMonitor(env_fn(rank=0), tstart=tstart)
+        self.env = self._make_env(env_fn, nenv)
+        self.nenv = nenv
         self.env_fn = env_fn
         self.gamma = gamma
         self.batch_size = batch_size
@@ -68,8 +112,10 @@ class SAC(Trainer):
         self.target_smoothing_coef = target_smoothing_coef
         self.norm_obs = normalize_observations
         self.eval_nepisodes = eval_nepisodes
+        self.eval_nenv = eval_nenv
         self.log_period = log_period
-        self.buffer = buffer(buffer_size, frame_stack)
+        self.buffer_fn = functools.partial(buffer, buffer_size, frame_stack, nenv=nenv)
+        self.buffer = self.buffer_fn()
 
         s = self.env.observation_space.shape
         ob_shape = (s[0] * self.frame_stack, *s[1:])
@@ -79,27 +125,53 @@ class SAC(Trainer):
             dist = TanhDiagGaussian
         else:
             dist = None
-        self.pi  = policy(ob_shape, self.env.action_space,  norm_observations=self.norm_obs, dist=dist)
-        self.qf1 = qf(ob_shape, self.env.action_space)
-        self.qf2 = qf(ob_shape, self.env.action_space)
-        self.vf = vf(ob_shape)
-        self.target_vf = vf(ob_shape)
+        if self.env.action_space.__class__.__name__ == 'Box':
+            self._ac_low = self.env.action_space.low
+            self._ac_scale = 0.5 * (self.env.action_space.high - self.env.action_space.low)
+        else:
+            self._ac_low, self._ac_scale = None, None
+        self.policy_fn = functools.partial(policy, ob_shape, self.env.action_space,  norm_observations=self.norm_obs, dist=dist)
+        self.qf_fn = functools.partial(qf, ob_shape, self.env.action_space)
+        self.pi  = self.policy_fn()
+        # observations are added to the normalization stats as they are stored.
+        self.ob_stats = ObStatsAccumulator(self.pi.running_norm, ob_stats_period) if self.norm_obs else None
+        qf = self.qf_fn()
+        self.ensemble = isinstance(qf, EnsembleQFunction)
+        if self.ensemble:
+            self.qf = qf
+            self.qf1, self.qf2 = None, None
+        else:
+            self.qf = None
+            self.qf1, self.qf2 = qf, self.qf_fn()
+        self.qf_subset_size = qf_subset_size
+        if vf is None:
+            assert reparameterization_trick, "SAC without a value function requires the reparameterization trick."
+            self.vf_fn = None
+            self.vf, self.target_vf = None, None
+            self.target_qfs = [self.qf_fn() for _ in self._qfs()]
+        else:
+            self.vf_fn = functools.partial(vf, ob_shape)
+            self.vf = self.vf_fn()
+            self.target_vf = self.vf_fn()
+            self.target_qfs = []
 
         self.device = torch.device("cuda:0" if gpu and torch.cuda.is_available() else "cpu")
         self.pi.to(self.device)
-        self.qf1.to(self.device)
-        self.qf2.to(self.device)
-        self.vf.to(self.device)
-        self.target_vf.to(self.device)
-
-        self.opt_pi = optimizer(self.pi.parameters(), lr=policy_lr)
-        self.opt_qf1 = optimizer(self.qf1.parameters(), lr=qf_lr)
-        self.opt_qf2 = optimizer(self.qf2.parameters(), lr=qf_lr)
-        self.opt_vf = optimizer(self.vf.parameters(), lr=vf_lr)
+        for net in self._qfs() + self._targets()[0]:
+            net.to(self.device)
+        if self.vf is not None:
+            self.vf.to(self.device)
+
+        self.optimizer_fn = optimizer
+        self.policy_lr = policy_lr
+        self.qf_lr = qf_lr
+        self.vf_lr = vf_lr
+        self.foreach = foreach
+        self.opt = self._make_optimizer(self.pi, self._qfs(), self.vf)
         self.policy_mean_reg_weight = policy_mean_reg_weight
         self.policy_std_reg_weight = policy_std_reg_weight
 
-        self.target_vf.load_state_dict(self.vf.state_dict())
+        self._sync_targets()
 
         self.automatic_entropy_tuning = automatic_entropy_tuning
         if self.automatic_entropy_tuning:
@@ -118,26 +190,127 @@ class SAC(Trainer):
         self.vf_criterion = torch.nn.MSELoss()
 
         self.t, self.t_start = 0,0
-        self.losses = {'pi':[], 'vf':[], 'qf1':[], 'qf2':[], 'alpha':[]}
-
-        self._ob = torch.from_numpy(self.env.reset()).to(self.device)
+        self.nupdates = 0
+        self.nqf = self.qf.ensemble_size if self.ensemble else 2
+        self.losses = MetricsAccumulator()
+        self._logp = None
+
+        # When actor_thread is True, the environment is stepped in a separate
+        # thread using a copy of self.pi which is synced every
+        # actor_sync_period updates.
+        self.actor_thread = actor_thread
+        self.actor_sync_period = actor_sync_period
+        self.max_actor_lag = max_actor_lag
+        self.actor = None
+        self.buffer_lock = RWLock()
+        self.act_lock = threading.Lock()
+        if actor_thread:
+            self.act_pi = self.policy_fn()
+            self.act_pi.to(self.device)
+            self.act_pi.load_state_dict(self.pi.state_dict())
+        else:
+            self.act_pi = self.pi
 
         self._reset()
 
+    def _make_env(self, env_fn, nenv):
+        def _env(rank):
+            def _thunk():
+                return env_fn(rank=rank)
+            return _thunk
+        if nenv > 1:
+            env = SubprocVecEnv([_env(i) for i in range(nenv)])
+        else:
+            env = DummyVecEnv([_env(0)])
+        tstart = max(self.ckptr.ckpts()) if len(self.ckptr.ckpts()) > 0 else 0
+        return VecMonitor(env, max_history=100, tstart=tstart, tbX=True)
+
+    def _period_crossings(self, period, last_t=None):
+        """
+        Returns the number of multiples of period passed since last_t.
+        By default, last_t is the timestep before the last call to act,
+        which advances self.t by nenv timesteps.
+        """
+        if last_t is None:
+            last_t = self.t - self.nenv
+        return self.t // period - last_t // period
+
+    def _make_optimizer(self, pi, qfs, vf):
+        groups = [
+            {'params': list(pi.parameters()), 'lr': self.policy_lr},
+            {'params': [p for qf in qfs for p in qf.parameters()], 'lr': self.qf_lr},
+        ]
+        if vf is not None:
+            groups.append({'params': list(vf.parameters()), 'lr': self.vf_lr})
+        kwargs = {} if self.foreach is None else {'foreach': self.foreach}
+        return self.optimizer_fn(groups, lr=self.policy_lr, **kwargs)
+
+    def _qfs(self):
+        return [self.qf] if self.ensemble else [self.qf1, self.qf2]
+
+    def _targets(self):
+        """
+        Returns the target networks and the networks they track.
+        """
+        if self.vf is None:
+            return self.target_qfs, self._qfs()
+        return [self.target_vf], [self.vf]
+
+    def _sync_targets(self):
+        for target, net in zip(*self._targets()):
+            target.load_state_dict(net.state_dict())
+
+    def _update_targets(self):
+        with self.timer('target_update'):
+            soft_target_update(*self._targets(), self.target_smoothing_coef)
+
+    def _qvalues(self, ob, ac, qfs=None, detach=False):
+        """
+        Returns the values of all Q-functions (or of qfs) stacked along the
+        first dimension. If detach is True, no gradients flow to their parameters.
+        """
+        qfs = self._qfs() if qfs is None else qfs
+        if detach:
+            qfs = [FunctionalModule(qf, dict(qf.named_parameters())).detach() for qf in qfs]
+        if self.ensemble:
+            return qfs[0](ob, ac).value
+        return torch.stack([qf(ob, ac).value for qf in qfs])
+
+    def _min_q(self, qs):
+        """
+        Returns the minimum of qf_subset_size randomly chosen values in qs.
+        """
+        if qs.shape[0] > self.qf_subset_size:
+            qs = qs[torch.randperm(qs.shape[0], device=qs.device)[:self.qf_subset_size]]
+        return qs.min(dim=0)[0]
+
+    def _sample(self, ob):
+        """
+        Returns the policy outputs, a sampled action and its log probability.
+        """
+        pi_out = self.pi(ob, reparameterization_trick=self.rsample)
+        if self.discrete:
+            return pi_out, pi_out.action, pi_out.logp
+        if self.rsample:
+            ac, pth_ac = pi_out.dist.rsample(return_pretanh_value=True)
+        else:
+            ac, pth_ac = pi_out.dist.sample(return_pretanh_value=True)
+        return pi_out, ac, pi_out.dist.log_prob(ac, pth_ac)
+
     def _reset(self):
         self.buffer.env_reset()
         self._ob = self.env.reset()
 
     def state_dict(self):
+        if self.ensemble:
+            qf_state = {'qf': self.qf.state_dict()}
+        else:
+            qf_state = {'qf1': self.qf1.state_dict(), 'qf2': self.qf2.state_dict()}
         return {
             'pi': self.pi.state_dict(),
-            'qf1': self.qf1.state_dict(),
-            'qf2': self.qf2.state_dict(),
-            'vf': self.vf.state_dict(),
-            'opt_pi': self.opt_pi.state_dict(),
-            'opt_qf1': self.opt_qf1.state_dict(),
-            'opt_qf2': self.opt_qf2.state_dict(),
-            'opt_vf': self.opt_vf.state_dict(),
+            **qf_state,
+            'vf': self.vf.state_dict() if self.vf is not None else None,
+            'opt': self.opt.state_dict(),
             'log_alpha': self.log_alpha if self.automatic_entropy_tuning else None,
             'opt_alpha': self.opt_alpha.state_dict() if self.automatic_entropy_tuning else None,
             't':   self.t,
@@ -146,87 +319,79 @@ class SAC(Trainer):
 
     def load_state_dict(self, state_dict):
         self.pi.load_state_dict(state_dict['pi'])
-        self.qf1.load_state_dict(state_dict['qf1'])
-        self.qf2.load_state_dict(state_dict['qf2'])
-        self.vf.load_state_dict(state_dict['vf'])
-        self.target_vf.load_state_dict(state_dict['vf'])
-
-        self.opt_pi.load_state_dict(state_dict['opt_pi'])
-        self.opt_qf1.load_state_dict(state_dict['opt_qf1'])
-        self.opt_qf2.load_state_dict(state_dict['opt_qf2'])
-        self.opt_vf.load_state_dict(state_dict['opt_vf'])
+        if self.vf is not None:
+            self.vf.load_state_dict(state_dict['vf'])
+        if self.ensemble:
+            self.qf.load_state_dict(state_dict['qf'])
+        else:
+            self.qf1.load_state_dict(state_dict['qf1'])
+            self.qf2.load_state_dict(state_dict['qf2'])
+        self._sync_targets()
+        self.opt.load_state_dict(state_dict['opt'])
 
         if state_dict['log_alpha']:
             with torch.no_grad():
                 self.log_alpha.copy_(state_dict['log_alpha'])
-        self.opt_vf.load_state_dict(state_dict['opt_vf'])
+            self.opt_alpha.load_state_dict(state_dict['opt_alpha'])
 
         self.buffer.load_state_dict(state_dict['buffer'])
         self.t = state_dict['t']
         self._reset()
 
     def save(self):
-        state = self.state_dict()
-        # save buffer seperately and only once (because it is huge)
-        buffer_state_dict = state['buffer']
-        state_without_buffer = dict(state)
-        del state_without_buffer['buffer']
-        self.ckptr.save(state_without_buffer, self.t)
-        np.savez(os.path.join(self.ckptr.ckptdir, 'buffer.npz'), **buffer_state_dict)
+        # block the actor thread (if any) so that the buffer and t are consistent.
+        with self.buffer_lock.read():
+            state = self.state_dict()
+            # save buffer seperately and only once (because it is huge)
+            buffer_state_dict = state['buffer']
+            state_without_buffer = dict(state)
+            del state_without_buffer['buffer']
+            self.ckptr.save(state_without_buffer, state['t'], arrays={'buffer': buffer_state_dict})
 
     def load(self, t=None):
         state = self.ckptr.load(t)
-        state['buffer'] = np.load(os.path.join(self.ckptr.ckptdir, 'buffer.npz'))
+        state['buffer'] = self.ckptr.load_arrays('buffer')
         self.load_state_dict(state)
+        self.act_pi.load_state_dict(self.pi.state_dict())
         self.t_start = self.t
 
     def act(self):
-        idx = self.buffer.store_frame(self._ob)
-        x = self.buffer.encode_recent_observation()
-        with torch.no_grad():
+        """
+        Take one step in each environment. Returns the number of steps taken.
+        """
+        with self.buffer_lock.write():
+            idx = self.buffer.store_frames(self._ob)
+            x = self.buffer.encode_recent_observations()
+            if self.norm_obs:
+                self.ob_stats.add(x)
+        with torch.no_grad(), self.act_lock, self.timer('act'):
             x = torch.from_numpy(x).to(self.device)
-            ac = self.pi(x[None]).action.cpu().numpy()[0]
-        self._ob, r, done, _ = self.env.step(self._unnorm_action(ac))
-        self.buffer.store_effect(idx, ac, r, done)
-        if done:
-            self._ob = self.env.reset()
-        self.t += 1
-        if self.norm_obs and self.t % 128 == 0:
-            idx = self.buffer.next_idx
-            if idx >= 128:
-                obs = self.buffer.obs[idx-128:idx]
-            else:
-                obs = np.concatenate([self.buffer.obs[-(128-idx):], self.buffer.obs[:idx]], 0)
-            batch_mean = torch.from_numpy(np.mean(obs, axis=0)).to(self.device)
-            batch_var  = torch.from_numpy(np.var(obs, axis=0)).to(self.device)
-            self.pi.running_norm.update(batch_mean, batch_var, 128)
+            ac = self.act_pi(x).action.cpu().numpy()
+        with self.timer('env_step'):
+            self._ob, r, done, _ = self.env.step(self._unnorm_action(ac))
+        with self.buffer_lock.write():
+            self.buffer.store_effects(idx, ac, r, done)
+            self.t += self.nenv
+        return self.nenv
 
     def _unnorm_action(self, ac):
-        if self.env.action_space.__class__.__name__ == 'Box':
-            l = self.env.action_space.low
-            h = self.env.action_space.high
-            if l is not None and h is not None:
-                ac = l + 0.5 * (ac + 1) * (h - l)
-        return ac
+        """
+        Maps actions in [-1, 1] to the bounds of the action space.
+        ac can be a single action or a batch of actions.
+        """
+        if self._ac_low is None:
+            return ac
+        return self._ac_low + self._ac_scale * (ac + 1)
 
     def loss(self, batch):
         ob, ac, rew, next_ob, done = [torch.from_numpy(x).to(self.device) for x in batch]
 
-        pi_out = self.pi(ob, reparameterization_trick=self.rsample)
-        if self.discrete:
-            new_ac = pi_out.action
-            logp = pi_out.logp
-        else:
-            if self.rsample:
-                new_ac, new_pth_ac = pi_out.dist.rsample(return_pretanh_value=True)
-            else:
-                new_ac, new_pth_ac = pi_out.dist.sample(return_pretanh_value=True)
-            logp = pi_out.dist.log_prob(new_ac, new_pth_ac)
+        pi_out, new_ac, logp = self._sample(ob)
+        pi_next_ob = next_ob
         if self.norm_obs:
             ob = self.pi.running_norm(ob)
-        q1 = self.qf1(ob, ac).value
-        q2 = self.qf2(ob, ac).value
-        v  = self.vf(ob).value
+            next_ob = self.pi.running_norm(next_ob)
+        qs = self._qvalues(ob, ac)
 
         # alpha loss
         if self.automatic_entropy_tuning:
@@ -234,30 +399,36 @@ class SAC(Trainer):
             self.opt_alpha.zero_grad()
             alpha_loss.backward()
             self.opt_alpha.step()
-            alpha = self.log_alpha.exp()
+            alpha = self.log_alpha.exp().detach()
         else:
             alpha = 1
             alpha_loss = 0
 
         # qf loss
-        vtarg = self.target_vf(next_ob).value
+        if self.vf is None:
+            # soft Bellman backup
+            with torch.no_grad():
+                _, next_ac, next_logp = self._sample(pi_next_ob)
+                next_q = self._min_q(self._qvalues(next_ob, next_ac, qfs=self.target_qfs))
+                vtarg = next_q - alpha * next_logp
+        else:
+            vtarg = self.target_vf(next_ob).value
         qtarg = self.reward_scale * rew + (1.0 - done) * self.gamma * vtarg
-        assert qtarg.shape == q1.shape
-        assert qtarg.shape == q2.shape
-        qf1_loss = self.qf_criterion(q1, qtarg.detach())
-        qf2_loss = self.qf_criterion(q2, qtarg.detach())
+        assert qtarg.shape == qs.shape[1:]
+        qf_losses = torch.stack([self.qf_criterion(q, qtarg.detach()) for q in qs])
 
         # vf loss
-        q1_new = self.qf1(ob, new_ac).value
-        q2_new = self.qf2(ob, new_ac).value
-        q = torch.min(q1_new, q2_new)
-        vtarg = q - alpha * logp
-        assert v.shape == vtarg.shape
-        vf_loss = self.vf_criterion(v, vtarg.detach())
+        q = self._min_q(self._qvalues(ob, new_ac, detach=True))
+        vf_loss = None
+        if self.vf is not None:
+            v = self.vf(ob).value
+            vtarg = q - alpha * logp
+            assert v.shape == vtarg.shape
+            vf_loss = self.vf_criterion(v, vtarg.detach())
 
         # pi loss
         pi_loss = None
-        if self.t % self.policy_update_period == 0:
+        if self.nupdates % self.policy_update_period == 0:
             if self.rsample:
                 assert q.shape == logp.shape
                 pi_loss = (alpha*logp - q).mean()
@@ -270,99 +441,142 @@ class SAC(Trainer):
                 pi_loss += self.policy_mean_reg_weight * (pi_out.dist.normal.mean**2).mean()
                 pi_loss += self.policy_std_reg_weight * (pi_out.logstd**2).mean()
 
-            self.losses['pi'].append(pi_loss.detach().cpu().numpy())
-        self.losses['qf1'].append(qf1_loss.detach().cpu().numpy())
-        self.losses['qf2'].append(qf2_loss.detach().cpu().numpy())
-        self.losses['vf'].append(vf_loss.detach().cpu().numpy())
-        if self.automatic_entropy_tuning:
-            self.losses['alpha'].append(alpha_loss.detach().cpu().numpy())
-        else:
-            self.losses['alpha'].append(alpha_loss)
-        if self.t % self.log_period == 0 and self.t > 0:
-            if self.automatic_entropy_tuning:
-                logger.add_scalar('ent/log_alpha', self.log_alpha.detach().cpu().numpy(), self.t, time.time())
-                scalars = {"target": self.target_entropy, "entropy": -torch.mean(logp.detach()).cpu().numpy().item()}
-                logger.add_scalars('ent/entropy', scalars, self.t, time.time())
-            else:
-                logger.add_scalar('ent/entropy', -torch.mean(logp.detach()).cpu().numpy().item(), self.t, time.time())
-        return pi_loss, qf1_loss, qf2_loss, vf_loss
+            self.losses.add('pi', pi_loss)
+        self.losses.add('qf', qf_losses)
+        if vf_loss is not None:
+            self.losses.add('vf', vf_loss)
+        self.losses.add('alpha', alpha_loss)
+        self._logp = logp.detach()
+        return pi_loss, qf_losses.sum(), vf_loss
 
+    def update(self):
+        with self.buffer_lock.read(), self.timer('sample'):
+            batch = self.buffer.sample(self.batch_size)
+
+        with self.timer('loss'):
+            pi_loss, qf_loss, vf_loss = self.loss(batch)
+
+        # The losses depend on disjoint parameters, so the gradients of their
+        # sum are the gradients of the separate losses. Between policy updates
+        # the policy has no gradients and is skipped by the optimizer.
+        loss = qf_loss
+        if vf_loss is not None:
+            loss = loss + vf_loss
+        if pi_loss is not None:
+            loss = loss + pi_loss
+        self.opt.zero_grad()
+        with self.timer('backward'):
+            loss.backward()
+        with self.timer('optimizer_step'):
+            self.opt.step()
+        self.nupdates += 1
+        if self.actor_thread and self.nupdates % self.actor_sync_period == 0:
+            with self.act_lock:
+                self.act_pi.load_state_dict(self.pi.state_dict())
 
     def step(self):
+        if self.actor_thread:
+            self._learner_step()
+            return
         self.act()
         while self.buffer.num_in_buffer < min(self.learning_starts, self.buffer.size):
             self.act()
-        if self.t % self.target_update_period == 0:
-            soft_target_update(self.target_vf, self.vf, self.target_smoothing_coef)
-
-        if self.t % self.update_period == 0:
-            batch = self.buffer.sample(self.batch_size)
+        for _ in range(self._period_crossings(self.target_update_period)):
+            self._update_targets()
 
-            pi_loss, qf1_loss, qf2_loss, vf_loss = self.loss(batch)
+        # update_period env steps per gradient update, independent of nenv.
+        for _ in range(self._period_crossings(self.update_period)):
+            self.update()
 
-            # update
-            self.opt_qf1.zero_grad()
-            qf1_loss.backward()
-            self.opt_qf1.step()
-
-            self.opt_qf2.zero_grad()
-            qf2_loss.backward()
-            self.opt_qf2.step()
-
-            self.opt_vf.zero_grad()
-            vf_loss.backward()
-            self.opt_vf.step()
-
-            if pi_loss:
-                self.opt_pi.zero_grad()
-                pi_loss.backward()
-                self.opt_pi.step()
+        if self._period_crossings(self.log_period) > 0 and self.t > 0:
+            self.log()
 
-        if self.t % self.log_period == 0 and self.t > 0:
+    def _start_actor(self):
+        learning_starts = max(0, min(self.learning_starts, self.buffer.size) - self.buffer.num_in_buffer)
+        self.controller = ReplayRatioController(1. / self.update_period, learning_starts, self.max_actor_lag)
+        self.actor = ActorThread(self.act, self.controller)
+        self._last_t = self.t
+        self.actor.start()
+
+    def _learner_step(self):
+        """
+        Performs one update while the actor thread steps the environment.
+        Returns early if the replay ratio does not allow an update yet so that
+        Trainer.train can check for termination.
+        """
+        if self.actor is None:
+            self._start_actor()
+        self.actor.check()
+        if not self.controller.wait_to_update(timeout=0.1):
+            return
+        t, last_t = self.t, self._last_t
+        self._last_t = t
+        for _ in range(self._period_crossings(self.target_update_period, last_t)):
+            self._update_targets()
+        self.update()
+        self.controller.add_update()
+        if self._period_crossings(self.log_period, last_t) > 0:
             self.log()
 
 
     def log(self):
         logger.log("========================|  Timestep: {}  |========================".format(self.t))
-        for k,v in self.losses.items():
-            logger.logkv(f'Loss - {k}', np.mean(v))
-            logger.add_scalar(f'loss/{k}', np.mean(v), self.t, time.time())
-            self.losses[k] = []
+        for k,v in self.losses.means().items():
+            # the losses of all Q-functions are accumulated as one vector.
+            names = [f'qf{i+1}' for i in range(self.nqf)] if k == 'qf' else [k]
+            for name, loss in zip(names, np.reshape(v, -1)):
+                logger.logkv(f'Loss - {name}', loss)
+                logger.add_scalar(f'loss/{name}', loss, self.t, time.time())
+        if self._logp is not None:
+            entropy = -torch.mean(self._logp).cpu().numpy().item()
+            if self.automatic_entropy_tuning:
+                logger.add_scalar('ent/log_alpha', self.log_alpha.detach().cpu().numpy(), self.t, time.time())
+                scalars = {"target": self.target_entropy, "entropy": entropy}
+                logger.add_scalars('ent/entropy', scalars, self.t, time.time())
+            else:
+                logger.add_scalar('ent/entropy', entropy, self.t, time.time())
         # Logging stats...
         logger.logkv('timesteps', self.t)
         logger.logkv('fps', int((self.t - self.t_start) / (time.monotonic() - self.time_start)))
         logger.logkv('time_elapsed', time.monotonic() - self.time_start)
-
-        monitor = find_monitor(self.env)
-        if monitor is not None:
-            logger.logkv('mean episode length', np.mean(monitor.episode_lengths[-100:]))
-            logger.logkv('mean episode reward', np.mean(monitor.episode_rewards[-100:]))
+        if self.actor is not None:
+            for k,v in self.controller.stats().items():
+                logger.logkv(k, v)
+                logger.add_scalar(f'alg/{k}', v, self.t, time.time())
+
+        logger.logkv('mean episode length', np.mean(self.env.episode_lengths))
+        logger.logkv('mean episode reward', np.mean(self.env.episode_rewards))
+        nets = [self.pi, self.act_pi, self.vf] + self._qfs() + self._targets()[0]
+        memory.log_memory(self.t, buffer=self.buffer, nets=nets, opt=[self.opt, self.opt_alpha])
+        self.timer.log(self.t)
         logger.dumpkvs()
 
 
 
     def evaluate(self):
         self.pi.train(False)
-        eval_env = self.env_fn(rank=1)
-        if self.frame_stack > 1:
-            eval_env = FrameStack(eval_env, self.frame_stack)
+        eval_env_fn = _eval_env_fn(self.env_fn, self.frame_stack)
 
         os.makedirs(os.path.join(self.logdir, 'eval'), exist_ok=True)
         outfile = os.path.join(self.logdir, 'eval', self.ckptr.format.format(self.t) + '.json')
-        stats = rl_evaluate(eval_env, self.pi, self.eval_nepisodes, outfile, self.device)
+        stats = rl_evaluate(eval_env_fn, self.pi, self.eval_nepisodes, outfile, self.device, nenv=self.eval_nenv, rank=self.nenv)
         logger.add_scalar('eval/mean_episode_reward', stats['mean_reward'], self.t, time.time())
         logger.add_scalar('eval/mean_episode_length', stats['mean_length'], self.t, time.time())
 
         os.makedirs(os.path.join(self.logdir, 'video'), exist_ok=True)
         outfile = os.path.join(self.logdir, 'video', self.ckptr.format.format(self.t) + '.mp4')
+        eval_env = eval_env_fn(rank=self.nenv)
         rl_record(eval_env, self.pi, 5, outfile, self.device)
 
-        if find_monitor(self.env):
-            rl_plot(os.path.join(self.logdir, 'logs'), self.env.spec.id, self.t)
+        if find_monitor(eval_env):
+            rl_plot(os.path.join(self.logdir, 'logs'), eval_env.spec.id, self.t)
         self.pi.train(True)
 
 
     def close(self):
+        if self.actor is not None:
+            self.actor.stop()
+            self.actor = None
         if hasattr(self.env, 'close'):
             self.env.close()
         logger.reset()
@@ -382,6 +596,89 @@ class TestSAC(unittest.TestCase):
         assert sac.buffer.num_in_buffer == 500
         shutil.rmtree('logs')
 
+    def test_vec_sac(self):
+        sac = SAC('logs', nenv=4, learning_starts=300, eval_nepisodes=1, buffer_size=500, maxt=1000, eval=False, reparameterization_trick=False)
+        sac.train()
+        assert sac.buffer.num_in_buffer == 500
+        assert sac.nupdates > 0
+        shutil.rmtree('logs')
+
+    def test_ensemble_sac(self):
+        qf = functools.partial(EnsembleQFunction, ensemble_size=3)
+        sac = SAC('logs', qf=qf, qf_subset_size=2, learning_starts=300, buffer_size=500, maxt=1000, eval=False, reparameterization_trick=False)
+        assert sac.ensemble and sac.nqf == 3
+        sac.train()
+        assert sac.nupdates > 0
+        state = sac.state_dict()
+        assert 'qf' in state and 'qf1' not in state
+        shutil.rmtree('logs')
+
+    def test_sac_without_vf(self):
+        sac = SAC('logs', vf=None, learning_starts=300, buffer_size=500, policy_update_period=2, maxt=1000, eval=False)
+        assert sac.vf is None and len(sac.target_qfs) == 2
+        sac.train()
+        assert sac.nupdates > 0
+        assert 'vf' not in sac.losses
+        sac = SAC('logs', vf=None, learning_starts=300, buffer_size=500, maxt=1500, eval=False)
+        sac.train() # loads checkpoint
+        for tqf, qf in zip(sac.target_qfs, [sac.qf1, sac.qf2]):
+            assert not torch.allclose(tqf.qvals.weight, qf.qvals.weight)
+        shutil.rmtree('logs')
+
+    def test_ob_stats(self):
+        sac = SAC('logs', nenv=2, normalize_observations=True, ob_stats_period=64, learning_starts=300, buffer_size=500, maxt=1000, eval=False)
+        sac.train()
+        assert sac.pi.running_norm.count + sac.ob_stats.count == sac.t
+        shutil.rmtree('logs')
+
+    def test_fused_update(self):
+        sac = SAC('logs', optimizer=torch.optim.Adam, learning_starts=300, buffer_size=500, maxt=1000, eval=False, automatic_entropy_tuning=False)
+        while sac.buffer.num_in_buffer < 300:
+            sac.act()
+        batch = sac.buffer.sample(32)
+        sac.buffer.sample = lambda batch_size: batch
+        nets = [sac.pi, sac.qf1, sac.qf2, sac.vf]
+        init = [{k: v.clone() for k, v in net.state_dict().items()} for net in nets]
+        torch.manual_seed(0)
+        sac.update()
+        fused = [[p.detach().clone() for p in net.parameters()] for net in nets]
+
+        # the same step with separate losses and optimizers.
+        for net, state in zip(nets, init):
+            net.load_state_dict(state)
+        sac.nupdates = 0
+        params = [[p for p in m.parameters() if p.requires_grad] for m in [sac.pi, sac.qf1, sac.vf]]
+        params[1] += [p for p in sac.qf2.parameters() if p.requires_grad]
+        opts = [torch.optim.Adam(ps, lr=lr) for ps, lr in zip(params, [sac.policy_lr, sac.qf_lr, sac.vf_lr])]
+        torch.manual_seed(0)
+        losses = sac.loss(batch)
+        for opt, ps, loss in zip(opts, params, losses):
+            opt.zero_grad()
+            grads = torch.autograd.grad(loss, ps, retain_graph=True, allow_unused=True)
+            for p, g in zip(ps, grads):
+                p.grad = g
+        for opt in opts:
+            opt.step()
+        for net, ps in zip(nets, fused):
+            for p, f in zip(net.parameters(), ps):
+                assert torch.allclose(p, f, atol=1e-6)
+
+        expected = [(1 - 0.1) * tp + 0.1 * p for tp, p in zip(sac.target_vf.parameters(), sac.vf.parameters())]
+        soft_target_update(sac.target_vf, sac.vf, 0.1)
+        for tp, e in zip(sac.target_vf.parameters(), expected):
+            assert torch.allclose(tp, e, atol=1e-6)
+        sac.close()
+        shutil.rmtree('logs')
+
+    def test_actor_thread(self):
+        sac = SAC('logs', nenv=2, learning_starts=300, buffer_size=500, actor_thread=True, actor_sync_period=10, max_actor_lag=10, maxt=1000, eval=False, reparameterization_trick=False)
+        sac.train()
+        c = sac.controller
+        assert c.updates > 0
+        assert c.updates <= (c.steps - 300) / sac.update_period
+        assert c.steps <= 300 + c.updates * sac.update_period + 10 + sac.nenv
+        shutil.rmtree('logs')
+
 
 if __name__=='__main__':
     load_gin_configs(['../configs/sac.gin'])
@@ -4,32 +4,91 @@ from imageio import imwrite
 import shutil
 import subprocess as sp
 from dl.util import find_monitor, logger
+from gym import Wrapper
+from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
+from baselines.common.vec_env.dummy_vec_env import DummyVecEnv
 import torch
 from dl.eval.rl_plot import plot_results
 import matplotlib.pyplot as plt
 
 
-def rl_evaluate(env, actor, nepisodes, outfile, device='cpu'):
-    ep_lengths = []
-    ep_rewards = []
-    monitor = find_monitor(env)
-    for i in range(nepisodes):
-        ob = env.reset()
-        done = False
-        ep_lengths.append(0)
-        ep_rewards.append(0)
-        while not done:
-            ob = torch.from_numpy(ob).to(device)[None]
-            action = actor(ob).action.cpu().numpy()[0]
-            ob, r, done, _ = env.step(action)
-            if monitor is None:
-                ep_lengths[-1] += 1
-                ep_rewards[-1] += r
-            else:
-                done = monitor.needs_reset
-                if done:
-                    ep_lengths[-1] = monitor.episode_lengths[-1]
-                    ep_rewards[-1] = monitor.episode_rewards[-1]
+class _EvalEpisodes(Wrapper):
+    """
+    Sets info['eval_episode'] = (reward, length) at the end of each episode.
+    Episodes are those of the Monitor of env if it has one (e.g. games rather
+    than lives), otherwise they end at done.
+    """
+    def __init__(self, env):
+        super().__init__(env)
+        self.monitor = find_monitor(env)
+        self.eprew = 0.
+        self.eplen = 0
+
+    def step(self, action):
+        ob, r, done, info = self.env.step(action)
+        self.eprew += r
+        self.eplen += 1
+        if self.monitor is not None:
+            if self.monitor.needs_reset:
+                info['eval_episode'] = (self.monitor.episode_rewards[-1], self.monitor.episode_lengths[-1])
+        elif done:
+            info['eval_episode'] = (self.eprew, self.eplen)
+        if done:
+            self.eprew = 0.
+            self.eplen = 0
+        return ob, r, done, info
+
+
+def _eval_env_thunk(env_fn, rank):
+    def _thunk():
+        return _EvalEpisodes(env_fn(rank=rank))
+    return _thunk
+
+
+def rl_evaluate(env, actor, nepisodes, outfile, device='cpu', nenv=1, rank=0):
+    """
+    Runs nepisodes episodes with actor and saves their rewards and lengths to
+    outfile (json). Episodes are run in several environments at once with
+    one batched forward pass per step. Each environment runs a fixed share
+    of the episodes, so that the result is not biased toward short episodes.
+    Args:
+        env:
+            A gym env, a VecEnv of envs wrapped with a Monitor (episodes end
+            when the Monitor sets info['episode']), or a function env_fn such
+            that env_fn(rank=r) makes an env.
+        nenv (int):
+            With env_fn, the number of environments, with ranks rank, ...,
+            rank + nenv - 1, which are stepped in subprocesses if nenv > 1.
+    """
+    if hasattr(env, 'num_envs'):
+        venv = env
+    elif hasattr(env, 'step'):
+        venv = DummyVecEnv([lambda: _EvalEpisodes(env)])
+    elif nenv > 1:
+        venv = SubprocVecEnv([_eval_env_thunk(env, rank + i) for i in range(nenv)])
+    else:
+        venv = DummyVecEnv([_eval_env_thunk(env, rank)])
+    n = venv.num_envs
+    targets = [nepisodes // n + int(i < nepisodes % n) for i in range(n)]
+    episodes = [[] for _ in range(n)]
+
+    ob = venv.reset()
+    while any(len(episodes[i]) < targets[i] for i in range(n)):
+        ob = torch.from_numpy(ob).to(device)
+        action = actor(ob).action.cpu().numpy()
+        ob, _, _, infos = venv.step(action)
+        for i, info in enumerate(infos):
+            if len(episodes[i]) >= targets[i]:
+                continue
+            if 'eval_episode' in info:
+                episodes[i].append(info['eval_episode'])
+            elif 'episode' in info:
+                episodes[i].append((info['episode']['r'], info['episode']['l']))
+    if venv is not env and not hasattr(env, 'step'):
+        # close the environments made with env_fn.
+        venv.close()
+    ep_rewards = [float(r) for eps in episodes for r, _ in eps]
+    ep_lengths = [int(l) for eps in episodes for _, l in eps]
 
     outs = {
         'episode_lengths': ep_lengths,
@@ -81,3 +140,52 @@ def rl_plot(logdir, title, t):
         plt.savefig(os.path.join(logdir, 'plot_time.pdf'))
     except:
         pass
+
+
+
+import unittest
+
+class TestRLEvaluate(unittest.TestCase):
+    def test(self):
+        import gym
+        from dl.util import Monitor
+
+        class CountEnv(gym.Env):
+            # episodes of length n with a reward of 1 per step.
+            spec = None
+            observation_space = gym.spaces.Box(-1, 1, (1,), dtype=np.float32)
+            action_space = gym.spaces.Discrete(2)
+            def __init__(self, n):
+                self.n = n
+            def reset(self):
+                self.t = 0
+                return np.zeros(1, dtype=np.float32)
+            def step(self, action):
+                self.t += 1
+                return np.zeros(1, dtype=np.float32), 1., self.t >= self.n, {}
+
+        class Actor(object):
+            def __call__(self, ob):
+                self.batch_size = ob.shape[0]
+                return type('Out', (), {'action': torch.zeros(ob.shape[0], dtype=torch.long)})
+
+        outfile = os.path.join(tempfile.mkdtemp(), 'eval.json')
+        actor = Actor()
+        outs = rl_evaluate(CountEnv(3), actor, 5, outfile)
+        assert outs['episode_lengths'] == [3] * 5 and outs['mean_reward'] == 3.
+        with open(outfile, 'r') as f:
+            assert json.load(f) == outs
+
+        # every env runs the same number of episodes, so short episodes are not favored.
+        venv = DummyVecEnv([lambda n=n: Monitor(CountEnv(n), None) for n in [1, 5]])
+        outs = rl_evaluate(venv, actor, 4, outfile)
+        assert actor.batch_size == 2
+        assert outs['episode_lengths'] == [1, 1, 5, 5] and outs['mean_length'] == 3.
+
+        outs = rl_evaluate(lambda rank: CountEnv(rank), actor, 3, outfile, nenv=1, rank=2)
+        assert outs['episode_rewards'] == [2., 2., 2.]
+        shutil.rmtree(os.path.dirname(outfile))
+
+
+if __name__ == '__main__':
+    unittest.main()
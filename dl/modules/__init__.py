@@ -1,4 +1,5 @@
 from dl.modules.core import *
 from dl.modules.distributions import *
-from dl.modules.running_ob_norm import RunningObNorm
+from dl.modules.running_ob_norm import RunningObNorm, ObStatsAccumulator
 from dl.modules.rl_modules import *
+from dl.modules.population import Population, FunctionalModule
@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import gin
+import gin, math
 
 
 @gin.configurable
@@ -79,6 +79,31 @@ class Conv2dNet(nn.Module):
         return x
 
 
+class EnsembleLinear(nn.Module):
+    def __init__(self, ensemble_size, in_features, out_features):
+        """
+        ensemble_size independent linear layers evaluated in one batched matmul.
+        Inputs have shape (ensemble_size, batch, in_features), or
+        (batch, in_features) to feed the same input to every layer.
+        Outputs have shape (ensemble_size, batch, out_features).
+        """
+        super().__init__()
+        self.ensemble_size = ensemble_size
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(torch.empty(ensemble_size, in_features, out_features))
+        self.bias = nn.Parameter(torch.empty(ensemble_size, 1, out_features))
+        # same initialization as nn.Linear
+        bound = 1. / math.sqrt(in_features)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        if x.dim() == 2:
+            x = x.expand(self.ensemble_size, *x.shape)
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
 import unittest, os
 from dl.util import load_gin_configs
 
@@ -125,5 +150,16 @@ class TestCore(unittest.TestCase):
         assert net.ff.fc2.out_features == 1
         os.remove('./test.gin')
 
+    def test_ensemble_linear(self):
+        layer = EnsembleLinear(3, 4, 2)
+        x = torch.randn(3, 5, 4)
+        out = layer(x)
+        assert out.shape == (3, 5, 2)
+        for i in range(3):
+            assert torch.allclose(out[i], x[i] @ layer.weight[i] + layer.bias[i], atol=1e-6)
+        out = layer(x[0])
+        for i in range(3):
+            assert torch.allclose(out[i], x[0] @ layer.weight[i] + layer.bias[i], atol=1e-6)
+
 if __name__=='__main__':
     unittest.main()
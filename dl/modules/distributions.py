@@ -80,7 +80,9 @@ class TanhNormal(D.Distribution):
         """
         Sampling in the reparameterization case.
         """
-        z = self.normal.rsample(sample_shape)
+        # same as self.normal.rsample, but also works under torch.func.vmap.
+        loc = self.normal.loc.expand(self.normal._extended_shape(sample_shape))
+        z = loc + torch.randn_like(loc) * self.normal.scale
         if return_pretanh_value:
             return torch.tanh(z), z
         else:
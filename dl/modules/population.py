@@ -0,0 +1,113 @@
+"""
+Evaluate a population of independent networks in one batched call.
+"""
+from dl.modules.running_ob_norm import RunningObNorm
+from torch.func import functional_call, vmap
+import itertools
+import torch
+import torch.nn as nn
+
+
+class FunctionalModule(object):
+    """
+    Calls module with the parameters and buffers in tensors instead of its own.
+    Submodules are accessed as attributes, e.g. FunctionalModule(m, tensors).pi(x).
+    """
+    def __init__(self, module, tensors):
+        self.module = module
+        self.tensors = tensors
+
+    def __call__(self, *args, **kwargs):
+        return functional_call(self.module, self.tensors, args, kwargs)
+
+    def __getattr__(self, name):
+        prefix = name + '.'
+        tensors = {k[len(prefix):]: v for k,v in self.tensors.items() if k.startswith(prefix)}
+        return FunctionalModule(getattr(self.module, name), tensors)
+
+    def detach(self):
+        """
+        Returns a copy through which no gradients flow to the parameters.
+        """
+        return FunctionalModule(self.module, {k: v.detach() for k,v in self.tensors.items()})
+
+
+class Population(nn.Module):
+    """
+    Holds N independent copies (members) of a module and evaluates all of them
+    in one batched call with torch.func.vmap. Members are ordinary modules, so
+    each one can have its own optimizer and be saved or loaded on its own.
+    Modules with state that is not a parameter or buffer (RunningObNorm) are
+    not supported.
+    """
+    def __init__(self, members):
+        super().__init__()
+        for m in members[0].modules():
+            assert not isinstance(m, RunningObNorm), "Population does not support observation normalization."
+        self.members = nn.ModuleList(members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __getitem__(self, i):
+        return self.members[i]
+
+    def stack(self):
+        """
+        Returns the parameters and buffers of all members stacked along a new
+        first dimension. Gradients flow back to the members.
+        """
+        states = [dict(itertools.chain(m.named_parameters(), m.named_buffers())) for m in self.members]
+        return {k: torch.stack([s[k] for s in states]) for k in states[0]}
+
+    def vmap(self, fn, *args, randomness='different'):
+        """
+        Returns fn(member, *args) for all members, stacked along the first
+        dimension. member is a FunctionalModule for one member, and args are
+        split along their first dimension, which must equal len(self).
+        fn must return tensors or (nested) tuples or dicts of tensors.
+        """
+        # functional_call only swaps in the stacked tensors for the duration
+        # of the call, so any member can serve as the architecture.
+        base = self.members[0]
+        def _call(tensors, *args):
+            return fn(FunctionalModule(base, tensors), *args)
+        return vmap(_call, randomness=randomness)(self.stack(), *args)
+
+
+
+import unittest
+from dl.modules import Policy, QFunction
+from gym.spaces import Box, Discrete
+
+class TestPopulation(unittest.TestCase):
+    def test_policy(self):
+        for ac_space in [Discrete(3), Box(-1, 1, (2,))]:
+            pop = Population([Policy((4,), ac_space) for _ in range(3)])
+            x = torch.randn(3, 5, 4)
+            action, value, ent = pop.vmap(lambda net, x: (lambda o: (o.action, o.value, o.dist.entropy()))(net(x)), x)
+            assert action.shape[:2] == (3, 5)
+            assert value.shape == (3, 5)
+            for i in range(3):
+                outs = pop[i](x[i])
+                assert torch.allclose(value[i], outs.value, atol=1e-5)
+                assert torch.allclose(ent[i], outs.dist.entropy(), atol=1e-5)
+
+            # gradients reach every member
+            value.sum().backward()
+            for m in pop.members:
+                assert all(p.grad is not None for p in m.vf.parameters())
+
+    def test_submodules(self):
+        ac_space = Box(-1, 1, (2,))
+        members = [nn.ModuleDict({'q': QFunction((4,), ac_space)}) for _ in range(2)]
+        pop = Population(members)
+        x, a = torch.randn(2, 5, 4), torch.randn(2, 5, 2)
+        q = pop.vmap(lambda net, x, a: net.q.detach()(x, a).value, x, a)
+        assert q.shape == (2, 5)
+        assert not q.requires_grad
+        assert torch.allclose(q[1], members[1]['q'](x[1], a[1]).value, atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
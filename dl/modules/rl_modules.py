@@ -164,6 +164,54 @@ class QFunction(nn.Module):
             return self.outputs(action=action, value=value, max_a=None, max_q=None, qvals=None)
 
 
+@gin.configurable(blacklist=['obs_shape', 'action_space'])
+class EnsembleQFunction(nn.Module):
+    def __init__(self, obs_shape, action_space, ensemble_size=2, units=[256,256], activation_fn=F.relu):
+        """
+        An ensemble of ensemble_size MLP Q-functions whose layers are stacked
+        (see EnsembleLinear), so that all Q-values are computed in one batched
+        pass. Observations must be one dimensional.
+        The interface is the same as QFunction, with an additional leading
+        dimension of size ensemble_size on all outputs.
+        """
+        super().__init__()
+        assert len(obs_shape) == 1, "EnsembleQFunction requires one dimensional observations."
+        self.action_space = action_space
+        self.discrete = action_space.__class__.__name__ == 'Discrete'
+        self.ensemble_size = ensemble_size
+        self.activation_fn = activation_fn
+        ni = obs_shape[0] if self.discrete else obs_shape[0] + action_space.shape[0]
+        layers = []
+        for no in units:
+            layers.append(EnsembleLinear(ensemble_size, ni, no))
+            ni = no
+        self.layers = nn.ModuleList(layers)
+        self.qvals = EnsembleLinear(ensemble_size, ni, action_space.n if self.discrete else 1)
+        for i in range(ensemble_size):
+            nn.init.orthogonal_(self.qvals.weight.data[i], gain=1.0)
+        nn.init.constant_(self.qvals.bias.data, 0)
+
+        self.outputs = namedtuple('Outputs', ['action', 'value', 'max_a', 'max_q', 'qvals'])
+
+    def forward(self, x, action=None):
+        if self.discrete:
+            x = x.float()
+        else:
+            assert action is not None, "You must provide an action for a continuous action space"
+            x = torch.cat([x.float(), action.float()], -1)
+        for layer in self.layers:
+            x = self.activation_fn(layer(x))
+        qvals = self.qvals(x)
+        if not self.discrete:
+            return self.outputs(action=action, value=qvals.squeeze(-1), max_a=None, max_q=None, qvals=None)
+        maxq, maxa = qvals.max(dim=-1)
+        if action is None:
+            return self.outputs(action=maxa, value=maxq, max_a=maxa, max_q=maxq, qvals=qvals)
+        inds = action.long().view(1, -1, 1).expand(self.ensemble_size, -1, 1)
+        value = qvals.gather(2, inds).squeeze(2)
+        return self.outputs(action=action, value=value, max_a=maxa, max_q=maxq, qvals=qvals)
+
+
 
 
 
@@ -402,6 +450,24 @@ class TestRLModules(unittest.TestCase):
             ob, r, done, _ = env.step(outs.action[0])
 
 
+    def testEnsembleQFunction(self):
+        env = gym.make('MountainCarContinuous-v0')
+        net = EnsembleQFunction(env.observation_space.shape, env.action_space, ensemble_size=3, units=[32,32])
+        ob = torch.from_numpy(np.stack([env.observation_space.sample() for _ in range(5)])).float()
+        ac = torch.from_numpy(np.stack([env.action_space.sample() for _ in range(5)])).float()
+        outs = net(ob, ac)
+        assert outs.value.shape == (3, 5)
+        assert not torch.allclose(outs.value[0], outs.value[1])
+
+        env = atari_env('Pong')
+        net = EnsembleQFunction((4,), env.action_space, ensemble_size=3, units=[32])
+        ob = torch.randn(5, 4)
+        outs = net(ob)
+        assert outs.qvals.shape == (3, 5, env.action_space.n)
+        assert outs.max_q.shape == (3, 5)
+        ac = torch.zeros(5).long()
+        assert torch.allclose(net(ob, ac).value, outs.qvals[:, :, 0])
+
     def testPolicy(self):
         env = atari_env('Pong')
         net = Policy(env.observation_space.shape, env.action_space, norm_observations=True)
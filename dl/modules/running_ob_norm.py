@@ -3,6 +3,7 @@ https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algor
 """
 import torch
 import torch.nn as nn
+import numpy as np
 
 
 
@@ -33,6 +34,69 @@ class RunningObNorm(nn.Module):
         self.std = torch.sqrt(self.var)
 
 
+class ObStatsAccumulator(object):
+    """
+    Accumulates the mean and variance of observations as they are inserted,
+    merging each batch with Chan's parallel update, and updates a
+    RunningObNorm with them every update_period observations. If
+    update_period is None, the stats are only applied when flush is called.
+    Moments are accumulated in float64, with numpy for np.ndarrays (which is
+    much cheaper for small batches) and on the device of torch.Tensors.
+    """
+    def __init__(self, norm, update_period=None):
+        self.norm = norm
+        self.update_period = update_period
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def add(self, obs):
+        """
+        Adds a batch of observations (torch.Tensor or np.ndarray) to the stats.
+        """
+        obs = obs.astype(np.float64) if isinstance(obs, np.ndarray) else obs.double()
+        n = obs.shape[0]
+        batch_mean = obs.mean(0)
+        batch_m2 = ((obs - batch_mean) ** 2).sum(0)
+        if self.count == 0:
+            self.mean, self.m2 = batch_mean, batch_m2
+        else:
+            delta = batch_mean - self.mean
+            count = self.count + n
+            self.mean = self.mean + delta * (n / count)
+            self.m2 = self.m2 + batch_m2 + delta ** 2 * (self.count * n / count)
+        self.count += n
+        if self.update_period is not None and self.count >= self.update_period:
+            self.flush()
+
+    def moments(self):
+        """
+        Returns the mean, (biased) variance and count of the observations
+        added since the last flush.
+        """
+        return self.mean, self.m2 / self.count, self.count
+
+    def flush(self, reduce=None):
+        """
+        Updates the normalizer with the accumulated stats and resets them.
+        reduce, e.g. distributed.all_reduce_moments, is applied to the
+        moments first.
+        """
+        if self.count > 0:
+            device = self.norm.mean.device
+            mean, var, count = self.moments()
+            mean = torch.as_tensor(mean).to(device, torch.float)
+            var = torch.as_tensor(var).to(device, torch.float)
+            if reduce is not None:
+                mean, var, count = reduce(mean, var, count)
+            with torch.no_grad():
+                self.norm.update(mean, var, count)
+        self.reset()
+
+
 import unittest
 
 class TestRON(unittest.TestCase):
@@ -65,6 +129,26 @@ class TestRON(unittest.TestCase):
 
         assert len(ron.state_dict()) == 3
 
+    def test_accumulator(self):
+        ron = RunningObNorm([3])
+        acc = ObStatsAccumulator(ron, update_period=10)
+        obs = np.random.randn(40, 3).astype(np.float32) * 3 + 1
+        for i in range(0, 40, 4):
+            acc.add(obs[i:i+4])
+        # flushed after 12, 24 and 36 observations.
+        assert ron.count == 36
+        assert acc.count == 4
+        acc.flush()
+        assert ron.count == 40
+        assert np.allclose(ron.mean.numpy(), obs.mean(0), atol=1e-4)
+        assert np.allclose(ron.var.numpy(), obs.var(0), atol=1e-4)
+
+        acc = ObStatsAccumulator(ron)
+        acc.add(torch.from_numpy(obs))
+        mean, var, count = acc.moments()
+        assert count == 40
+        assert np.allclose(var.numpy(), obs.var(0), atol=1e-4)
+
 
 if __name__=='__main__':
     unittest.main()
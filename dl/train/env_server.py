@@ -0,0 +1,19 @@
+from dl.util import load_gin_configs, EnvServer, atari_env, make_env
+import dl.algorithms # registers configurables so that trainer configs can be used
+import argparse
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Serve environments to a remote trainer.')
+    parser.add_argument('port', type=int, help='port to listen on')
+    parser.add_argument('ranks', type=int, nargs='+', help='ranks of the hosted environments')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address to bind to, e.g. 0.0.0.0 to accept remote trainers (clients are not authenticated)')
+    parser.add_argument('-e', '--env', type=str, default='atari_env', choices=['atari_env', 'make_env'], help='env function')
+    parser.add_argument('-c', '--gin_config', type=str, help='gin config')
+    parser.add_argument('-b', '--gin_bindings', nargs='+', help='gin bindings to overwrite config')
+    args = parser.parse_args()
+    if args.gin_config is not None:
+        load_gin_configs([args.gin_config], args.gin_bindings)
+
+    env_fn = atari_env if args.env == 'atari_env' else make_env
+    EnvServer(env_fn, args.ranks, args.port, args.host).serve()
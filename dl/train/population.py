@@ -0,0 +1,23 @@
+from dl.util import load_gin_configs
+from dl.algorithms import PopulationPPO, PopulationSAC
+import argparse, os
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Train a population of PPO or SAC agents in one process.')
+    parser.add_argument('logdir', type=str, help='logdir')
+    parser.add_argument('-a', '--algorithm', type=str, default='ppo', choices=['ppo', 'sac'], help='algorithm')
+    parser.add_argument('-n', '--population_size', type=int, default=4, help='number of independent agents')
+    parser.add_argument('-c', '--gin_config', type=str, help='gin config')
+    parser.add_argument('-b', '--gin_bindings', nargs='+', help='gin bindings to overwrite config')
+    args = parser.parse_args()
+    if args.gin_config is None:
+        config = os.path.dirname(os.path.dirname(__file__)) + f'/configs/{args.algorithm}.gin'
+    else:
+        config = args.gin_config
+    load_gin_configs([config], args.gin_bindings or [])
+
+    if args.algorithm == 'ppo':
+        trainer = PopulationPPO(args.logdir, population_size=args.population_size)
+    else:
+        trainer = PopulationSAC(args.logdir, population_size=args.population_size)
+    trainer.train()
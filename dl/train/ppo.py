@@ -1,18 +1,33 @@
-from dl.util import load_gin_configs
+from dl.util import load_gin_configs, distributed
 from dl.algorithms import PPO
+import torch.multiprocessing as mp
 import argparse, os
 
+
+def train(rank, world_size, port, logdir, config, gin_bindings):
+    if world_size > 1:
+        distributed.init_process_group(rank, world_size, master_port=port)
+    load_gin_configs([config], gin_bindings)
+    ppo = PPO(logdir)
+    ppo.train()
+    if world_size > 1:
+        distributed.dist.destroy_process_group()
+
+
 if __name__=='__main__':
     parser = argparse.ArgumentParser(description='Train PPO.')
     parser.add_argument('logdir', type=str, help='logdir')
     parser.add_argument('-c', '--gin_config', type=str, help='gin config')
     parser.add_argument('-b', '--gin_bindings', nargs='+', help='gin bindings to overwrite config')
+    parser.add_argument('-n', '--nprocs', type=int, default=1, help='number of data parallel learners')
+    parser.add_argument('-p', '--port', type=int, default=29500, help='port used to initialize torch.distributed')
     args = parser.parse_args()
     if args.gin_config is None:
         config = os.path.dirname(os.path.dirname(__file__)) + '/configs/ppo.gin'
     else:
         config = args.gin_config
-    load_gin_configs([config], args.gin_bindings)
 
-    ppo = PPO(args.logdir)
-    ppo.train()
+    if args.nprocs > 1:
+        mp.spawn(train, args=(args.nprocs, args.port, args.logdir, config, args.gin_bindings), nprocs=args.nprocs)
+    else:
+        train(0, 1, args.port, args.logdir, config, args.gin_bindings)
@@ -0,0 +1,33 @@
+from dl.util import sweep
+import argparse, os, json
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Run a hyperparameter sweep over gin bindings.')
+    parser.add_argument('logdir', type=str, help='logdir of the sweep, each run is trained in logdir/<run name>')
+    parser.add_argument('-a', '--algorithm', type=str, required=True, help='trainer class in dl.algorithms, e.g. PPO')
+    parser.add_argument('-c', '--gin_config', type=str, required=True, help='gin config')
+    parser.add_argument('-s', '--space', nargs='+', required=True,
+                        help="search space, e.g. 'PPO.ent_coef=[0.01, 0.001]' or 'optim.Adam.lr=loguniform(1e-5, 1e-3)'")
+    parser.add_argument('-r', '--random', type=int, default=None, help='number of random samples (default: grid search)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for random search')
+    parser.add_argument('-n', '--nprocs', type=int, default=None, help='number of concurrent runs (default: cores // cores_per_run)')
+    parser.add_argument('--cores_per_run', type=int, default=1, help='number of cores each run is pinned to')
+    parser.add_argument('--nthreads', type=int, default=None, help='torch threads per run (default: cores_per_run)')
+    args = parser.parse_args()
+
+    space = sweep.parse_space(args.space)
+    if args.random:
+        params = sweep.random_search(space, args.random, args.seed)
+    else:
+        params = sweep.grid(space)
+    runs = {sweep.run_name(p): p for p in params}
+    nprocs = args.nprocs or max(1, len(os.sched_getaffinity(0)) // args.cores_per_run)
+    config = os.path.abspath(args.gin_config)
+
+    failed = sweep.run_sweep(args.algorithm, config, runs, args.logdir, nprocs, args.cores_per_run, args.nthreads)
+    rows = sweep.summarize(args.logdir, list(runs.keys()))
+    with open(os.path.join(args.logdir, 'summary.json'), 'w') as f:
+        json.dump(rows, f, indent=2)
+    print(sweep.format_table(rows))
+    if failed:
+        print('Failed runs: ' + ', '.join(failed))
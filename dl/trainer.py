@@ -1,5 +1,7 @@
 import gin, os, time
-from dl.util import Checkpointer, logger
+from dl.util import Checkpointer, PhaseTimer, logger
+from dl.util.ckptr import wait_for_writes
+from dl.util import distributed
 
 @gin.configurable(blacklist=['logdir'])
 class Trainer(object):
@@ -21,8 +23,17 @@ class Trainer(object):
             The maximum number of timesteps to train the model.
         maxseconds (float):
             The maximum amount of time to train the model.
+        time_phases (bool):
+            Whether or not to time the phases of training with self.timer.
+            Subclasses log the timings with self.timer.log.
+        profiler (callable):
+            Creates a dl.util.Profiler given a log directory, e.g. @Profiler.
+            Calls to step are profiled in the windows it schedules and the
+            profiles are saved in logdir/profiles.
+    When torch.distributed is initialized, only rank 0 logs, saves, and
+    evaluates the model, and all ranks stop training at the same step.
     """
-    def __init__(self, logdir, eval=False, eval_period=None, save_period=None, maxt=None, maxseconds=None):
+    def __init__(self, logdir, eval=False, eval_period=None, save_period=None, maxt=None, maxseconds=None, time_phases=True, profiler=None):
         self.logdir = logdir
         self.ckptr = Checkpointer(os.path.join(self.logdir, 'ckpts'))
         self.eval = eval
@@ -30,7 +41,19 @@ class Trainer(object):
         self.save_period = save_period
         self.maxt = maxt
         self.maxseconds = maxseconds
-        logger.configure(logdir, ['stdout', 'log'], tbX=True)
+        self.timer = PhaseTimer(enabled=time_phases)
+        self.rank = distributed.get_rank()
+        self.world_size = distributed.get_world_size()
+        self.profiler = None
+        if profiler is not None:
+            profdir = os.path.join(self.logdir, 'profiles')
+            if self.world_size > 1:
+                profdir = os.path.join(profdir, f'rank{self.rank}')
+            self.profiler = profiler(profdir)
+        if self.rank == 0:
+            logger.configure(logdir, ['stdout', 'log'], tbX=True)
+        else:
+            logger.configure(logdir, [], tbX=False)
 
         self.t = 0
 
@@ -56,8 +79,9 @@ class Trainer(object):
         config = gin.operative_config_str()
         logger.log("=================== CONFIG ===================")
         logger.log(config)
-        with open(os.path.join(self.logdir, 'config.gin'), 'w') as f:
-            f.write(config)
+        if self.rank == 0:
+            with open(os.path.join(self.logdir, 'config.gin'), 'w') as f:
+                f.write(config)
         self.time_start = time.monotonic()
         if len(self.ckptr.ckpts()) > 0:
             self.load()
@@ -68,26 +92,62 @@ class Trainer(object):
         if self.eval_period:
             last_eval = (self.t // self.eval_period) * self.eval_period
 
+        first_step = True
         try:
             while True:
-                if self.maxt and self.t >= self.maxt:
-                    break
-                if self.maxseconds and time.monotonic() - self.time_start >= self.maxseconds:
+                done = bool(self.maxt and self.t >= self.maxt)
+                done |= bool(self.maxseconds and time.monotonic() - self.time_start >= self.maxseconds)
+                if distributed.all_reduce_any(done):
                     break
+                if self.profiler is not None:
+                    self.profiler.before_step(self.t)
                 self.step()
+                if self.profiler is not None:
+                    self.profiler.after_step(self.t)
+                if first_step:
+                    # includes loading the checkpoint when resuming.
+                    first_step = False
+                    elapsed = time.monotonic() - self.time_start
+                    logger.log(f"Time to first step: {elapsed:.2f} seconds.")
+                    if self.rank == 0:
+                        logger.add_scalar('alg/time_to_first_step', elapsed, self.t, time.time())
                 if self.save_period and (self.t - last_save) >= self.save_period:
-                    self.save()
+                    if self.rank == 0:
+                        self._checkpoint()
                     last_save = self.t
                 if self.eval and (self.t - last_eval) >= self.eval_period:
-                    self.evaluate()
+                    if self.rank == 0:
+                        with self.timer('evaluate'):
+                            self.evaluate()
                     last_eval = self.t
         except KeyboardInterrupt:
             logger.log("Caught Ctrl-C. Saving model and exiting...")
-        if self.t not in self.ckptr.ckpts():
-            self.save()
-        logger.export_scalars(self.ckptr.format.format(self.t) + '.json')
+        self.stop()
+        if self.profiler is not None:
+            self.profiler.close(self.t)
+        if self.rank == 0:
+            wait_for_writes()
+            if self.t not in self.ckptr.ckpts():
+                self.save()
+            wait_for_writes()
+            logger.export_scalars(self.ckptr.format.format(self.t) + '.json')
         self.close()
 
+    def _checkpoint(self):
+        # with asynchronous checkpoints, training is only blocked while state
+        # is snapshotted (and while waiting for the previous write).
+        start = time.monotonic()
+        with self.timer('checkpoint'):
+            self.save()
+        logger.add_scalar('alg/checkpoint_blocked_seconds', time.monotonic() - start, self.t, time.time())
+
+    def stop(self):
+        """
+        Called when training ends, before the final checkpoint. Subclasses
+        stop background workers here so that their results are saved.
+        """
+        pass
+
     def close(self):
         pass
 
@@ -112,6 +172,8 @@ class TestTrainer(unittest.TestCase):
 
         trainer = T('logs', eval=True, eval_period=50, save_period=100, maxt=1000)
         trainer.train()
+        assert trainer.timer.counts['checkpoint'] == 10
+        assert trainer.timer.counts['evaluate'] == 20
         shutil.rmtree('logs')
         trainer = T('logs', eval=True, eval_period=50, save_period=100, maxseconds=2)
         trainer.train()
@@ -5,3 +5,15 @@ from dl.util.monitor import *
 from dl.util.misc import *
 from dl.util.envs import *
 from dl.util.rollout import RolloutStorage
+from dl.util.metrics import MetricsAccumulator
+from dl.util.scalar_log import ScalarLog
+from dl.util.timer import PhaseTimer
+from dl.util.profiler import Profiler
+from dl.util.actor_thread import ActorThread, ReplayRatioController, RWLock
+from dl.util.shared_weights import SharedWeights
+from dl.util import distributed
+from dl.util import memory
+from dl.util.remote_env import RemoteVecEnv, EnvServer
+from dl.util.policy_workers import PolicyWorkers
+from dl.util.inference_server import InferenceServer, InferenceClient
+from dl.util import sweep
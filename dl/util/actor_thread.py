@@ -0,0 +1,192 @@
+"""
+Run an actor, which steps the environment, in a thread separate from the learner.
+"""
+import threading, time
+from contextlib import contextmanager
+
+
+class RWLock(object):
+    """
+    Readers-writer lock. Any number of readers may hold the lock at the same
+    time, writers have exclusive access. Waiting writers are given priority
+    over new readers so that inserts are not starved by sampling.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting > 0:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers > 0:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class ReplayRatioController(object):
+    """
+    Keeps the number of gradient updates per environment step of a concurrent
+    actor and learner close to a target ratio.
+    Args:
+        ratio (float):
+            The target number of gradient updates per environment step.
+        learning_starts (int):
+            The number of environment steps to take before updates are allowed.
+        max_lag (int):
+            The number of environment steps the actor is allowed to run ahead
+            of the learner before it is blocked.
+    """
+    def __init__(self, ratio, learning_starts=0, max_lag=1000):
+        self.ratio = ratio
+        self.learning_starts = learning_starts
+        self.max_lag = max_lag
+        self.steps = 0
+        self.updates = 0
+        self._cond = threading.Condition()
+        self._last = (time.monotonic(), 0, 0)
+
+    def _can_act(self):
+        return self.steps < self.learning_starts + self.updates / self.ratio + self.max_lag
+
+    def _can_update(self):
+        return self.updates + 1 <= (self.steps - self.learning_starts) * self.ratio
+
+    def wait_to_act(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(self._can_act, timeout)
+
+    def wait_to_update(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(self._can_update, timeout)
+
+    def add_steps(self, n):
+        with self._cond:
+            self.steps += n
+            self._cond.notify_all()
+
+    def add_update(self):
+        with self._cond:
+            self.updates += 1
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        Returns env steps per second and updates per second since the last call,
+        and the realized replay ratio since learning started.
+        """
+        with self._cond:
+            steps, updates = self.steps, self.updates
+        now = time.monotonic()
+        t, last_steps, last_updates = self._last
+        self._last = (now, steps, updates)
+        return {
+            'actor_fps': (steps - last_steps) / (now - t),
+            'learner_ups': (updates - last_updates) / (now - t),
+            'replay_ratio': updates / max(steps - self.learning_starts, 1),
+        }
+
+
+class ActorThread(threading.Thread):
+    """
+    Repeatedly calls act_fn, which steps the environment and returns the number
+    of environment steps taken, while respecting the replay ratio enforced by
+    controller. Exceptions raised by act_fn are re-raised in the learner by check.
+    """
+    def __init__(self, act_fn, controller):
+        super().__init__(daemon=True)
+        self.act_fn = act_fn
+        self.controller = controller
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                if self.controller.wait_to_act(timeout=0.1):
+                    self.controller.add_steps(self.act_fn())
+        except Exception as e:
+            self.error = e
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("Exception in actor thread.") from self.error
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.check()
+
+
+
+import unittest
+
+class TestActorThread(unittest.TestCase):
+    def test_ratio(self):
+        controller = ReplayRatioController(0.25, learning_starts=100, max_lag=8)
+        actor = ActorThread(lambda: 1, controller)
+        actor.start()
+        for _ in range(200):
+            assert controller.wait_to_update(timeout=5)
+            controller.add_update()
+        actor.stop()
+        assert controller.updates == 200
+        assert 100 + 200 * 4 <= controller.steps <= 100 + 200 * 4 + 8 + 1
+        stats = controller.stats()
+        assert abs(stats['replay_ratio'] - 0.25) < 0.01
+
+    def test_error(self):
+        def act():
+            raise ValueError()
+        actor = ActorThread(act, ReplayRatioController(1.))
+        actor.start()
+        actor.join()
+        try:
+            actor.check()
+            assert False
+        except RuntimeError:
+            pass
+
+    def test_rwlock(self):
+        lock = RWLock()
+        with lock.read():
+            with lock.read():
+                pass
+        events = []
+        def write():
+            with lock.write():
+                events.append('write')
+        with lock.read():
+            thread = threading.Thread(target=write)
+            thread.start()
+            time.sleep(0.05)
+            events.append('read')
+        thread.join()
+        assert events == ['read', 'write']
+
+
+if __name__ == '__main__':
+    unittest.main()
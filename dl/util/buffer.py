@@ -2,6 +2,7 @@
     This file is apdated from https://github.com/berkeleydeeprlcourse/homework/tree/master/hw3
     Minor edits were made to allow for easier subclassing and changing the type of data stored.
 """
+from dl.util.memory import check_available
 import numpy as np
 import random
 
@@ -17,7 +18,7 @@ def sample_n_unique(sampling_f, n):
     return res
 
 class ReplayBuffer(object):
-    def __init__(self, size, frame_history_len):
+    def __init__(self, size, frame_history_len, nenv=1):
         """This is a memory efficient implementation of the replay buffer.
         The sepecific memory optimizations use here are:
             - only store each frame once rather than k times
@@ -38,15 +39,23 @@ class ReplayBuffer(object):
             overflows the old memories are dropped.
         frame_history_len: int
             Number of memories to be retried for each observation.
+        nenv: int
+            Number of environments stepped in lockstep. Frames from each
+            step of all environments are stored together in one row, so the
+            frame following index idx of an environment is at idx + nenv.
         """
+        assert size % nenv == 0, "size must be a multiple of nenv."
         self.size = size
         self.frame_history_len = frame_history_len
+        self.nenv = nenv
 
         self.next_idx      = 0
         self.num_in_buffer = 0
 
         self.obs      = None
         self.action   = None
+        self.reward   = None
+        self.done     = None
 
     def _init_obs_data(self, frame):
         dtype = np.float32 if frame.dtype == np.float64 else frame.dtype
@@ -56,16 +65,23 @@ class ReplayBuffer(object):
         self.action   = np.empty([self.size] + list(action_shape), dtype=action_dtype)
         self.reward   = np.empty([self.size],                      dtype=np.float32)
         self.done     = np.empty([self.size],                      dtype=np.bool)
+        # np.empty only takes memory as the buffer fills up. Fail now if the
+        # full buffer will not fit.
+        check_available(self.nbytes(), 'ReplayBuffer', owner=self)
+
+    def nbytes(self):
+        """Returns the number of bytes used by the buffer when it is full."""
+        return sum(x.nbytes for x in [self.obs, self.action, self.reward, self.done] if x is not None)
 
     def can_sample(self, batch_size):
         """Returns true if `batch_size` different transitions can be sampled from the buffer."""
-        return batch_size + 1 <= self.num_in_buffer
+        return batch_size + self.nenv <= self.num_in_buffer
 
     def _encode_sample(self, idxes):
         obs_batch      = np.concatenate([self._encode_observation(idx)[np.newaxis, :] for idx in idxes], 0)
         act_batch      = self.action[idxes]
         rew_batch      = self.reward[idxes]
-        next_obs_batch = np.concatenate([self._encode_observation(idx + 1)[np.newaxis, :] for idx in idxes], 0)
+        next_obs_batch = np.concatenate([self._encode_observation((idx + self.nenv) % self.size)[np.newaxis, :] for idx in idxes], 0)
         done_mask      = np.array([1.0 if self.done[idx] else 0.0 for idx in idxes], dtype=np.float32)
 
         return obs_batch, act_batch, rew_batch, next_obs_batch, done_mask
@@ -101,7 +117,7 @@ class ReplayBuffer(object):
             Array of shape (batch_size,) and dtype np.float32
         """
         assert self.can_sample(batch_size)
-        idxes = sample_n_unique(lambda: random.randint(0, self.num_in_buffer - 2), batch_size)
+        idxes = sample_n_unique(lambda: random.randint(0, self.num_in_buffer - 1 - self.nenv), batch_size)
         return self._encode_sample(idxes)
 
     def encode_recent_observation(self):
@@ -113,30 +129,43 @@ class ReplayBuffer(object):
             and dtype np.uint8, where observation[:, :, i*img_c:(i+1)*img_c]
             encodes frame at time `t - frame_history_len + i`
         """
+        assert self.nenv == 1, "Use encode_recent_observations when nenv > 1."
         assert self.num_in_buffer > 0
         return self._encode_observation((self.next_idx - 1) % self.size)
 
+    def encode_recent_observations(self):
+        """Return the most recent `frame_history_len` frames of each environment.
+        Returns
+        -------
+        observations: np.array
+            Array of shape (nenv, img_c * frame_history_len, img_h, img_w)
+        """
+        assert self.num_in_buffer > 0
+        start = (self.next_idx - self.nenv) % self.size
+        return np.stack([self._encode_observation(start + i) for i in range(self.nenv)], 0)
+
     def _encode_observation(self, idx):
-        end_idx   = idx + 1 # make noninclusive
-        start_idx = end_idx - self.frame_history_len
+        n = self.nenv
+        end_idx   = idx + n # make noninclusive
+        start_idx = end_idx - self.frame_history_len * n
         # if there weren't enough frames ever in the buffer for context
         if start_idx < 0 and self.num_in_buffer != self.size:
-            start_idx = 0
-        for idx in range(start_idx, end_idx - 1):
+            start_idx = idx % n
+        for idx in range(start_idx, end_idx - n, n):
             if self.done[idx % self.size]:
-                start_idx = idx + 1
-        missing_context = self.frame_history_len - (end_idx - start_idx)
+                start_idx = idx + n
+        missing_context = self.frame_history_len - (end_idx - start_idx) // n
         # if zero padding is needed for missing context
         # or we are on the boundry of the buffer
         if start_idx < 0 or missing_context > 0:
             frames = [np.zeros_like(self.obs[0]) for _ in range(missing_context)]
-            for idx in range(start_idx, end_idx):
+            for idx in range(start_idx, end_idx, n):
                 frames.append(self.obs[idx % self.size])
             return np.concatenate(frames, 0)
         else:
             # this optimization has potential to saves about 30% compute time \o/
             s = self.obs.shape[2:]
-            return self.obs[start_idx:end_idx].reshape(-1, *s)
+            return self.obs[start_idx:end_idx:n].reshape(-1, *s)
 
     def store_frame(self, frame):
         """Store a single frame in the buffer at the next available index, overwriting
@@ -150,6 +179,7 @@ class ReplayBuffer(object):
         idx: int
             Index at which the frame is stored. To be used for `store_effect` later.
         """
+        assert self.nenv == 1, "Use store_frames when nenv > 1."
         if self.obs is None:
             self._init_obs_data(frame)
 
@@ -161,6 +191,30 @@ class ReplayBuffer(object):
 
         return ret
 
+    def store_frames(self, frames):
+        """Store one frame for each environment in a single row of the buffer.
+        Parameters
+        ----------
+        frames: np.array
+            Array of shape (nenv, img_c, img_h, img_w)
+        Returns
+        -------
+        idx: int
+            Index at which the frame of the first environment is stored.
+            The frame of environment i is stored at idx + i.
+        """
+        assert frames.shape[0] == self.nenv
+        if self.obs is None:
+            self._init_obs_data(frames[0])
+
+        self.obs[self.next_idx:self.next_idx + self.nenv] = frames
+
+        ret = self.next_idx
+        self.next_idx = (self.next_idx + self.nenv) % self.size
+        self.num_in_buffer = min(self.size, self.num_in_buffer + self.nenv)
+
+        return ret
+
     def store_effect(self, idx, action, reward, done):
         """Store effects of action taken after obeserving frame stored
         at index idx. The reason `store_frame` and `store_effect` is broken
@@ -183,13 +237,53 @@ class ReplayBuffer(object):
         self.reward[idx] = reward
         self.done[idx]   = done
 
+    def store_effects(self, idx, actions, rewards, dones):
+        """Store the effects of the actions taken in each environment after
+        observing the frames stored at index idx (returned by `store_frames`).
+        actions, rewards and dones have a leading dimension of size nenv.
+        """
+        if self.action is None:
+            self._init_replay_data(actions.shape[1:], actions.dtype)
+        self.action[idx:idx + self.nenv] = actions
+        self.reward[idx:idx + self.nenv] = rewards
+        self.done[idx:idx + self.nenv]   = dones
+
+    def store_sequence(self, frames, actions, rewards, dones):
+        """Store a sequence of consecutive frames and effects from one
+        environment at the next available indices.
+        Parameters
+        ----------
+        frames: np.array
+            Array of shape (n, img_c, img_h, img_w)
+        actions, rewards, dones: np.array
+            Arrays with a leading dimension of size n.
+        Returns
+        -------
+        idxes: np.array
+            Indices at which the sequence is stored.
+        """
+        assert self.nenv == 1, "Sequences can only be stored when nenv == 1."
+        if self.obs is None:
+            self._init_obs_data(frames[0])
+        if self.action is None:
+            self._init_replay_data(actions.shape[1:], actions.dtype)
+        idxes = (self.next_idx + np.arange(len(frames))) % self.size
+        self.obs[idxes]    = frames
+        self.action[idxes] = actions
+        self.reward[idxes] = rewards
+        self.done[idxes]   = dones
+        self.next_idx = (self.next_idx + len(frames)) % self.size
+        self.num_in_buffer = min(self.size, self.num_in_buffer + len(frames))
+        return idxes
+
     def env_reset(self):
         """
         Allow environment resets for the most recent transition after it has
         been stored. This is useful when loading a saved replay buffer.
         """
         if self.num_in_buffer > 0:
-            self.done[(self.next_idx-1) % self.size] = True
+            start = (self.next_idx - self.nenv) % self.size
+            self.done[start:start + self.nenv] = True
 
     def state_dict(self):
         return {
@@ -199,9 +293,12 @@ class ReplayBuffer(object):
             'done': self.done,
             'num_in_buffer': self.num_in_buffer,
             'next_idx': self.next_idx,
+            'nenv': self.nenv,
         }
 
     def load_state_dict(self, state_dict):
+        if 'nenv' in state_dict:
+            assert state_dict['nenv'] == self.nenv, "Buffer was saved with a different number of environments."
         self.obs = state_dict['obs']
         self.action = state_dict['action']
         self.reward = state_dict['reward']
@@ -278,7 +375,76 @@ class TestBuffer(unittest.TestCase):
         for i,x in enumerate(s1):
             assert np.allclose(x, s2[i])
 
+    def test_memory(self):
+        buffer = ReplayBuffer(10, 4)
+        buffer.store_frame(np.zeros((3, 8, 8), dtype=np.uint8))
+        buffer.store_effect(0, np.zeros(2, dtype=np.float32), 0., False)
+        assert buffer.nbytes() == 10 * (3*8*8 + 2*4 + 4 + 1)
+        # a buffer which does not fit in memory fails on the first transition.
+        buffer = ReplayBuffer(2**34, 4)
+        with self.assertRaises(MemoryError):
+            buffer.store_frame(np.zeros((3, 8, 8), dtype=np.uint8))
+            buffer.store_effect(0, np.zeros(2, dtype=np.float32), 0., False)
+
+    def test_vec(self):
+        nenv = 3
+        buffer = ReplayBuffer(30, 4, nenv=nenv)
+        buffers = [ReplayBuffer(10, 4) for _ in range(nenv)]
+        for t in range(25):
+            obs = np.random.randint(0, 255, size=(nenv,1,8,8), dtype=np.uint8)
+            acs = np.random.randint(0, 4, size=(nenv,))
+            rews = np.random.rand(nenv).astype(np.float32)
+            dones = np.random.rand(nenv) < 0.2
+            idx = buffer.store_frames(obs)
+            x = buffer.encode_recent_observations()
+            assert x.shape == (nenv,4,8,8)
+            for i,b in enumerate(buffers):
+                idx_i = b.store_frame(obs[i])
+                assert np.allclose(x[i], b.encode_recent_observation())
+                b.store_effect(idx_i, acs[i], rews[i], dones[i])
+            buffer.store_effects(idx, acs, rews, dones)
+
+        # Check that each env matches a single env buffer.
+        for j in range(9):
+            s = buffer._encode_sample([j * nenv + i for i in range(nenv)])
+            for i,b in enumerate(buffers):
+                si = b._encode_sample([j])
+                for x, xi in zip(s, si):
+                    assert np.allclose(x[i], xi[0])
+
+        s = buffer.sample(5)
+        assert s[0].shape == (5,4,8,8)
+        assert s[3].shape == (5,4,8,8)
 
+        buffer.env_reset()
+        assert np.all(buffer.done[buffer.next_idx - nenv:buffer.next_idx])
+        buffer2 = ReplayBuffer(30, 4, nenv=nenv)
+        buffer2.load_state_dict(buffer.state_dict())
+        s1 = buffer._encode_sample([1,3,5])
+        s2 = buffer2._encode_sample([1,3,5])
+        for i,x in enumerate(s1):
+            assert np.allclose(x, s2[i])
+
+    def test_sequence(self):
+        buffer = ReplayBuffer(10, 2)
+        buffer2 = ReplayBuffer(10, 2)
+        frames = np.random.randint(0, 255, size=(13,1,8,8), dtype=np.uint8)
+        acs = np.random.randint(0, 4, size=(13,))
+        rews = np.random.rand(13).astype(np.float32)
+        dones = np.random.rand(13) < 0.2
+        for i in range(13):
+            idx = buffer.store_frame(frames[i])
+            buffer.store_effect(idx, acs[i], rews[i], dones[i])
+        idxes = buffer2.store_sequence(frames[:6], acs[:6], rews[:6], dones[:6])
+        assert np.all(idxes == np.arange(6))
+        idxes = buffer2.store_sequence(frames[6:], acs[6:], rews[6:], dones[6:])
+        assert np.all(idxes == np.array([6,7,8,9,0,1,2]))
+        assert buffer2.next_idx == buffer.next_idx
+        assert buffer2.num_in_buffer == buffer.num_in_buffer
+        s1 = buffer._encode_sample([3,4,5,9])
+        s2 = buffer2._encode_sample([3,4,5,9])
+        for i,x in enumerate(s1):
+            assert np.allclose(x, s2[i])
 
 
 
@@ -1,41 +1,251 @@
-import os, glob
+import os, glob, json, signal, traceback, weakref, shutil, mmap
 import numpy as np
 import torch
 import gin
 
 
+def _to_host(x):
+    """
+    Copies device tensors in (nested) dicts, lists and tuples to the host.
+    """
+    if torch.is_tensor(x):
+        return x.cpu() if x.device.type != 'cpu' else x
+    if isinstance(x, dict):
+        return type(x)((k, _to_host(v)) for k, v in x.items())
+    if isinstance(x, (list, tuple)):
+        return type(x)(_to_host(v) for v in x)
+    return x
+
+
+# Checkpointers which may have a write in flight.
+_async_ckptrs = weakref.WeakSet()
+
+def wait_for_writes():
+    """
+    Waits for the writes of all asynchronous Checkpointers to finish.
+    """
+    for ckptr in list(_async_ckptrs):
+        ckptr.wait()
+
+
 @gin.configurable(blacklist=['ckptdir'])
 class Checkpointer():
-    def __init__(self, ckptdir, max_ckpts_to_keep=None, min_ckpt_period=None, format='{:09d}'):
+    """
+    Saves and loads checkpoints in ckptdir. Each checkpoint is a directory
+    <t>.pt with one file per top-level entry of the saved dict and a
+    manifest, so that entries (e.g. only the policy) can be loaded on their
+    own. Checkpoints are written to a temporary path and renamed when
+    complete, so a checkpoint is either fully written or absent. The
+    timesteps of all checkpoints are kept in index.json.
+    Args:
+        ckptdir (str):
+            The directory in which checkpoints are saved.
+        max_ckpts_to_keep (int):
+            The number of recent checkpoints to keep. All are kept if None.
+        min_ckpt_period (int):
+            If set, the first checkpoint of every min_ckpt_period timesteps
+            is kept in addition to the max_ckpts_to_keep latest.
+        format (str):
+            The format of checkpoint file names given the timestep.
+        mmap_arrays (bool):
+            If True, load_arrays memory-maps arrays copy-on-write, so they
+            are read lazily as they are accessed and the files are never
+            modified.
+        prewarm_arrays (bool):
+            If True, load_arrays asks the kernel to read memory-mapped arrays
+            in the background (madvise(MADV_WILLNEED)).
+        async_save (bool):
+            If True, save forks the process and the child writes the
+            checkpoint while training continues. The child sees a copy-on-write
+            snapshot of memory, so state (e.g. replay buffers) does not need to
+            be copied. Only device tensors are copied to the host before
+            forking. One write is in flight at a time. Saving, loading and
+            wait block until the previous write is done.
+    """
+    def __init__(self, ckptdir, max_ckpts_to_keep=None, min_ckpt_period=None, format='{:09d}', mmap_arrays=True, prewarm_arrays=False, async_save=False):
         self.ckptdir = ckptdir
         self.max_ckpts_to_keep = max_ckpts_to_keep
         self.min_ckpt_period = min_ckpt_period
         self.format = format
+        self.mmap_arrays = mmap_arrays
+        self.prewarm_arrays = prewarm_arrays
+        self.async_save = async_save
+        self._pending = None
         os.makedirs(ckptdir, exist_ok=True)
+        self._read_index()
+        if async_save:
+            _async_ckptrs.add(self)
 
     def ckpts(self):
+        # re-read the index if another Checkpointer (or process) replaced it.
+        if self._index_version() != self._version:
+            self._read_index()
+        return list(self._ts)
+
+    def _index_version(self):
+        try:
+            st = os.stat(os.path.join(self.ckptdir, 'index.json'))
+            return (st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            return None
+
+    def _read_index(self):
+        path = os.path.join(self.ckptdir, 'index.json')
         ckpts = glob.glob(os.path.join(self.ckptdir, "*.pt"))
-        return sorted([int(c.split('/')[-1][:-3]) for c in ckpts])
+        ts = sorted([int(c.split('/')[-1][:-3]) for c in ckpts])
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                if json.load(f) == ts:
+                    self._ts = ts
+                    self._version = self._index_version()
+                    return
+        # checkpoints saved without an index, or an index which disagrees with
+        # the checkpoints on disk (e.g. after a crash while pruning).
+        self._ts = ts
+        self._write_index()
+
+    def _write_index(self):
+        path = os.path.join(self.ckptdir, 'index.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self._ts, f)
+        os.replace(path + '.tmp', path)
+        self._version = self._index_version()
 
     def get_ckpt_path(self, t):
         return os.path.join(self.ckptdir, self.format.format(t) + '.pt')
 
-    def save(self, save_dict, t):
+    def save(self, save_dict, t, arrays=None):
+        """
+        Saves save_dict as the checkpoint at timestep t. arrays is an optional
+        dict from name to a dict of np.ndarrays (e.g. a replay buffer) which
+        replace the previous version of name and are loaded with load_arrays.
+        They are written before the checkpoint, so that they are complete
+        when the checkpoint exists.
+        """
+        self.wait()
         ts = self.ckpts()
         max_t = max(ts) if len(ts) > 0 else -1
         assert t > max_t, f"Cannot save a checkpoint at timestep {t} when checkpoints at a later timestep exist."
-        torch.save(save_dict, self.get_ckpt_path(t))
+        if not self.async_save:
+            self._write(save_dict, t, arrays)
+            return
+        save_dict = _to_host(save_dict)
+        pid = os.fork()
+        if pid == 0:
+            # child: write and exit without running any of the parent's cleanup.
+            status = 0
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                self._write(save_dict, t, arrays)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        self._pending = (pid, t)
+
+    def _write(self, save_dict, t, arrays):
+        for name, data in (arrays or {}).items():
+            self._write_arrays(name, data, t)
+        path = self.get_ckpt_path(t)
+        shutil.rmtree(path + '.tmp', ignore_errors=True)
+        os.makedirs(path + '.tmp')
+        manifest = {'t': t, 'entries': {}}
+        for k, v in save_dict.items():
+            fname = f'{k}.pt'
+            torch.save(v, os.path.join(path + '.tmp', fname))
+            manifest['entries'][k] = fname
+        with open(os.path.join(path + '.tmp', 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        os.replace(path + '.tmp', path)
+        # the index always lists the new checkpoint before older ones are removed.
+        self._ts = sorted(self.ckpts() + [t])
+        self._write_index()
         self.prune_ckpts()
+        self._write_index()
+
+    def _write_arrays(self, name, arrays, t):
+        # Each array is saved uncompressed in its own .npy file so that it can
+        # be memory-mapped. Versions are written to new directories and a
+        # symlink is swapped to the new version, so that a complete version
+        # is always available. Arrays mapped from old versions stay valid
+        # after the files are removed.
+        version = name + '.' + self.format.format(t)
+        vdir = os.path.join(self.ckptdir, version)
+        shutil.rmtree(vdir, ignore_errors=True)
+        os.makedirs(vdir)
+        for k, x in arrays.items():
+            np.save(os.path.join(vdir, k + '.npy'), x)
+        link = os.path.join(self.ckptdir, name)
+        os.symlink(version, link + '.tmp')
+        os.replace(link + '.tmp', link)
+        for path in glob.glob(os.path.join(self.ckptdir, name + '.*')):
+            if os.path.isdir(path) and os.path.basename(path) != version:
+                shutil.rmtree(path)
+        if os.path.exists(link + '.npz'):
+            os.remove(link + '.npz')
+
+    def load_arrays(self, name):
+        """
+        Loads the latest arrays saved under name. Arrays are memory-mapped
+        if self.mmap_arrays. Arrays saved with np.savez by earlier versions
+        (<name>.npz) are loaded as well.
+        """
+        self.wait()
+        path = os.path.join(self.ckptdir, name)
+        if not os.path.exists(path):
+            assert os.path.exists(path + '.npz'), f"Can't find arrays {name} in {self.ckptdir}."
+            return dict(np.load(path + '.npz', allow_pickle=True))
+        arrays = {}
+        for fname in os.listdir(path):
+            fname = os.path.join(path, fname)
+            try:
+                x = np.load(fname, mmap_mode='c' if self.mmap_arrays else None)
+            except ValueError:
+                # arrays of python objects can not be memory-mapped.
+                x = np.load(fname, allow_pickle=True)
+            if isinstance(x, np.memmap) and x.ndim == 0:
+                x = np.array(x)
+            if isinstance(x, np.memmap) and self.prewarm_arrays and hasattr(mmap, 'MADV_WILLNEED'):
+                x._mmap.madvise(mmap.MADV_WILLNEED)
+            arrays[os.path.basename(fname)[:-4]] = x
+        return arrays
+
+    def wait(self):
+        """
+        Waits for the write in flight, if any, to finish.
+        """
+        if self._pending is None:
+            return
+        pid, t = self._pending
+        self._pending = None
+        _, status = os.waitpid(pid, 0)
+        assert status == 0, f"Writing the checkpoint at timestep {t} failed."
+        # the child updated the index.
+        self._read_index()
 
-    def load(self, t=None):
+    def load(self, t=None, keys=None):
+        """
+        Loads the checkpoint at timestep t (the latest if None). If keys is
+        given, only those top-level entries are read. Tensors are
+        memory-mapped and read as they are used.
+        """
+        self.wait()
         if t is None:
             t = max(self.ckpts())
         path = self.get_ckpt_path(t)
         assert os.path.exists(path), f"Can't find checkpoint at iteration {t}."
-        if torch.cuda.is_available():
-            return torch.load(path)
-        else:
-            return torch.load(path, map_location='cpu')
+        map_location = None if torch.cuda.is_available() else 'cpu'
+        if os.path.isfile(path):
+            # checkpoints saved as a single file.
+            state = torch.load(path, map_location=map_location)
+            return state if keys is None else {k: state[k] for k in keys}
+        with open(os.path.join(path, 'manifest.json'), 'r') as f:
+            entries = json.load(f)['entries']
+        keys = list(entries.keys()) if keys is None else keys
+        for k in keys:
+            assert k in entries, f"Checkpoint at iteration {t} has no entry {k}."
+        return {k: torch.load(os.path.join(path, entries[k]), map_location=map_location, mmap=True) for k in keys}
 
     def prune_ckpts(self):
         if self.max_ckpts_to_keep is None:
@@ -54,7 +264,12 @@ class Checkpointer():
                     ts_to_remove.append(t)
 
         for t in ts_to_remove:
-            os.remove(self.get_ckpt_path(t))
+            path = self.get_ckpt_path(t)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        self._ts = [t for t in self._ts if t not in set(ts_to_remove)]
 
 
 
@@ -111,6 +326,93 @@ class TestCheckpointer(unittest.TestCase):
         assert ckptr.ckpts() == [97,98,99]
         rmtree('.test_ckpt_dir')
 
+    def test_async(self):
+        ckptr = Checkpointer('./.test_ckpt_dir', max_ckpts_to_keep=3, async_save=True)
+        buffer = np.zeros(1000, dtype=np.float32)
+        for t in range(10):
+            buffer[:] = t
+            ckptr.save({'test': torch.full((2,), t)}, t, arrays={'buffer': {'x': buffer, 'n': t}})
+            # changes made after save returns are not saved.
+            buffer[:] = -1
+        assert ckptr.load()['test'][0] == 9
+        assert ckptr.ckpts() == [7,8,9]
+        arrays = ckptr.load_arrays('buffer')
+        assert np.all(arrays['x'] == 9) and arrays['n'] == 9
+        assert len(glob.glob(os.path.join(ckptr.ckptdir, '*.tmp'))) == 0
+        ckptr.save({'test': 10}, 10)
+        wait_for_writes()
+        assert ckptr.ckpts() == [8,9,10]
+        rmtree('.test_ckpt_dir')
+
+    def test_arrays(self):
+        ckptr = Checkpointer('./.test_ckpt_dir', prewarm_arrays=True)
+        x = np.arange(10)
+        ckptr.save({}, 0, arrays={'buffer': {'x': x, 'n': 3, 'tree': np.array(object())}})
+        arrays = ckptr.load_arrays('buffer')
+        assert isinstance(arrays['x'], np.memmap) and np.array_equal(arrays['x'], x)
+        assert arrays['n'] == 3 and arrays['n'].shape == ()
+        assert isinstance(arrays['tree'][()], object)
+        # memory-mapped arrays are copy-on-write and stay valid after newer versions are saved.
+        arrays['x'][0] = 100
+        ckptr.save({}, 1, arrays={'buffer': {'x': x + 1}})
+        assert arrays['x'][0] == 100 and arrays['x'][1] == 1
+        assert np.array_equal(ckptr.load_arrays('buffer')['x'], x + 1)
+        assert sorted(os.listdir(ckptr.ckptdir)) == ['000000000.pt', '000000001.pt', 'buffer', 'buffer.000000001', 'index.json']
+        rmtree('.test_ckpt_dir')
+
+        # checkpoints saved with np.savez
+        ckptr = Checkpointer('./.test_ckpt_dir')
+        np.savez(os.path.join(ckptr.ckptdir, 'buffer.npz'), x=x)
+        assert np.array_equal(ckptr.load_arrays('buffer')['x'], x)
+        rmtree('.test_ckpt_dir')
+
+    def test_selective_load(self):
+        ckptr = Checkpointer('./.test_ckpt_dir')
+        net = torch.nn.Linear(4, 2)
+        opt = torch.optim.Adam(net.parameters())
+        ckptr.save({'pi': net.state_dict(), 'opt': opt.state_dict(), 't': 5}, 5)
+        assert sorted(os.listdir(ckptr.get_ckpt_path(5))) == ['manifest.json', 'opt.pt', 'pi.pt', 't.pt']
+        state = ckptr.load(keys=['pi'])
+        assert list(state.keys()) == ['pi']
+        assert torch.equal(state['pi']['weight'], net.weight.data)
+        assert sorted(ckptr.load(5).keys()) == ['opt', 'pi', 't']
+        with self.assertRaises(AssertionError):
+            ckptr.load(keys=['net'])
+        rmtree('.test_ckpt_dir')
+
+    def test_index(self):
+        ckptr = Checkpointer('./.test_ckpt_dir', max_ckpts_to_keep=2)
+        for t in range(5):
+            ckptr.save({'test': t}, t)
+        with open(os.path.join(ckptr.ckptdir, 'index.json'), 'r') as f:
+            assert json.load(f) == [3, 4]
+        assert Checkpointer('./.test_ckpt_dir').ckpts() == [3, 4]
+
+        # checkpoints saved as single files without an index.
+        os.remove(os.path.join(ckptr.ckptdir, 'index.json'))
+        torch.save({'test': 5, 'other': 0}, ckptr.get_ckpt_path(5))
+        ckptr = Checkpointer('./.test_ckpt_dir', max_ckpts_to_keep=2)
+        assert ckptr.ckpts() == [3, 4, 5]
+        assert ckptr.load(keys=['test']) == {'test': 5}
+        ckptr.save({'test': 6}, 6)
+        assert ckptr.ckpts() == [5, 6]
+        assert sorted(os.listdir(ckptr.ckptdir)) == ['000000005.pt', '000000006.pt', 'index.json']
+
+        # a crash while pruning leaves the new checkpoint in the index.
+        def crash():
+            os.remove(ckptr.get_ckpt_path(5))
+            raise KeyboardInterrupt
+        ckptr.prune_ckpts = crash
+        with self.assertRaises(KeyboardInterrupt):
+            ckptr.save({'test': 7}, 7)
+        with open(os.path.join(ckptr.ckptdir, 'index.json'), 'r') as f:
+            assert json.load(f) == [5, 6, 7]
+        # indexed checkpoints which were removed are dropped on load.
+        ckptr = Checkpointer('./.test_ckpt_dir', max_ckpts_to_keep=2)
+        assert ckptr.ckpts() == [6, 7]
+        assert ckptr.load()['test'] == 7
+        rmtree('.test_ckpt_dir')
+
 
 if __name__=='__main__':
     unittest.main()
@@ -0,0 +1,130 @@
+"""
+Helpers for data parallel training with torch.distributed.
+All functions are no-ops when torch.distributed is not initialized.
+"""
+import os
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def init_process_group(rank, world_size, backend='gloo', master_addr='127.0.0.1', master_port=29500):
+    """
+    Initializes the default process group for world_size local processes.
+    """
+    os.environ.setdefault('MASTER_ADDR', master_addr)
+    os.environ.setdefault('MASTER_PORT', str(master_port))
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+
+def broadcast_module(module, src=0):
+    """
+    Copies the parameters and buffers of module on rank src to all other ranks.
+    """
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for v in module.state_dict().values():
+            dist.broadcast(v, src)
+
+
+def all_reduce_gradients(params):
+    """
+    Averages the gradients of params across ranks with a single all-reduce.
+    Parameters without a gradient are treated as having a gradient of zero.
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    params = [p for p in params if p.requires_grad]
+    grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in params]
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= world_size
+    offset = 0
+    for p in params:
+        n = p.numel()
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+        p.grad.copy_(flat[offset:offset + n].view_as(p))
+        offset += n
+
+
+def all_reduce_moments(mean, var, count):
+    """
+    Combines the mean and (biased) variance of count samples on each rank
+    into the mean and variance of the samples on all ranks.
+    Returns mean, var, count.
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return mean, var, count
+    count = torch.as_tensor(count, dtype=mean.dtype, device=mean.device)
+    moments = torch.stack([count * mean, count * (var + mean ** 2), count.expand_as(mean)])
+    dist.all_reduce(moments)
+    total = moments[2]
+    mean = moments[0] / total
+    var = moments[1] / total - mean ** 2
+    return mean, var.clamp(min=0), total.view(-1)[0].item()
+
+
+def all_reduce_any(flag):
+    """
+    Returns True on every rank if flag is True on any rank.
+    """
+    if not is_distributed():
+        return flag
+    x = torch.tensor([1 if flag else 0])
+    dist.all_reduce(x, op=dist.ReduceOp.MAX)
+    return bool(x.item())
+
+
+
+import unittest
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+def _test_worker(rank, world_size, port):
+    init_process_group(rank, world_size, master_port=port)
+    torch.manual_seed(rank)
+    net = nn.Linear(3, 2)
+    broadcast_module(net)
+    w = [torch.empty_like(net.weight) for _ in range(world_size)]
+    dist.all_gather(w, net.weight.detach())
+    assert all(torch.allclose(w[0], x) for x in w)
+
+    net.zero_grad()
+    (float(rank + 1) * net(torch.ones(1, 3)).sum()).backward()
+    all_reduce_gradients(net.parameters())
+    assert torch.allclose(net.weight.grad, torch.full_like(net.weight, (world_size + 1) / 2))
+
+    x = torch.arange(4 * (rank + 1), dtype=torch.float).view(-1, 1) + 10 * rank
+    mean, var, count = all_reduce_moments(x.mean(0), x.var(0, unbiased=False), len(x))
+    xs = torch.cat([torch.arange(4 * (r + 1), dtype=torch.float).view(-1, 1) + 10 * r for r in range(world_size)])
+    assert count == len(xs)
+    assert torch.allclose(mean, xs.mean(0))
+    assert torch.allclose(var, xs.var(0, unbiased=False), atol=1e-4)
+
+    assert all_reduce_any(rank == 1)
+    assert not all_reduce_any(False)
+    dist.destroy_process_group()
+
+class TestDistributed(unittest.TestCase):
+    def test(self):
+        assert get_rank() == 0 and get_world_size() == 1
+        mp.spawn(_test_worker, args=(2, 29517), nprocs=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
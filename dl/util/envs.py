@@ -19,13 +19,61 @@ class EpsilonGreedy(ActionWrapper):
             return self.action_space.sample()
         return action
 
+class _EpisodeWindow(object):
+    """
+    Rewards and lengths of the episodes which finished since the last write.
+    """
+    def __init__(self):
+        self.rews = []
+        self.lens = []
+
+    def add(self, rews, lens):
+        self.rews.append(rews)
+        self.lens.append(lens)
+
+    def log(self, prefix, t):
+        if len(self.rews) == 0:
+            return
+        walltime = time.time()
+        logger.add_scalar(prefix + 'env/episodes', sum(len(r) for r in self.rews), t, walltime)
+        for name, x in [('episode_reward', np.concatenate(self.rews)), ('episode_length', np.concatenate(self.lens))]:
+            logger.add_scalar(f'{prefix}env/{name}_mean', x.mean(), t, walltime)
+            logger.add_scalar(f'{prefix}env/{name}_min', x.min(), t, walltime)
+            logger.add_scalar(f'{prefix}env/{name}_max', x.max(), t, walltime)
+        self.rews = []
+        self.lens = []
+
+
+@gin.configurable(blacklist=['venv', 'tstart'])
 class VecMonitor(VecEnvWrapper):
-    def __init__(self, venv, max_history=1000, tstart=0, tbX=False):
+    """
+    Keeps the rewards and lengths of the last max_history episodes and counts
+    the timesteps of finished episodes in self.t.
+    Args:
+        max_history (int):
+            The number of episodes kept in episode_rewards and episode_lengths.
+        tstart (int):
+            The initial timestep.
+        tbX (bool):
+            Whether or not to write episode stats to tensorboard. The mean,
+            min and max reward and length of the episodes which finished in
+            each window of log_period timesteps are written once per window.
+        log_period (int):
+            The number of timesteps in each window.
+        log_episodes (bool):
+            If True, the reward and length of every episode are also written
+            (env/episode_reward and env/episode_length).
+    """
+    def __init__(self, venv, max_history=1000, tstart=0, tbX=False, log_period=10000, log_episodes=False):
         super().__init__(venv)
         self.t = tstart
         self.enable_tbX = tbX
+        self.log_period = log_period
+        self.log_episodes = log_episodes
         self.episode_rewards = deque(maxlen=max_history)
         self.episode_lengths = deque(maxlen=max_history)
+        self.window = _EpisodeWindow()
+        self.last_log = tstart
         self.rews = np.zeros(self.num_envs, dtype=np.float32)
         self.lens = np.zeros(self.num_envs, dtype=np.int32)
 
@@ -40,16 +88,91 @@ class VecMonitor(VecEnvWrapper):
         obs, rews, dones, infos = self.venv.step_wait()
         self.rews += rews
         self.lens += 1
-        for i,done in enumerate(dones):
-            if done:
-                self.episode_lengths.append(self.lens[i])
-                self.episode_rewards.append(self.rews[i])
-                self.t += self.lens[i]
-                if self.enable_tbX and logger.get_summary_writer():
-                    logger.add_scalar('env/episode_length', self.lens[i], self.t, time.time())
-                    logger.add_scalar('env/episode_reward', self.rews[i], self.t, time.time())
-                self.lens[i] = 0
-                self.rews[i] = 0.
+        done = np.flatnonzero(dones)
+        if len(done) == 0:
+            return obs, rews, dones, infos
+        ep_rews = self.rews[done]
+        ep_lens = self.lens[done]
+        self.rews[done] = 0.
+        self.lens[done] = 0
+        self.episode_rewards.extend(ep_rews)
+        self.episode_lengths.extend(ep_lens)
+        ts = self.t + np.cumsum(ep_lens)
+        self.t = int(ts[-1])
+        if self.enable_tbX and logger.get_summary_writer():
+            if self.log_episodes:
+                walltime = time.time()
+                for t, r, l in zip(ts.tolist(), ep_rews.tolist(), ep_lens.tolist()):
+                    logger.add_scalar('env/episode_length', l, t, walltime)
+                    logger.add_scalar('env/episode_reward', r, t, walltime)
+            self.window.add(ep_rews, ep_lens)
+            if self.t - self.last_log >= self.log_period:
+                self.window.log('', self.t)
+                self.last_log = self.t
+        return obs, rews, dones, infos
+
+@gin.configurable(blacklist=['venv', 'population_size', 'tstart'])
+class PopulationVecMonitor(VecEnvWrapper):
+    """
+    VecMonitor for the environments of a population, which are split into
+    population_size consecutive blocks of equal size. The episode statistics
+    of member i are kept in episode_rewards[i] and episode_lengths[i] and
+    written to tensorboard under member{i}/ (see VecMonitor).
+    """
+    def __init__(self, venv, population_size, max_history=1000, tstart=0, tbX=False, log_period=10000, log_episodes=False):
+        super().__init__(venv)
+        assert self.num_envs % population_size == 0
+        self.population_size = population_size
+        self.nenv = self.num_envs // population_size
+        self.t = np.full(population_size, tstart, dtype=np.int64)
+        self.enable_tbX = tbX
+        self.log_period = log_period
+        self.log_episodes = log_episodes
+        self.episode_rewards = [deque(maxlen=max_history) for _ in range(population_size)]
+        self.episode_lengths = [deque(maxlen=max_history) for _ in range(population_size)]
+        self.windows = [_EpisodeWindow() for _ in range(population_size)]
+        self.last_log = self.t.copy()
+        self.rews = np.zeros(self.num_envs, dtype=np.float32)
+        self.lens = np.zeros(self.num_envs, dtype=np.int32)
+
+    def reset(self):
+        obs = self.venv.reset()
+        self.t += self.lens.reshape(self.population_size, self.nenv).sum(axis=1)
+        self.rews = np.zeros(self.num_envs, dtype=np.float32)
+        self.lens = np.zeros(self.num_envs, dtype=np.int32)
+        return obs
+
+    def step_wait(self):
+        obs, rews, dones, infos = self.venv.step_wait()
+        self.rews += rews
+        self.lens += 1
+        done = np.flatnonzero(dones)
+        if len(done) == 0:
+            return obs, rews, dones, infos
+        ep_rews = self.rews[done]
+        ep_lens = self.lens[done]
+        self.rews[done] = 0.
+        self.lens[done] = 0
+        members = done // self.nenv
+        log = self.enable_tbX and logger.get_summary_writer()
+        for m in np.unique(members):
+            rews_m = ep_rews[members == m]
+            lens_m = ep_lens[members == m]
+            self.episode_rewards[m].extend(rews_m)
+            self.episode_lengths[m].extend(lens_m)
+            ts = self.t[m] + np.cumsum(lens_m)
+            self.t[m] = ts[-1]
+            if not log:
+                continue
+            if self.log_episodes:
+                walltime = time.time()
+                for t, r, l in zip(ts.tolist(), rews_m.tolist(), lens_m.tolist()):
+                    logger.add_scalar(f'member{m}/env/episode_length', l, t, walltime)
+                    logger.add_scalar(f'member{m}/env/episode_reward', r, t, walltime)
+            self.windows[m].add(rews_m, lens_m)
+            if self.t[m] - self.last_log[m] >= self.log_period:
+                self.windows[m].log(f'member{m}/', int(self.t[m]))
+                self.last_log[m] = self.t[m]
         return obs, rews, dones, infos
 
 class TBXMonitor(gym.Wrapper):
@@ -168,6 +291,46 @@ class TestAtari(unittest.TestCase):
         logger.reset()
 
 
+class TestVecMonitor(unittest.TestCase):
+    def test(self):
+        from baselines.common.vec_env.dummy_vec_env import DummyVecEnv
+        from dl.util.scalar_log import read_scalars
+        import tempfile, shutil
+
+        class CountEnv(gym.Env):
+            # episodes of length n with a reward of 1 per step.
+            def __init__(self, n):
+                self.n = n
+                self.observation_space = Box(-1, 1, (1,), dtype=np.float32)
+                self.action_space = gym.spaces.Discrete(2)
+            def reset(self):
+                self.t = 0
+                return np.zeros(1, dtype=np.float32)
+            def step(self, action):
+                self.t += 1
+                return np.zeros(1, dtype=np.float32), 1., self.t >= self.n, {}
+
+        logdir = tempfile.mkdtemp()
+        logger.configure(logdir, [], tbX=True)
+        venv = DummyVecEnv([lambda n=n: CountEnv(n) for n in [1, 2, 3, 4]])
+        env = VecMonitor(venv, max_history=10, tbX=True, log_period=20, log_episodes=True)
+        env.reset()
+        for _ in range(12):
+            env.step(np.zeros(4, dtype=np.int64))
+        # 12 + 6 + 4 + 3 episodes.
+        assert env.t == 48
+        assert len(env.episode_rewards) == 10
+        assert list(env.episode_rewards) == list(env.episode_lengths)
+        logger.SCALARS.flush()
+        scalars = read_scalars(logger.SCALARS.path)
+        assert len(scalars['env/episode_reward']['value']) == 25
+        assert scalars['env/episode_reward']['step'][-1] == 48
+        assert list(scalars['env/episodes']['step']) == [22, 48]
+        assert scalars['env/episode_length_max']['value'][0] == 4
+        assert scalars['env/episode_length_min']['value'][0] == 1
+        logger.configure(logdir, [], tbX=False)
+        shutil.rmtree(logdir)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,272 @@
+"""
+Serve batched forward passes of a network to many local clients.
+"""
+from dl.util.remote_env import send_msg, recv_msg
+import os, socket, threading, queue, time, copy
+import torch
+import numpy as np
+from collections import deque, namedtuple
+
+
+class InferenceServer(object):
+    """
+    Listens on the unix socket at path for observations sent by InferenceClients
+    and evaluates them with a copy of net in dynamic batches. A batch is run as
+    soon as it holds max_batch_size observations or max_wait_us microseconds
+    after its first request arrived. Requests are not split, so a batch only
+    exceeds max_batch_size if a single request does. Only the outputs in keys
+    are returned. Call sync to update the weights of the served network.
+    """
+    def __init__(self, net, path, max_batch_size=64, max_wait_us=1000, keys=('action',), device='cpu', history=10000):
+        self.net = copy.deepcopy(net).to(device)
+        self.path = path
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_us / 1e6
+        self.keys = keys
+        self.device = device
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._requests = queue.Queue()
+        # a request which did not fit in the previous batch.
+        self._next = None
+        self._stop = threading.Event()
+        self._threads = []
+        self._conns = []
+        self.sock = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen()
+        self.sock.settimeout(0.1)
+        for target in [self._accept, self._batch]:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def sync(self, net):
+        with self._lock, torch.no_grad():
+            self.net.load_state_dict(net.state_dict())
+
+    def _accept(self):
+        while not self._stop.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            self._conns.append(conn)
+            threading.Thread(target=self._read, args=(conn,), daemon=True).start()
+
+    def _read(self, conn):
+        try:
+            while not self._stop.is_set():
+                ob = recv_msg(conn)
+                self._requests.put((conn, ob, time.monotonic()))
+        except (ConnectionError, OSError):
+            conn.close()
+
+    def _batch(self):
+        while not self._stop.is_set():
+            if self._next is not None:
+                reqs, self._next = [self._next], None
+            else:
+                try:
+                    reqs = [self._requests.get(timeout=0.1)]
+                except queue.Empty:
+                    continue
+            n = len(reqs[0][1])
+            deadline = reqs[0][2] + self.max_wait
+            while n < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    req = self._requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if n + len(req[1]) > self.max_batch_size:
+                    self._next = req
+                    break
+                reqs.append(req)
+                n += len(req[1])
+            self._run(reqs, n)
+
+    def _run(self, reqs, n):
+        try:
+            x = torch.from_numpy(np.concatenate([ob for _, ob, _ in reqs])).to(self.device)
+            with self._lock, torch.no_grad():
+                outs = self.net(x)
+            outs = {k: getattr(outs, k).cpu().numpy() for k in self.keys}
+        except Exception as e:
+            # a bad request (e.g. an observation of the wrong shape) fails on
+            # its own and the server keeps running.
+            if len(reqs) > 1:
+                for req in reqs:
+                    self._run([req], len(req[1]))
+                return
+            try:
+                send_msg(reqs[0][0], {'__error__': f'{type(e).__name__}: {e}'})
+            except OSError:
+                pass
+            return
+        # stats are recorded before replying, so they include every answered request.
+        now = time.monotonic()
+        self.latencies.extend(now - t for _, _, t in reqs)
+        self.batch_sizes.append(n)
+        start = 0
+        for conn, ob, _ in reqs:
+            end = start + len(ob)
+            try:
+                send_msg(conn, {k: v[start:end] for k,v in outs.items()})
+            except OSError:
+                pass
+            start = end
+
+    def stats(self):
+        """
+        Returns the p50 and p99 latency of requests in microseconds and the
+        mean batch size.
+        """
+        if len(self.latencies) == 0:
+            return {}
+        latencies = 1e6 * np.array(self.latencies)
+        return {
+            'latency_p50_us': np.percentile(latencies, 50),
+            'latency_p99_us': np.percentile(latencies, 99),
+            'mean_batch_size': np.mean(self.batch_sizes),
+        }
+
+    def batch_size_histogram(self):
+        """
+        Returns the number of batches of size i at index i.
+        """
+        return np.bincount(np.array(self.batch_sizes, dtype=np.int64), minlength=self.max_batch_size + 1)
+
+    def close(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        for conn in self._conns:
+            conn.close()
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class InferenceClient(object):
+    """
+    Sends batches of observations to the InferenceServer at path. Calling the
+    client returns the outputs of the served network as tensors, so it can be
+    used in place of the network, e.g. in rl_evaluate. Errors of the served
+    network are raised as RuntimeErrors.
+    """
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self._outputs = None
+
+    def __call__(self, ob):
+        if isinstance(ob, torch.Tensor):
+            ob = ob.cpu().numpy()
+        send_msg(self.sock, np.ascontiguousarray(ob))
+        outs = recv_msg(self.sock)
+        if '__error__' in outs:
+            raise RuntimeError(f"The inference server failed to evaluate the observations: {outs['__error__']}")
+        if self._outputs is None:
+            self._outputs = namedtuple('Outputs', list(outs.keys()))
+        return self._outputs(**{k: torch.from_numpy(v) for k,v in outs.items()})
+
+    def close(self):
+        self.sock.close()
+
+
+
+import unittest, tempfile
+import torch.nn as nn
+
+class TestInferenceServer(unittest.TestCase):
+    def test(self):
+        class Net(nn.Module):
+            Outputs = namedtuple('Outputs', ['action', 'value'])
+            def __init__(self):
+                super().__init__()
+                self.fc = nn.Linear(4, 1)
+            def forward(self, x):
+                return self.Outputs(action=x.sum(dim=1), value=self.fc(x))
+
+        path = os.path.join(tempfile.gettempdir(), 'test_inference_server.sock')
+        net = Net()
+        server = InferenceServer(net, path, max_batch_size=8, max_wait_us=5000, keys=('action', 'value'))
+        server.start()
+        results = {}
+        def client(i):
+            c = InferenceClient(path)
+            results[i] = [c(np.full((1, 4), i, dtype=np.float32)).action.item() for _ in range(20)]
+            c.close()
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(8):
+            assert results[i] == [4. * i] * 20
+        hist = server.batch_size_histogram()
+        assert hist.sum() == len(server.batch_sizes)
+        assert np.sum(hist * np.arange(len(hist))) == 8 * 20
+        assert len(hist) == 9 and len(server.latencies) == 8 * 20
+        assert server.stats()['mean_batch_size'] > 1
+        assert server.stats()['latency_p99_us'] >= server.stats()['latency_p50_us']
+
+        with torch.no_grad():
+            net.fc.weight.fill_(1.)
+            net.fc.bias.fill_(0.)
+        server.sync(net)
+        c = InferenceClient(path)
+        assert c(torch.ones(2, 4)).value.numpy().tolist() == [[4.], [4.]]
+        c.close()
+
+        # requests which do not fit are run in the next batch.
+        server.batch_sizes.clear()
+        results = {}
+        def big_client(i):
+            c = InferenceClient(path)
+            results[i] = c(np.full((3, 4), i, dtype=np.float32)).action.numpy().tolist()
+            c.close()
+        threads = [threading.Thread(target=big_client, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(4):
+            assert results[i] == [4. * i] * 3
+        assert sum(server.batch_sizes) == 12 and max(server.batch_sizes) <= 8
+
+        # a request the network fails on only fails for its client.
+        bad, good = InferenceClient(path), InferenceClient(path)
+        with self.assertRaises(RuntimeError):
+            bad(np.ones((1, 3), dtype=np.float32))
+        assert good(np.ones((1, 4), dtype=np.float32)).action.item() == 4.
+        results = {}
+        def client(i, c, shape):
+            try:
+                results[i] = c(np.ones(shape, dtype=np.float32)).action.numpy().tolist()
+            except RuntimeError:
+                results[i] = None
+        threads = []
+        for i, (c, shape) in enumerate([(bad, (1, 3)), (good, (2, 4))]):
+            threads.append(threading.Thread(target=client, args=(i, c, shape)))
+            threads[-1].start()
+        for thread in threads:
+            thread.join()
+        assert results == {0: None, 1: [4., 4.]}
+        bad.close()
+        good.close()
+        server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
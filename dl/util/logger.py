@@ -4,7 +4,8 @@ Change baselines logger to append to log files.
 from baselines.logger import *
 from baselines.logger import configure as baselines_configure
 from tensorboardX import SummaryWriter
-import os
+from dl.util.scalar_log import ScalarLog
+import os, atexit
 
 def append_human_init(self, filename_or_file):
     if isinstance(filename_or_file, str):
@@ -29,26 +30,42 @@ CSVOutputFormat.__init__ = append_csv_init
 
 # create global tensorboardX summary writer.
 WRITER = None
+# scalars are also appended to logdir/scalar_data/scalars.{bin,tags} for export.
+SCALARS = None
 def configure(logdir, format_strs=None, tbX=False, **kwargs):
-    global WRITER
+    global WRITER, SCALARS
+    _close_scalars()
     if tbX:
         WRITER = SummaryWriter(logdir, **kwargs)
+        # don't keep every scalar in memory, they are exported from SCALARS.
+        WRITER._SummaryWriter__append_to_scalar_dict = lambda *args: None
+        SCALARS = ScalarLog(os.path.join(logdir, 'scalar_data', 'scalars'))
     else:
         WRITER = None
     baselines_configure(logdir, format_strs)
 
+def _close_scalars():
+    global SCALARS
+    if SCALARS is not None:
+        SCALARS.close()
+        SCALARS = None
+
+atexit.register(_close_scalars)
+
 def get_summary_writer():
     return WRITER
 
 def add_scalar(tag, scalar_value, global_step=None, walltime=None):
     assert WRITER is not None, "call configure to initialize SummaryWriter"
     WRITER.add_scalar(tag, scalar_value, global_step, walltime)
-    # change interface so both add_scalar and add_scalars adds to the scalar dict.
-    WRITER._SummaryWriter__append_to_scalar_dict(tag, scalar_value, global_step, walltime)
+    # change interface so both add_scalar and add_scalars are exported.
+    SCALARS.add(tag, scalar_value, global_step, walltime)
 
 def add_scalars(main_tag, tag_scalar_dict, global_step=None, walltime=None):
     assert WRITER is not None, "call configure to initialize SummaryWriter"
     WRITER.add_scalars(main_tag, tag_scalar_dict, global_step, walltime)
+    for tag, scalar_value in tag_scalar_dict.items():
+        SCALARS.add(f'{main_tag}/{tag}', scalar_value, global_step, walltime)
 
 def add_histogram(tag, values, global_step=None, bins='tensorflow', walltime=None, max_bins=None):
     assert WRITER is not None, "call configure to initialize SummaryWriter"
@@ -90,10 +107,13 @@ def add_graph(model, input_to_model=None, verbose=False, **kwargs):
 
 
 def export_scalars(fname, overwrite=False):
+    """
+    Writes the scalars added since the last export to
+    logdir/scalar_data/fname as json, reading them from the scalar log.
+    """
     assert WRITER is not None, "call configure to initialize SummaryWriter"
-    os.makedirs(os.path.join(WRITER.log_dir, 'scalar_data'), exist_ok=True)
     if fname[-4:] != 'json':
         fname += '.json'
-    fname = os.path.join(WRITER.log_dir, 'scalar_data', fname)
+    fname = os.path.join(os.path.dirname(SCALARS.path), fname)
     if not os.path.exists(fname) or overwrite:
-        WRITER.export_scalars_to_json(fname)
+        SCALARS.export_json(fname)
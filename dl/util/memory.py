@@ -0,0 +1,157 @@
+"""
+Account for the memory used by buffers, rollouts, models and optimizers.
+"""
+from dl.util import logger
+import os, time, resource, weakref
+import numpy as np
+import torch
+
+
+def nbytes(x):
+    """
+    Returns the number of bytes held by x, which can be a np.ndarray, a
+    torch.Tensor, an nn.Module (parameters and buffers), an optimizer (state),
+    an object with an nbytes method (e.g. ReplayBuffer or RolloutStorage), or
+    a list, tuple or dict of these.
+    """
+    if x is None:
+        return 0
+    if isinstance(x, np.ndarray):
+        return x.nbytes
+    if torch.is_tensor(x):
+        return x.numel() * x.element_size()
+    if isinstance(x, torch.nn.Module):
+        return sum(nbytes(p) for p in x.parameters()) + sum(nbytes(b) for b in x.buffers())
+    if isinstance(x, torch.optim.Optimizer):
+        return sum(nbytes(v) for state in x.state.values() for v in state.values() if torch.is_tensor(v))
+    if isinstance(x, dict):
+        return sum(nbytes(v) for v in x.values())
+    if isinstance(x, (list, tuple)):
+        # count objects which appear more than once (e.g. shared networks) once.
+        return sum(nbytes(v) for v in {id(v): v for v in x}.values())
+    if hasattr(x, 'nbytes'):
+        return x.nbytes()
+    return 0
+
+
+def process_rss():
+    """
+    Returns the resident set size of this process in bytes.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # peak rss, in kilobytes on linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def available_memory():
+    """
+    Returns the memory available to new allocations in bytes, or None if it
+    is unknown.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+# bytes reserved by the owners of buffers which passed check_available.
+_reserved = weakref.WeakKeyDictionary()
+
+def check_available(nbytes, name, owner=None):
+    """
+    Raises a MemoryError if nbytes more bytes do not fit in the available
+    memory. Arrays allocated with np.empty only take memory when they are
+    filled, so buffers call this when they are allocated to fail at startup
+    instead of when they fill up.
+    If owner is given, nbytes are reserved for it until it is garbage
+    collected (or checks again), so that several buffers of one process do
+    not each count the same free memory. Reserved bytes are not subtracted
+    from MemAvailable as they fill, so later checks are conservative.
+    """
+    available = available_memory()
+    if available is not None:
+        available -= sum(n for o, n in _reserved.items() if o is not owner)
+        if nbytes > available:
+            raise MemoryError(f"{name} needs {nbytes / 2**30:.2f} GB when full, but only "
+                              f"{max(available, 0) / 2**30:.2f} GB of memory is available.")
+    if owner is not None:
+        _reserved[owner] = nbytes
+
+
+def cuda_memory_stats(device=None):
+    """
+    Returns the allocated, reserved and peak allocated bytes of the torch
+    cuda caching allocator, or an empty dict without cuda.
+    """
+    if not torch.cuda.is_available():
+        return {}
+    return {
+        'cuda_allocated': torch.cuda.memory_allocated(device),
+        'cuda_reserved': torch.cuda.memory_reserved(device),
+        'cuda_max_allocated': torch.cuda.max_memory_allocated(device),
+    }
+
+
+def log_memory(t, **components):
+    """
+    Logs the bytes of each component (see nbytes), the process rss and the
+    cuda allocator stats in MB with logger.logkv and to tensorboard.
+    Example:
+        log_memory(self.t, buffer=self.buffer, net=self.net, opt=self.opt)
+    """
+    stats = {name: nbytes(x) for name, x in components.items()}
+    stats['rss'] = process_rss()
+    stats.update(cuda_memory_stats())
+    for name, n in stats.items():
+        logger.logkv(f'memory - {name} (MB)', n / 2**20)
+        logger.add_scalar(f'memory/{name}', n / 2**20, t, time.time())
+    return stats
+
+
+
+import unittest
+
+class TestMemory(unittest.TestCase):
+    def test(self):
+        net = torch.nn.Linear(10, 5)
+        assert nbytes(net) == 55 * 4
+        opt = torch.optim.Adam(net.parameters())
+        assert nbytes(opt) == 0
+        net(torch.ones(1, 10)).sum().backward()
+        opt.step()
+        # exp_avg and exp_avg_sq (and a step count which is a tensor in recent versions of torch).
+        assert nbytes(opt) >= 2 * 55 * 4
+        x = np.zeros((3, 4), dtype=np.uint8)
+        assert nbytes({'a': x, 'b': [torch.zeros(2), None]}) == 12 + 8
+        assert nbytes([net, net]) == nbytes(net)
+        assert process_rss() > 0
+
+    def test_check_available(self):
+        if available_memory() is None:
+            return
+        check_available(1, 'buffer')
+        with self.assertRaises(MemoryError):
+            check_available(2**60, 'buffer')
+
+        # memory reserved by one buffer is not available to another.
+        class Buffer(object):
+            pass
+        a, b = Buffer(), Buffer()
+        n = int(0.6 * available_memory())
+        check_available(n, 'a', owner=a)
+        check_available(n, 'a', owner=a)
+        with self.assertRaises(MemoryError):
+            check_available(n, 'b', owner=b)
+        del a
+        check_available(n, 'b', owner=b)
+
+
+if __name__ == '__main__':
+    unittest.main()
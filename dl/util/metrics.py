@@ -0,0 +1,85 @@
+"""
+Accumulate training metrics without syncing with the device on every update.
+"""
+import numpy as np
+import torch
+
+
+class MetricsAccumulator(object):
+    """
+    Keeps running sums and counts of metrics, e.g. losses. Tensors are
+    detached and summed on their device, so adding a metric neither keeps its
+    autograd graph alive nor waits for the device. Metrics can be scalars or
+    tensors of a fixed shape (e.g. one value per population member).
+    All sums are copied to the host together when means() is called.
+    """
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, name, value):
+        if torch.is_tensor(value):
+            value = value.detach()
+        if name in self.sums:
+            self.sums[name] = self.sums[name] + value
+            self.counts[name] += 1
+        else:
+            self.sums[name] = value
+            self.counts[name] = 1
+
+    def __contains__(self, name):
+        return name in self.sums
+
+    def __len__(self):
+        return len(self.sums)
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+
+    def means(self, reset=True):
+        """
+        Returns a dict from name to the mean (np.ndarray) of the values added
+        since the last reset.
+        """
+        tensors = {k: v for k,v in self.sums.items() if torch.is_tensor(v)}
+        host = {}
+        if len(tensors) > 0:
+            # one copy to the host for all metrics.
+            device = next(iter(tensors.values())).device
+            flat = torch.cat([v.reshape(-1).float().to(device) for v in tensors.values()]).cpu().numpy()
+            i = 0
+            for k,v in tensors.items():
+                host[k] = flat[i:i+v.numel()].reshape(v.shape)
+                i += v.numel()
+        means = {k: host.get(k, np.asarray(v, dtype=np.float32)) / self.counts[k] for k,v in self.sums.items()}
+        if reset:
+            self.reset()
+        return means
+
+
+
+import unittest
+
+class TestMetrics(unittest.TestCase):
+    def test(self):
+        metrics = MetricsAccumulator()
+        x = torch.ones(3, requires_grad=True)
+        for i in range(4):
+            loss = (x * i).sum()
+            metrics.add('loss', loss)
+            metrics.add('per_member', x * i)
+            metrics.add('alpha', 0.5)
+        assert not metrics.sums['loss'].requires_grad
+        assert 'loss' in metrics and len(metrics) == 3
+        means = metrics.means()
+        assert np.allclose(means['loss'], 4.5)
+        assert means['per_member'].shape == (3,)
+        assert np.allclose(means['per_member'], 1.5)
+        assert np.allclose(means['alpha'], 0.5)
+        assert len(metrics) == 0
+        assert metrics.means() == {}
+
+
+if __name__ == '__main__':
+    unittest.main()
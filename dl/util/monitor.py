@@ -4,16 +4,72 @@ Change baselines Monitor to append to log files.
 from baselines import bench
 from baselines.bench.monitor import ResultsWriter
 from gym.core import Wrapper
-import time, json, csv
+import numpy as np
+import time, json, csv, gin
 import os.path as osp
 
 
+class RingBuffer(object):
+    """
+    Keeps the last capacity values appended to it. Supports len, iteration,
+    indexing and slicing (oldest first, like the end of a list) and an O(1)
+    mean of the kept values.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = [0.] * capacity
+        self.n = 0
+        self.next = 0
+        self.sum = 0.
+        self.appends = 0
+
+    def append(self, x):
+        if self.n == self.capacity:
+            self.sum -= self.data[self.next]
+        else:
+            self.n += 1
+        self.data[self.next] = x
+        self.sum += x
+        self.next = (self.next + 1) % self.capacity
+        self.appends += 1
+        if self.appends % self.capacity == 0:
+            # recompute the running sum to keep rounding errors from accumulating.
+            self.sum = float(np.sum(self.data[:self.n]))
+
+    def values(self):
+        if self.n < self.capacity:
+            return self.data[:self.n]
+        return self.data[self.next:] + self.data[:self.next]
+
+    def mean(self):
+        return self.sum / self.n if self.n > 0 else np.nan
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def __getitem__(self, idx):
+        return self.values()[idx]
+
+
 class AppendResultsWriter(ResultsWriter):
-    def __init__(self, filename=None, header='', extra_keys=()):
+    """
+    ResultsWriter which appends to existing files. Rows are flushed to disk
+    every flush_rows rows or flush_secs seconds (checked when a row is
+    written), and on close. Every row is flushed if both are None.
+    """
+    def __init__(self, filename=None, header='', extra_keys=(), flush_secs=None, flush_rows=None):
         self.extra_keys = extra_keys
+        self.flush_secs = flush_secs
+        self.flush_rows = flush_rows
+        self.rows = 0
+        self.last_flush = time.monotonic()
         if filename is None:
             self.f = None
             self.logger = None
+            self.tstart = time.time()
         else:
             if not filename.endswith(Monitor.EXT):
                 if osp.isdir(filename):
@@ -39,17 +95,53 @@ class AppendResultsWriter(ResultsWriter):
                 self.logger.writeheader()
                 self.f.flush()
 
+    def write_row(self, epinfo):
+        if self.logger is None:
+            return
+        self.logger.writerow(epinfo)
+        self.rows += 1
+        if self.flush_rows is None and self.flush_secs is None:
+            self.flush()
+        elif self.flush_rows is not None and self.rows >= self.flush_rows:
+            self.flush()
+        elif self.flush_secs is not None and time.monotonic() - self.last_flush >= self.flush_secs:
+            self.flush()
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+        self.rows = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            self.logger = None
+
+@gin.configurable(blacklist=['env', 'filename'])
 class Monitor(bench.Monitor):
     """
     Changing baselines.bench.Monitor to append to an existing log file.
     This allows for easier starting and stopping of experiments.
+    Args:
+        max_history (int):
+            If set, only the last max_history episodes are kept in
+            episode_rewards, episode_lengths and episode_times (RingBuffers).
+            num_episodes counts all episodes.
+        flush_secs (float), flush_rows (int):
+            See AppendResultsWriter. The file stays readable by
+            baselines.bench.load_results.
     """
-    def __init__(self, env, filename, allow_early_resets=True, reset_keywords=(), info_keywords=()):
+    def __init__(self, env, filename, allow_early_resets=True, reset_keywords=(), info_keywords=(),
+                 max_history=None, flush_secs=None, flush_rows=None):
         Wrapper.__init__(self, env=env)
         self.results_writer = AppendResultsWriter(
             filename,
             header={"t_start": time.time(), 'env_id' : env.spec and env.spec.id},
-            extra_keys=reset_keywords + info_keywords
+            extra_keys=reset_keywords + info_keywords,
+            flush_secs=flush_secs,
+            flush_rows=flush_rows
         )
         self.tstart = self.results_writer.tstart
         self.reset_keywords = reset_keywords
@@ -57,8 +149,89 @@ class Monitor(bench.Monitor):
         self.allow_early_resets = allow_early_resets
         self.rewards = None
         self.needs_reset = True
-        self.episode_rewards = []
-        self.episode_lengths = []
-        self.episode_times = []
+        if max_history is None:
+            self.episode_rewards = []
+            self.episode_lengths = []
+            self.episode_times = []
+        else:
+            self.episode_rewards = RingBuffer(max_history)
+            self.episode_lengths = RingBuffer(max_history)
+            self.episode_times = RingBuffer(max_history)
+        self.num_episodes = 0
         self.total_steps = 0
         self.current_reset_info = {} # extra info about the current episode, that was passed in during reset()
+
+    def update(self, ob, rew, done, info):
+        super().update(ob, rew, done, info)
+        if done:
+            self.num_episodes += 1
+
+    def mean_episode_stats(self, n=100):
+        """
+        Returns the mean length and reward of recent episodes: the kept
+        episodes (in O(1)) when max_history is set, and the last n episodes
+        otherwise.
+        """
+        if isinstance(self.episode_rewards, RingBuffer):
+            return self.episode_lengths.mean(), self.episode_rewards.mean()
+        return np.mean(self.episode_lengths[-n:]), np.mean(self.episode_rewards[-n:])
+
+    def close(self):
+        super().close()
+        self.results_writer.close()
+
+
+
+import unittest, tempfile, shutil, gym
+
+class TestMonitor(unittest.TestCase):
+    def test_ring_buffer(self):
+        x = RingBuffer(3)
+        assert len(x) == 0 and list(x) == []
+        for i in range(5):
+            x.append(i)
+        assert len(x) == 3 and list(x) == [2, 3, 4]
+        assert list(x[-2:]) == [3, 4] and x[0] == 2
+        assert x.mean() == 3.
+
+    def test(self):
+        from baselines.bench import load_results
+
+        class CountEnv(gym.Env):
+            # episodes of length 3 with a reward of 1 per step.
+            spec = None
+            observation_space = gym.spaces.Discrete(1)
+            action_space = gym.spaces.Discrete(1)
+            def reset(self):
+                self.t = 0
+                return 0
+            def step(self, action):
+                self.t += 1
+                return 0, 1., self.t >= 3, {}
+
+        logdir = tempfile.mkdtemp()
+        env = Monitor(CountEnv(), logdir, max_history=4, flush_rows=5)
+        for _ in range(10):
+            env.reset()
+            done = False
+            while not done:
+                _, _, done, _ = env.step(0)
+        assert env.num_episodes == 10 and len(env.episode_rewards) == 4
+        assert env.episode_rewards.mean() == 3. and list(env.episode_lengths[-2:]) == [3, 3]
+        assert env.mean_episode_stats() == (3., 3.)
+        env.close()
+
+        # append to the same file.
+        env = Monitor(CountEnv(), logdir, flush_secs=100)
+        env.reset()
+        for _ in range(3):
+            env.step(0)
+        assert env.mean_episode_stats() == (3., 3.)
+        env.close()
+        results = load_results(logdir)
+        assert len(results) == 11 and np.all(results['r'] == 3)
+        shutil.rmtree(logdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+"""
+Vectorized environment workers which run policy inference locally.
+"""
+from dl.util.shared_weights import SharedWeights
+from baselines.common.vec_env.dummy_vec_env import DummyVecEnv
+import copy
+import torch
+import torch.multiprocessing as mp
+import numpy as np
+from collections import deque
+
+
+def _worker(conn, ranks, env_fn, net, weights):
+    torch.set_num_threads(1)
+    env = DummyVecEnv([lambda rank=rank: env_fn(rank=rank) for rank in ranks])
+    nenv = len(ranks)
+    ob = env.reset()
+    mask = np.zeros(nenv, dtype=np.float32)
+    rews = np.zeros(nenv, dtype=np.float32)
+    lens = np.zeros(nenv, dtype=np.int32)
+    version = None
+    while True:
+        cmd, steps = conn.recv()
+        if cmd == 'close':
+            break
+        version = weights.sync(net, version)
+        data = {k: [] for k in ['ob', 'ac', 'r', 'mask', 'vpred', 'logp']}
+        episode_rewards, episode_lengths = [], []
+        for _ in range(steps):
+            with torch.no_grad():
+                outs = net(torch.from_numpy(ob))
+            ac = outs.action.numpy()
+            next_ob, r, done, _ = env.step(ac)
+            data['ob'].append(ob)
+            data['ac'].append(ac)
+            data['r'].append(r.astype(np.float32))
+            data['mask'].append(mask)
+            data['vpred'].append(outs.value.numpy())
+            data['logp'].append(outs.logp.numpy())
+            ob = next_ob
+            mask = 1.0 - done.astype(np.float32)
+            rews += r
+            lens += 1
+            for i in np.nonzero(done)[0]:
+                episode_rewards.append(rews[i])
+                episode_lengths.append(lens[i])
+            rews[done] = 0.
+            lens[done] = 0
+        batch = {k: np.stack(v) for k,v in data.items()}
+        batch['version'] = np.full((steps, nenv), version, dtype=np.int64)
+        batch['next_ob'] = ob
+        batch['next_mask'] = mask
+        batch['episode_rewards'] = episode_rewards
+        batch['episode_lengths'] = episode_lengths
+        conn.send(batch)
+    env.close()
+    conn.close()
+
+
+class PolicyWorkers(object):
+    """
+    Steps the environments env_fn(rank) for rank in ranks in nworkers
+    processes, each of which holds a cpu copy of net. collect publishes the
+    weights of net through shared memory and returns a batch of
+    (ob, ac, r, mask, vpred, logp, version) for steps steps of every environment,
+    where version identifies the weights used to act.
+    Only feed forward policies are supported.
+    """
+    def __init__(self, env_fn, ranks, nworkers, net, max_history=100):
+        assert len(ranks) % nworkers == 0, "The number of environments must be divisible by nworkers."
+        assert net.recurrent_state_size() is None, "Worker inference only supports feed forward policies."
+        self.num_envs = len(ranks)
+        self.episode_rewards = deque(maxlen=max_history)
+        self.episode_lengths = deque(maxlen=max_history)
+        ctx = mp.get_context('fork')
+        self.weights = SharedWeights(net, ctx)
+        cpu_net = copy.deepcopy(net).cpu()
+        n = self.num_envs // nworkers
+        self.conns = []
+        self.procs = []
+        for i in range(nworkers):
+            conn, worker_conn = ctx.Pipe()
+            p = ctx.Process(target=_worker, args=(worker_conn, ranks[i*n:(i+1)*n], env_fn, cpu_net, self.weights), daemon=True)
+            p.start()
+            worker_conn.close()
+            self.conns.append(conn)
+            self.procs.append(p)
+
+    def collect(self, net, steps):
+        """
+        Returns a dict of arrays with leading dimensions (steps, num_envs) and
+        the observations and masks following the last step.
+        """
+        self.weights.publish(net)
+        for conn in self.conns:
+            conn.send(('collect', steps))
+        batches = [conn.recv() for conn in self.conns]
+        out = {}
+        for k in ['ob', 'ac', 'r', 'mask', 'vpred', 'logp', 'version']:
+            out[k] = np.concatenate([b[k] for b in batches], axis=1)
+        for k in ['next_ob', 'next_mask']:
+            out[k] = np.concatenate([b[k] for b in batches], axis=0)
+        for b in batches:
+            self.episode_rewards.extend(b['episode_rewards'])
+            self.episode_lengths.extend(b['episode_lengths'])
+        return out
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(('close', None))
+        for p in self.procs:
+            p.join()
+
+
+
+import unittest
+from dl.modules import Policy
+from dl.util import atari_env
+
+class TestPolicyWorkers(unittest.TestCase):
+    def test(self):
+        env_fn = lambda rank: atari_env('Pong', rank=rank)
+        env = env_fn(rank=0)
+        net = Policy(env.observation_space.shape, env.action_space)
+        workers = PolicyWorkers(env_fn, list(range(4)), 2, net)
+        batch = workers.collect(net, 10)
+        assert batch['ob'].shape == (10, 4) + env.observation_space.shape
+        assert batch['next_ob'].shape == (4,) + env.observation_space.shape
+        assert np.all(batch['version'] == 1)
+        for k in ['ac', 'r', 'mask', 'vpred', 'logp']:
+            assert batch[k].shape[:2] == (10, 4)
+        assert np.all(batch['mask'][0] == 0)
+
+        # actions should match the local policy.
+        with torch.no_grad():
+            outs = net(torch.from_numpy(batch['ob'][3]))
+        assert np.allclose(outs.value.numpy(), batch['vpred'][3], atol=1e-5)
+        batch = workers.collect(net, 10)
+        assert np.all(batch['version'] == 2)
+        workers.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
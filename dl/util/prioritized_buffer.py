@@ -43,9 +43,16 @@ class PrioritizedReplayBuffer(object):
     def can_sample(self, batch_size):
         return self.buffer.can_sample(batch_size)
 
+    def nbytes(self):
+        return self.buffer.nbytes() + self._it_sum.nbytes() + self._it_min.nbytes()
+
     def _sample_proportional(self):
-        mass = random.random() * self._it_sum.sum(0, self.buffer.num_in_buffer - 2)
-        return self._it_sum.find_prefixsum_idx(mass)
+        while True:
+            mass = random.random() * self._it_sum.sum(0, self.buffer.num_in_buffer - 1 - self.buffer.nenv)
+            idx = self._it_sum.find_prefixsum_idx(mass)
+            # Rounding errors can land on an index with zero priority.
+            if self._it_sum[idx] > 0:
+                return idx
 
     def _encode_sample(self, idxes):
         return self.buffer._encode_sample(idxes)
@@ -111,6 +118,22 @@ class PrioritizedReplayBuffer(object):
     def store_effect(self, *args, **kwargs):
         return self.buffer.store_effect(*args, **kwargs)
 
+    def store_sequence(self, frames, actions, rewards, dones, priorities):
+        """Store a sequence of transitions with initial priorities.
+        See ReplayBuffer.store_sequence. Entries with priority 0 are
+        never sampled, which allows storing frames that are only used
+        as context for the observations of other transitions.
+        """
+        idxes = self.buffer.store_sequence(frames, actions, rewards, dones)
+        # priorities computed by actors are kept as they are and raise the
+        # priority of frames stored without one.
+        self._max_priority = max(self._max_priority, float(np.max(priorities)))
+        for idx, priority in zip(idxes, priorities):
+            self._it_sum[idx] = priority ** self._alpha
+            self._it_min[idx] = priority ** self._alpha if priority > 0 else float('inf')
+        self.num_in_buffer = self.buffer.num_in_buffer
+        return idxes
+
     def update_priorities(self, idxes, priorities):
         """Update priorities of sampled transitions.
         sets priority of transition at index idxes[i] in buffer
@@ -128,7 +151,7 @@ class PrioritizedReplayBuffer(object):
         assert len(idxes) == len(priorities)
         for idx, priority in zip(idxes, priorities):
             assert priority > 0
-            assert 0 <= idx < self.buffer.num_in_buffer - 1
+            assert 0 <= idx < self.buffer.num_in_buffer - self.buffer.nenv
             self._it_sum[idx] = priority ** self._alpha
             self._it_min[idx] = priority ** self._alpha
 
@@ -233,6 +256,28 @@ class TestPrioritizedBuffer(unittest.TestCase):
         assert buffer._it_sum[4] == buffer2._it_sum[4]
         assert buffer._it_sum[5] == buffer2._it_sum[5]
 
+    def test_sequence(self):
+        buffer = PrioritizedReplayBuffer(ReplayBuffer(16, 4), alpha=0.5)
+        frames = np.random.randint(0, 255, size=(10,1,8,8), dtype=np.uint8)
+        acs = np.random.randint(0, 4, size=(10,))
+        rews = np.random.rand(10).astype(np.float32)
+        dones = np.zeros(10, dtype=bool)
+        priorities = np.zeros(10)
+        priorities[3:-1] = 0.5
+        idxes = buffer.store_sequence(frames, acs, rews, dones, priorities)
+        assert buffer.num_in_buffer == 10
+        assert buffer._it_min.min() == 0.5 ** buffer._alpha
+        for _ in range(10):
+            s = buffer.sample(4, beta=1.)
+            assert all(3 <= idx < 9 for idx in s[-1])
+            assert np.allclose(s[-2], 1.)
+
+        # priorities above the current max are not clipped.
+        priorities[3:-1] = 4.
+        idxes = buffer.store_sequence(frames, acs, rews, dones, priorities)
+        assert buffer._max_priority == 4.
+        assert buffer._it_sum[idxes[3]] == 4. ** buffer._alpha
+
 
 
 
@@ -0,0 +1,165 @@
+"""
+Profile windows of training without restarting the run.
+"""
+import os, signal, cProfile
+import torch
+import gin
+
+
+@gin.configurable(blacklist=['logdir'])
+class Profiler(object):
+    """
+    Profiles Trainer.step during windows of length timesteps which start at
+    timestep start and then every period timesteps, or at the next step after
+    the process receives sig (e.g. 'SIGUSR1'). Each window writes
+    <first t>-<last t>.pt.trace.json (torch.profiler, viewable in
+    chrome://tracing or perfetto) and <first t>-<last t>.pstats (cProfile) to
+    logdir. Outside of windows, the cost is a comparison per step.
+    Example:
+        Trainer.profiler = @Profiler
+        Profiler.start = 1000000
+        Profiler.length = 10000
+        Profiler.period = 10000000
+        Profiler.sig = 'SIGUSR1'
+    Args:
+        logdir (str):
+            The directory in which profiles are saved.
+        start (int):
+            The timestep of the first window. If None, windows are only
+            started by sig.
+        length (int):
+            The number of timesteps in each window. A window contains at
+            least one call to Trainer.step.
+        period (int):
+            The period of windows after start. If None, only one window starts
+            at start.
+        sig (str or int):
+            A signal which starts a window.
+        torch_profiler (bool):
+            Whether or not to record a torch.profiler trace.
+        cprofile (bool):
+            Whether or not to record python function stats with cProfile.
+        record_shapes (bool):
+            Passed to torch.profiler.profile.
+        with_stack (bool):
+            Passed to torch.profiler.profile.
+    """
+    def __init__(self, logdir, start=None, length=10000, period=None, sig=None,
+                 torch_profiler=True, cprofile=True, record_shapes=False, with_stack=False):
+        assert torch_profiler or cprofile, "Nothing to profile."
+        assert period is None or period >= length, "Profiling windows can not overlap."
+        self.logdir = logdir
+        self.next_start = start
+        self.length = length
+        self.period = period
+        self.torch_profiler = torch_profiler
+        self.cprofile = cprofile
+        self.record_shapes = record_shapes
+        self.with_stack = with_stack
+        self.requested = False
+        self.window = None
+        if sig is not None:
+            signal.signal(getattr(signal, sig) if isinstance(sig, str) else sig, self._request)
+
+    def _request(self, signum, frame):
+        self.requested = True
+
+    def _skip_windows(self, t):
+        # skip windows which ended before t, e.g. when resuming from a checkpoint.
+        while self.next_start is not None and t >= self.next_start + self.length:
+            self.next_start = self.next_start + self.period if self.period else None
+
+    def before_step(self, t):
+        if self.window is not None:
+            return
+        self._skip_windows(t)
+        if self.requested or (self.next_start is not None and t >= self.next_start):
+            self.requested = False
+            self._start(t)
+
+    def after_step(self, t):
+        if self.window is not None and t >= self.window[1]:
+            self._stop(t)
+
+    def close(self, t):
+        """
+        Saves the current window, if any.
+        """
+        if self.window is not None:
+            self._stop(t)
+
+    def _start(self, t):
+        self.window = (t, t + self.length)
+        self.torch_prof = self.cprof = None
+        if self.torch_profiler:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_prof = torch.profiler.profile(activities=activities, record_shapes=self.record_shapes, with_stack=self.with_stack)
+            self.torch_prof.start()
+        if self.cprofile:
+            self.cprof = cProfile.Profile()
+            self.cprof.enable()
+
+    def _stop(self, t):
+        os.makedirs(self.logdir, exist_ok=True)
+        name = os.path.join(self.logdir, '{:09d}-{:09d}'.format(self.window[0], t))
+        if self.cprof is not None:
+            self.cprof.disable()
+            self.cprof.dump_stats(name + '.pstats')
+        if self.torch_prof is not None:
+            self.torch_prof.stop()
+            self.torch_prof.export_chrome_trace(name + '.pt.trace.json')
+        self.window = self.torch_prof = self.cprof = None
+        if self.next_start is not None and t >= self.next_start:
+            self.next_start = self.next_start + self.period if self.period else None
+        self._skip_windows(t)
+
+
+
+import unittest, shutil, tempfile, pstats, json
+
+class TestProfiler(unittest.TestCase):
+    def _run(self, profiler, t, nsteps, steps_per_call=10):
+        for _ in range(nsteps):
+            profiler.before_step(t)
+            torch.ones(10).sum()
+            t += steps_per_call
+            profiler.after_step(t)
+        return t
+
+    def _profiles(self, logdir):
+        return sorted(f for f in os.listdir(logdir) if f.endswith('.pstats'))
+
+    def test_schedule(self):
+        logdir = tempfile.mkdtemp()
+        profiler = Profiler(logdir, start=100, length=30, period=200)
+        self._run(profiler, 0, 60)
+        assert self._profiles(logdir) == ['000000100-000000130.pstats', '000000300-000000330.pstats',
+                                          '000000500-000000530.pstats']
+        with open(os.path.join(logdir, '000000100-000000130.pt.trace.json'), 'r') as f:
+            assert len(json.load(f)['traceEvents']) > 0
+        pstats.Stats(os.path.join(logdir, '000000100-000000130.pstats'))
+
+        # resume after the first window and finish inside the second window.
+        shutil.rmtree(logdir)
+        profiler = Profiler(logdir, start=100, length=30, period=200, torch_profiler=False)
+        t = self._run(profiler, 150, 16)
+        profiler.close(t)
+        assert self._profiles(logdir) == ['000000300-000000310.pstats']
+        assert not any(f.endswith('.json') for f in os.listdir(logdir))
+        shutil.rmtree(logdir)
+
+    def test_signal(self):
+        logdir = tempfile.mkdtemp()
+        profiler = Profiler(logdir, length=20, sig='SIGUSR1', torch_profiler=False)
+        t = self._run(profiler, 0, 5)
+        assert not os.path.exists(logdir) or self._profiles(logdir) == []
+        os.kill(os.getpid(), signal.SIGUSR1)
+        self._run(profiler, t, 5)
+        assert self._profiles(logdir) == ['000000050-000000070.pstats']
+        shutil.rmtree(logdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
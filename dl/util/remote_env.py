@@ -0,0 +1,290 @@
+"""
+Step blocks of environments hosted by env servers on other machines.
+Messages are nested dicts and lists of json values, numpy arrays and Box or
+Discrete spaces. They are sent as a json header, which describes the dtype
+and shape of each array, followed by the raw bytes of the arrays. Nothing
+received is unpickled, so a peer can not run code in the receiving process.
+"""
+from baselines.common.vec_env import VecEnv
+from gym.spaces import Box, Discrete
+import socket, struct, json, time
+import numpy as np
+from collections import deque
+
+
+def _encode(obj, arrays):
+    # replaces arrays (appended to arrays) and spaces with json placeholders.
+    if isinstance(obj, np.ndarray):
+        assert not obj.dtype.hasobject, "Arrays of python objects can not be sent."
+        # np.ascontiguousarray would make 0-d arrays 1-d.
+        arrays.append(obj if obj.flags.c_contiguous else obj.copy(order='C'))
+        return {'__array__': len(arrays) - 1}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        for k in obj.keys():
+            assert isinstance(k, str), f"Keys of sent dicts must be strings, got {k!r}."
+        return {k: _encode(v, arrays) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(v, arrays) for v in obj]
+    if isinstance(obj, Box):
+        return {'__space__': 'Box', 'low': _encode(obj.low, arrays), 'high': _encode(obj.high, arrays),
+                'dtype': obj.dtype.str}
+    if isinstance(obj, Discrete):
+        return {'__space__': 'Discrete', 'n': int(obj.n), 'start': int(obj.start)}
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    raise TypeError(f"Objects of type {type(obj).__name__} can not be sent.")
+
+
+def _decode(obj, arrays):
+    if isinstance(obj, list):
+        return [_decode(v, arrays) for v in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if '__array__' in obj:
+        return arrays[obj['__array__']]
+    if '__space__' in obj:
+        if obj['__space__'] == 'Box':
+            return Box(low=_decode(obj['low'], arrays), high=_decode(obj['high'], arrays), dtype=np.dtype(obj['dtype']))
+        if obj['__space__'] == 'Discrete':
+            return Discrete(obj['n'], start=obj['start'])
+        raise ValueError(f"Unknown space {obj['__space__']}.")
+    return {k: _decode(v, arrays) for k, v in obj.items()}
+
+
+def send_msg(sock, obj):
+    arrays = []
+    msg = _encode(obj, arrays)
+    header = json.dumps({'msg': msg, 'arrays': [[a.dtype.str, a.shape] for a in arrays]}).encode()
+    sock.sendall(struct.pack('!Q', len(header)) + header)
+    for a in arrays:
+        if a.size > 0:
+            sock.sendall(memoryview(a.reshape(-1)).cast('B'))
+
+
+def _recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        k = sock.recv_into(view[pos:], n - pos)
+        if k == 0:
+            raise ConnectionError("Socket closed.")
+        pos += k
+    return buf
+
+
+def recv_msg(sock):
+    n, = struct.unpack('!Q', _recv_exact(sock, 8))
+    header = json.loads(_recv_exact(sock, n))
+    arrays = []
+    for dtype, shape in header['arrays']:
+        dtype = np.dtype(dtype)
+        if dtype.hasobject:
+            raise ValueError("Received an array of python objects.")
+        size = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        arrays.append(np.frombuffer(_recv_exact(sock, size), dtype=dtype).reshape(tuple(shape)))
+    return _decode(header['msg'], arrays)
+
+
+def _parse_endpoint(endpoint):
+    host, port = endpoint.rsplit(':', 1)
+    return host, int(port)
+
+
+class EnvServer(object):
+    """
+    Hosts the environments env_fn(rank) for rank in ranks and steps them on
+    behalf of one client at a time. Environments are reset automatically
+    at the end of an episode, like DummyVecEnv.
+    Clients are not authenticated, so the server only listens on the local
+    machine unless another host (e.g. '0.0.0.0') is given explicitly.
+    """
+    def __init__(self, env_fn, ranks, port, host='127.0.0.1'):
+        self.envs = [env_fn(rank=rank) for rank in ranks]
+        self.sock = socket.create_server((host, port))
+
+    def serve(self):
+        """
+        Serves clients until one of them sends a close message.
+        """
+        running = True
+        while running:
+            conn, _ = self.sock.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with conn:
+                try:
+                    running = self._handle(conn)
+                except ConnectionError:
+                    pass
+        for env in self.envs:
+            env.close()
+        self.sock.close()
+
+    def _handle(self, conn):
+        while True:
+            msg = recv_msg(conn)
+            cmd = msg['cmd']
+            if cmd == 'spaces':
+                env = self.envs[0]
+                send_msg(conn, {'nenv': len(self.envs), 'observation_space': env.observation_space,
+                                'action_space': env.action_space})
+            elif cmd == 'reset':
+                send_msg(conn, {'obs': np.stack([env.reset() for env in self.envs])})
+            elif cmd == 'step':
+                send_msg(conn, self._step(msg['actions']))
+            elif cmd == 'close':
+                return False
+
+    def _step(self, actions):
+        start = time.monotonic()
+        obs, rews, dones, infos = [], [], [], []
+        for env, ac in zip(self.envs, actions):
+            if isinstance(env.action_space, Discrete):
+                ac = int(ac)
+            ob, r, done, info = env.step(ac)
+            if done:
+                ob = env.reset()
+            obs.append(ob)
+            rews.append(r)
+            dones.append(done)
+            infos.append(info)
+        return {'obs': np.stack(obs), 'rews': np.array(rews, dtype=np.float32),
+                'dones': np.array(dones), 'infos': infos, 'step_time': time.monotonic() - start}
+
+
+class RemoteVecEnv(VecEnv):
+    """
+    A VecEnv made of the environments hosted by the EnvServers at endpoints
+    ('host:port'). step_async sends step requests to all servers before waiting
+    for any of them, so servers step in parallel with each other and with the
+    caller until step_wait.
+    """
+    def __init__(self, endpoints, timeout=None, history=100):
+        self.endpoints = list(endpoints)
+        self.socks = []
+        self.nenvs = []
+        for endpoint in self.endpoints:
+            sock = socket.create_connection(_parse_endpoint(endpoint), timeout=timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            send_msg(sock, {'cmd': 'spaces'})
+            msg = recv_msg(sock)
+            self.socks.append(sock)
+            self.nenvs.append(msg['nenv'])
+        self.latencies = {endpoint: deque(maxlen=history) for endpoint in self.endpoints}
+        self.step_times = {endpoint: deque(maxlen=history) for endpoint in self.endpoints}
+        self._splits = np.cumsum(self.nenvs)[:-1]
+        self._sent = None
+        super().__init__(sum(self.nenvs), msg['observation_space'], msg['action_space'])
+
+    def reset(self):
+        for sock in self.socks:
+            send_msg(sock, {'cmd': 'reset'})
+        return np.concatenate([recv_msg(sock)['obs'] for sock in self.socks])
+
+    def step_async(self, actions):
+        self._sent = []
+        for sock, acs in zip(self.socks, np.split(np.asarray(actions), self._splits)):
+            send_msg(sock, {'cmd': 'step', 'actions': acs})
+            self._sent.append(time.monotonic())
+
+    def step_wait(self):
+        obs, rews, dones, infos = [], [], [], []
+        for endpoint, sock, sent in zip(self.endpoints, self.socks, self._sent):
+            msg = recv_msg(sock)
+            self.latencies[endpoint].append(time.monotonic() - sent)
+            self.step_times[endpoint].append(msg['step_time'])
+            obs.append(msg['obs'])
+            rews.append(msg['rews'])
+            dones.append(msg['dones'])
+            infos.extend(msg['infos'])
+        self._sent = None
+        return np.concatenate(obs), np.concatenate(rews), np.concatenate(dones), infos
+
+    def latency(self):
+        """
+        Returns the mean round trip time and the mean time spent stepping
+        environments on the server, in milliseconds, for each endpoint.
+        """
+        return {endpoint: {'latency_ms': 1000 * np.mean(self.latencies[endpoint]),
+                           'step_ms': 1000 * np.mean(self.step_times[endpoint])}
+                for endpoint in self.endpoints if len(self.latencies[endpoint]) > 0}
+
+    def shutdown_servers(self):
+        for sock in self.socks:
+            send_msg(sock, {'cmd': 'close'})
+
+    def close_extras(self):
+        if self._sent is not None:
+            self.step_wait()
+        for sock in self.socks:
+            sock.close()
+
+
+
+import unittest
+import multiprocessing as mp
+from dl.util import atari_env
+from baselines.common.vec_env.dummy_vec_env import DummyVecEnv
+
+def _serve(ranks, port):
+    EnvServer(lambda rank: atari_env('Pong', rank=rank), ranks, port, host='127.0.0.1').serve()
+
+class TestRemoteEnv(unittest.TestCase):
+    def test_msg(self):
+        a, b = socket.socketpair()
+        obj = {'obs': np.random.rand(3, 4, 8, 8).astype(np.float32), 'infos': [{}, {'x': 1}]}
+        send_msg(a, obj)
+        out = recv_msg(b)
+        assert np.allclose(obj['obs'], out['obs'])
+        assert out['infos'] == obj['infos']
+
+        obj = {'acs': np.array([1, 2], dtype=np.int64), 'dones': np.array([True, False]), 'r': np.float32(0.5),
+               'empty': np.zeros((0, 3)), 'x': np.array(2.), 'infos': [{'episode': {'r': 1., 'l': 3}}, {}],
+               'observation_space': Box(0, 255, (1, 4, 4), dtype=np.uint8), 'action_space': Discrete(6)}
+        send_msg(a, obj)
+        out = recv_msg(b)
+        for k in ['acs', 'dones', 'empty', 'x']:
+            assert out[k].dtype == obj[k].dtype and np.array_equal(out[k], obj[k])
+        assert out['r'] == 0.5 and out['infos'] == obj['infos']
+        assert out['observation_space'] == obj['observation_space']
+        assert out['action_space'] == obj['action_space']
+
+        # only data is sent, never arbitrary objects.
+        with self.assertRaises(TypeError):
+            send_msg(a, {'f': lambda: 0})
+        with self.assertRaises(AssertionError):
+            send_msg(a, np.array([object()]))
+        a.close()
+        b.close()
+
+    def test_remote_env(self):
+        ports = [29623, 29624]
+        servers = [mp.Process(target=_serve, args=([2*i, 2*i+1], port)) for i,port in enumerate(ports)]
+        for p in servers:
+            p.start()
+        time.sleep(2)
+        env = RemoteVecEnv([f'127.0.0.1:{port}' for port in ports])
+        local_env = DummyVecEnv([lambda rank=rank: atari_env('Pong', rank=rank) for rank in range(4)])
+        assert env.num_envs == 4
+        assert env.observation_space == local_env.observation_space
+        ob = env.reset()
+        assert np.allclose(ob, local_env.reset())
+        for _ in range(100):
+            acs = np.array([env.action_space.sample() for _ in range(4)])
+            ob, r, done, info = env.step(acs)
+            ob2, r2, done2, _ = local_env.step(acs)
+            assert np.allclose(ob, ob2) and np.allclose(r, r2) and np.all(done == done2)
+            assert len(info) == 4
+        stats = env.latency()
+        assert set(stats.keys()) == set(env.endpoints)
+        assert all(s['latency_ms'] >= s['step_ms'] for s in stats.values())
+        env.shutdown_servers()
+        env.close()
+        for p in servers:
+            p.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
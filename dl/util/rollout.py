@@ -28,6 +28,12 @@ class RolloutStorage(object):
         self.data['vtarg'] = torch.zeros(size=shape, dtype=step_data['vpred'].dtype, device=self.device)
         self.data['atarg'] = torch.zeros_like(self.data['vtarg'])
 
+    def nbytes(self):
+        """Returns the number of bytes of the stored data, on self.device."""
+        if self.data is None:
+            return 0
+        return sum(v.numel() * v.element_size() for v in self.data.values())
+
     def insert(self, step_data):
         """
         Insert new data into storage, transferring to the correct device if needed.
@@ -63,6 +69,34 @@ class RolloutStorage(object):
         if norm_advantages:
             self.data['atarg'] = (self.data['atarg'] - self.data['atarg'].mean()) / (self.data['atarg'].std() + 1e-5)
 
+    def compute_vtrace_targets(self, next_value, next_mask, log_rhos, gamma, rho_bar=1.0, c_bar=1.0, lambda_=1.0, norm_advantages=False):
+        """
+        Computes V-trace value targets and policy gradient advantages.
+        https://arxiv.org/abs/1802.01561
+        self.data['vpred'] should contain the value estimates of the target
+        policy and log_rhos the log importance weights (target logp - behavior logp)
+        with the same shape as self.data['r'].
+        """
+        assert log_rhos.shape == self.data['r'].shape
+        rhos = torch.exp(log_rhos)
+        clipped_rhos = rhos.clamp(max=rho_bar)
+        cs = lambda_ * rhos.clamp(max=c_bar)
+        values = self.data['vpred']
+        next_values = torch.cat([values[1:], next_value[None]], dim=0)
+        next_masks = torch.cat([self.data['mask'][1:], next_mask[None]], dim=0)
+        discounts = gamma * next_masks
+        deltas = clipped_rhos * (self.data['r'] + discounts * next_values - values)
+
+        acc = torch.zeros_like(next_value)
+        for step in reversed(range(self.num_steps)):
+            acc = deltas[step] + discounts[step] * cs[step] * acc
+            self.data['vtarg'][step] = acc + values[step]
+
+        next_vtarg = torch.cat([self.data['vtarg'][1:], next_value[None]], dim=0)
+        self.data['atarg'] = clipped_rhos * (self.data['r'] + discounts * next_vtarg - values)
+        if norm_advantages:
+            self.data['atarg'] = (self.data['atarg'] - self.data['atarg'].mean()) / (self.data['atarg'].std() + 1e-5)
+
 
     def feed_forward_generator(self, batch_size):
         assert self.step == 0, f"Insert exactly {self.num_steps} transitions before calling a generator. Only {self.step} insertions were made."
@@ -151,6 +185,8 @@ class TestRollout(unittest.TestCase):
                     assert False
                 except:
                     pass
+        # recurrent states are only stored for the first step.
+        assert r.nbytes() == 4 * (10*4*84*84 + 7*10*4 + 4*5)
         r.compute_targets(torch.ones(size=(4,1)), torch.ones(size=(4,1)), gamma=0.99, use_gae=True, lambda_=1.0)
         for batch in r.recurrent_generator(2):
             assert batch['ob'].shape == (20,1,84,84)
@@ -160,6 +196,29 @@ class TestRollout(unittest.TestCase):
             assert batch['r'].shape == (20,1)
             assert batch['state'].shape == (2,5)
 
+    def test_vtrace(self):
+        r = RolloutStorage(10, 3)
+        for i in range(10):
+            data = {}
+            data['ob'] = torch.zeros(size=(3,4))
+            data['ac'] = torch.zeros(size=(3,1))
+            data['r'] = torch.rand(size=(3,1))
+            data['mask'] = (torch.rand(size=(3,1)) > 0.2).float()
+            data['vpred'] = torch.rand(size=(3,1))
+            r.insert(data)
+        next_value, next_mask = torch.rand(size=(3,1)), torch.ones(size=(3,1))
+        # on-policy with lambda_ = 1, vtrace reduces to n-step returns.
+        r.compute_vtrace_targets(next_value, next_mask, torch.zeros(size=(10,3,1)), gamma=0.99)
+        vtrace, atarg = r.data['vtarg'].clone(), r.data['atarg'].clone()
+        r.compute_targets(next_value, next_mask, gamma=0.99, use_gae=False)
+        assert torch.allclose(vtrace, r.data['vtarg'], atol=1e-5)
+        assert torch.allclose(atarg[-1], r.data['atarg'][-1], atol=1e-5)
+
+        # truncated importance weights of zero give one step targets.
+        r.compute_vtrace_targets(next_value, next_mask, -1e4 * torch.ones(size=(10,3,1)), gamma=0.99)
+        assert torch.allclose(r.data['vtarg'], r.data['vpred'])
+        assert torch.allclose(r.data['atarg'], torch.zeros_like(r.data['atarg']))
+
 
 
 if __name__ == '__main__':
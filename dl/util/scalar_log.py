@@ -0,0 +1,244 @@
+"""
+An append-only binary log of scalars with bounded memory.
+"""
+import os, json, queue, threading, time
+import numpy as np
+
+
+RECORD = np.dtype([('tag', '<u4'), ('step', '<i8'), ('walltime', '<f8'), ('value', '<f8')])
+
+
+class ScalarLog(object):
+    """
+    Appends (tag, step, walltime, value) records to <path>.bin and the names
+    of tags to <path>.tags (one per line, the line number is the id used in
+    records). Records are buffered in batches of batch_size and written by a
+    background thread, so add does not block on the filesystem. At most
+    max_pending batches wait to be written, after which add blocks, so memory
+    is bounded by (max_pending + 1) * batch_size records. A partial batch is
+    written when a record is added more than flush_secs after the last write,
+    and by flush.
+    Logs are appended to when they exist, e.g. when resuming a run. A
+    partially written record at the end of a log which was not closed (e.g.
+    after a crash) is removed when the log is opened.
+    Args:
+        path (str):
+            The path of the log without extension.
+        batch_size (int):
+            The number of records written at once.
+        max_pending (int):
+            The maximum number of full batches waiting to be written.
+        flush_secs (float):
+            The maximum time a record is buffered before it is written.
+    """
+    def __init__(self, path, batch_size=4096, max_pending=4, flush_secs=10.):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_secs = flush_secs
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.tags = {tag: i for i, tag in enumerate(read_tags(path))}
+        # new records are appended after complete records only.
+        if os.path.exists(path + '.bin'):
+            os.truncate(path + '.bin', _nrecords(path) * RECORD.itemsize)
+        # records written before this log was opened are not exported.
+        self.exported = _nrecords(path)
+        self._new_tags = []
+        self._batch = np.empty(batch_size, dtype=RECORD)
+        self._n = 0
+        self._last_flush = time.monotonic()
+        self._error = None
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def add(self, tag, value, step=None, walltime=None):
+        # values may be python numbers, arrays or tensors with a single element.
+        value = np.asarray(value).item()
+        with self._lock:
+            if tag not in self.tags:
+                self.tags[tag] = len(self.tags)
+                self._new_tags.append(tag)
+            self._batch[self._n] = (self.tags[tag], -1 if step is None else step,
+                                    time.time() if walltime is None else walltime, value)
+            self._n += 1
+            if self._n == self.batch_size or time.monotonic() - self._last_flush > self.flush_secs:
+                self._put()
+
+    def _put(self):
+        # called with the lock held.
+        self._queue.put((self._new_tags, self._batch[:self._n].copy()))
+        self._new_tags = []
+        self._n = 0
+        self._last_flush = time.monotonic()
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            tags, records = item
+            try:
+                if len(tags) > 0:
+                    # tags are written before the records which use them.
+                    with open(self.path + '.tags', 'a') as f:
+                        f.write(''.join(tag + '\n' for tag in tags))
+                with open(self.path + '.bin', 'ab') as f:
+                    f.write(records.tobytes())
+            except Exception as e:
+                # raised by flush, so that waiting for the writer never hangs.
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        Writes all buffered records and waits until they are on disk.
+        """
+        with self._lock:
+            if self._n > 0 or len(self._new_tags) > 0:
+                self._put()
+        self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+    def export_json(self, fname):
+        """
+        Writes the records added since the last export (or since the log was
+        opened) to fname in the format of tensorboardX's
+        export_scalars_to_json: {tag: [[walltime, step, value], ...], ...}.
+        The json is written one tag at a time, reading the log from disk.
+        """
+        self.flush()
+        records = read_records(self.path, start=self.exported)
+        self.exported += len(records)
+        tags = read_tags(self.path)
+        with open(fname, 'w') as f:
+            f.write('{')
+            for i, tag_id in enumerate(np.unique(records['tag'])):
+                r = records[records['tag'] == tag_id]
+                step = [None if s < 0 else int(s) for s in r['step']]
+                data = [[w, s, v] for w, s, v in zip(r['walltime'].tolist(), step, r['value'].tolist())]
+                f.write((', ' if i > 0 else '') + json.dumps(tags[tag_id]) + ': ' + json.dumps(data))
+            f.write('}')
+
+
+def _nrecords(path):
+    if not os.path.exists(path + '.bin'):
+        return 0
+    return os.path.getsize(path + '.bin') // RECORD.itemsize
+
+
+def read_tags(path):
+    """
+    Returns the list of tags of the log at path.
+    """
+    if not os.path.exists(path + '.tags'):
+        return []
+    with open(path + '.tags', 'r') as f:
+        return f.read().splitlines()
+
+
+def read_records(path, start=0):
+    """
+    Returns the records of the log at path, starting at record start, as a
+    memory-mapped structured array with fields tag, step, walltime and value.
+    """
+    n = _nrecords(path)
+    if n <= start:
+        return np.empty(0, dtype=RECORD)
+    return np.memmap(path + '.bin', dtype=RECORD, mode='r', shape=(n,))[start:]
+
+
+def read_scalars(path):
+    """
+    Returns a dict from tag to a dict with the steps, walltimes and values
+    (np.ndarrays) of the tag in the log at path.
+    """
+    records = read_records(path)
+    tags = read_tags(path)
+    scalars = {}
+    for tag_id in np.unique(records['tag']):
+        r = records[records['tag'] == tag_id]
+        scalars[tags[tag_id]] = {'step': np.array(r['step']), 'walltime': np.array(r['walltime']),
+                                 'value': np.array(r['value'])}
+    return scalars
+
+
+
+import unittest, tempfile, shutil
+
+class TestScalarLog(unittest.TestCase):
+    def test(self):
+        logdir = tempfile.mkdtemp()
+        path = os.path.join(logdir, 'scalars')
+        log = ScalarLog(path, batch_size=10, max_pending=2)
+        for t in range(95):
+            log.add('loss', t / 2, t)
+            if t % 10 == 0:
+                log.add('env/reward', t, t, walltime=1.)
+        # full batches are written in the background.
+        log._queue.join()
+        assert _nrecords(path) == 100
+        log.add('no_step', 3.)
+        log.add('single', np.array([0.5], dtype=np.float32), 0)
+        log.flush()
+        assert _nrecords(path) == 107
+        scalars = read_scalars(path)
+        assert sorted(scalars.keys()) == ['env/reward', 'loss', 'no_step', 'single']
+        assert scalars['single']['value'][0] == 0.5
+        assert np.array_equal(scalars['loss']['step'], np.arange(95))
+        assert np.array_equal(scalars['loss']['value'], np.arange(95) / 2)
+        assert np.all(scalars['env/reward']['walltime'] == 1.)
+
+        log.export_json(os.path.join(logdir, 'a.json'))
+        with open(os.path.join(logdir, 'a.json'), 'r') as f:
+            data = json.load(f)
+        assert data['env/reward'][1] == [1., 10, 10.]
+        assert data['no_step'][0][1] is None
+        assert len(data['loss']) == 95
+        log.add('loss', 1., 95)
+        log.close()
+
+        # resume: tag ids are reused and only new records are exported.
+        log = ScalarLog(path)
+        log.add('loss', 2., 96)
+        log.add('new', 0., 96)
+        log.export_json(os.path.join(logdir, 'b.json'))
+        with open(os.path.join(logdir, 'b.json'), 'r') as f:
+            data = json.load(f)
+        assert sorted(data.keys()) == ['loss', 'new'] and len(data['loss']) == 1
+        log.close()
+        assert read_tags(path) == ['loss', 'env/reward', 'no_step', 'single', 'new']
+        assert len(read_scalars(path)['loss']['step']) == 97
+
+        # a partially written record is ignored.
+        with open(path + '.bin', 'ab') as f:
+            f.write(b'\0' * 5)
+        assert len(read_records(path)) == 110
+        # and removed on resume, so that new records stay aligned.
+        log = ScalarLog(path)
+        log.add('loss', 3., 97)
+        log.close()
+        assert os.path.getsize(path + '.bin') == 111 * RECORD.itemsize
+        scalars = read_scalars(path)
+        assert scalars['loss']['step'][-1] == 97 and scalars['loss']['value'][-1] == 3.
+
+        # errors of the writer are raised by flush.
+        log = ScalarLog(path)
+        shutil.rmtree(logdir)
+        log.add('loss', 0.)
+        with self.assertRaises(FileNotFoundError):
+            log.flush()
+        log.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
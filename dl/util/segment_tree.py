@@ -2,7 +2,7 @@
 Copied from OpenAI baselines.
 https://github.com/openai/baselines/blob/master/baselines/common/segment_tree.py
 """
-import operator
+import operator, sys
 import numpy as np
 import random
 
@@ -38,6 +38,10 @@ class SegmentTree(object):
         self._value = [neutral_element for _ in range(2 * capacity)]
         self._operation = operation
 
+    def nbytes(self):
+        """Returns the approximate number of bytes used by the tree once all values are set."""
+        return sys.getsizeof(self._value) + len(self._value) * sys.getsizeof(0.)
+
     def _reduce_helper(self, start, end, node, node_start, node_end):
         if start == node_start and end == node_end:
             return self._value[node]
@@ -0,0 +1,76 @@
+"""
+Share the weights of a torch module with other processes on the same machine.
+"""
+import torch
+import torch.multiprocessing as mp
+
+
+class SharedWeights(object):
+    """
+    Holds a copy of a module's state dict in shared memory along with a
+    version number which is incremented on every publish. Processes holding
+    a copy of the module call sync to load new weights when they are available.
+    Create this object before starting the processes that use it.
+    """
+    def __init__(self, module, ctx=mp):
+        self.state = {k: v.detach().cpu().clone().share_memory_() for k,v in module.state_dict().items()}
+        self.version = ctx.Value('i', 0, lock=False)
+        self.lock = ctx.Lock()
+
+    def publish(self, module):
+        with self.lock, torch.no_grad():
+            for k,v in module.state_dict().items():
+                self.state[k].copy_(v)
+            self.version.value += 1
+        return self.version.value
+
+    def sync(self, module, version=None):
+        """
+        Loads the shared weights into module if they are newer than version.
+        Returns the version of the weights held by module afterwards.
+        """
+        if version is not None and self.version.value == version:
+            return version
+        with self.lock:
+            module.load_state_dict(self.state)
+            return self.version.value
+
+
+
+import unittest
+import torch.nn as nn
+
+def _sync_child(weights, module, q):
+    q.put(weights.sync(module))
+    q.put(module.weight.sum().item())
+
+class TestSharedWeights(unittest.TestCase):
+    def test(self):
+        net = nn.Linear(4, 2)
+        weights = SharedWeights(net)
+        net2 = nn.Linear(4, 2)
+        assert weights.sync(net2) == 0
+        assert torch.allclose(net.weight, net2.weight)
+
+        with torch.no_grad():
+            net.weight.fill_(1.)
+        assert weights.publish(net) == 1
+        assert weights.sync(net2, version=1) == 1
+        assert not torch.allclose(net.weight, net2.weight)
+        assert weights.sync(net2, version=0) == 1
+        assert torch.allclose(net.weight, net2.weight)
+
+        ctx = mp.get_context('fork')
+        q = ctx.Queue()
+        with torch.no_grad():
+            net.weight.fill_(2.)
+        weights.publish(net)
+        p = ctx.Process(target=_sync_child, args=(weights, nn.Linear(4, 2), q))
+        p.start()
+        assert q.get() == 2
+        assert q.get() == 16.
+        p.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
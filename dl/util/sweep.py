@@ -0,0 +1,216 @@
+"""
+Run hyperparameter sweeps over gin bindings on a local process pool.
+"""
+from dl.util.misc import load_gin_configs
+import os, glob, json, time, itertools, ast, math, random
+import torch
+import multiprocessing as mp
+
+
+def parse_space(specs):
+    """
+    Parses search space specifications of the form 'name=values', where values
+    is a python list of choices ('PPO.ent_coef=[0.01, 0.001]') or one of
+    'uniform(low, high)', 'loguniform(low, high)' and 'randint(low, high)'
+    (random search only). Returns a dict from binding name to values.
+    """
+    space = {}
+    for spec in specs:
+        name, values = [s.strip() for s in spec.split('=', 1)]
+        if values.startswith(('uniform(', 'loguniform(', 'randint(')):
+            dist, args = values[:-1].split('(', 1)
+            space[name] = (dist,) + tuple(ast.literal_eval(f'({args},)'))
+        else:
+            values = ast.literal_eval(values)
+            space[name] = list(values) if isinstance(values, (list, tuple)) else [values]
+    return space
+
+
+def grid(space):
+    """
+    Returns all combinations of the choices in space.
+    """
+    for name, values in space.items():
+        assert isinstance(values, list), f"Grid search requires a list of choices for {name}."
+    names = list(space.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*space.values())]
+
+
+def random_search(space, n, seed=0):
+    """
+    Returns n samples from space, drawn with a fixed seed so that a sweep
+    can be restarted.
+    """
+    rng = random.Random(seed)
+    def _sample(values):
+        if isinstance(values, list):
+            return rng.choice(values)
+        dist, low, high = values
+        if dist == 'uniform':
+            return rng.uniform(low, high)
+        if dist == 'loguniform':
+            return math.exp(rng.uniform(math.log(low), math.log(high)))
+        if dist == 'randint':
+            return rng.randint(low, high)
+        assert False, f"Unknown distribution {dist}."
+    return [{name: _sample(values) for name, values in space.items()} for _ in range(n)]
+
+
+def _format(value):
+    if isinstance(value, float):
+        return '{:.6g}'.format(value)
+    return str(value).replace('/', '_').replace(' ', '')
+
+
+def run_name(params):
+    return ','.join(f'{name}={_format(value)}' for name, value in params.items())
+
+
+def bindings(params):
+    return [f'{name}={value!r}' for name, value in params.items()]
+
+
+def core_slots(nslots, cores_per_run, cores=None):
+    """
+    Splits the cores available to this process into nslots disjoint sets of
+    cores_per_run cores. Returns None for every slot if there are not enough cores.
+    """
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0))
+    if nslots * cores_per_run > len(cores):
+        return [None] * nslots
+    return [cores[i*cores_per_run:(i+1)*cores_per_run] for i in range(nslots)]
+
+
+def _run(trainer, config, gin_bindings, logdir, cores, nthreads):
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+    # limit threads of this process and of the environment processes it starts.
+    os.environ['OMP_NUM_THREADS'] = str(nthreads)
+    os.environ['MKL_NUM_THREADS'] = str(nthreads)
+    torch.set_num_threads(nthreads)
+    import dl.algorithms
+    load_gin_configs([config], gin_bindings)
+    getattr(dl.algorithms, trainer)(logdir).train()
+
+
+def run_sweep(trainer, config, runs, logdir, nprocs, cores_per_run=1, nthreads=None, log=print):
+    """
+    Trains trainer (the name of a class in dl.algorithms) with config and the
+    bindings of each run in runs (a dict from run name to a dict of bindings),
+    in logdir/<run name>. At most nprocs runs are trained at the same time,
+    each pinned to its own cores_per_run cores and limited to nthreads torch
+    threads (cores_per_run by default). Runs with checkpoints are resumed by
+    the Trainer. Returns the names of the runs that failed.
+    """
+    ctx = mp.get_context('spawn')
+    nthreads = nthreads or cores_per_run
+    slots = core_slots(nprocs, cores_per_run)
+    if slots[0] is None:
+        log(f"Not enough cores to pin {nprocs} runs to {cores_per_run} cores each. Runs will not be pinned.")
+    pending = list(runs.items())
+    running = {}
+    failed = []
+    while pending or running:
+        for slot in range(nprocs):
+            if slot in running or not pending:
+                continue
+            name, params = pending.pop(0)
+            run_logdir = os.path.join(logdir, name)
+            resumed = len(glob.glob(os.path.join(run_logdir, 'ckpts', '*.pt'))) > 0
+            args = (trainer, config, bindings(params), run_logdir, slots[slot], nthreads)
+            p = ctx.Process(target=_run, args=args)
+            p.start()
+            running[slot] = (name, p)
+            log(f"{'Resuming' if resumed else 'Starting'} {name} on cores {slots[slot]}.")
+        for slot, (name, p) in list(running.items()):
+            if p.exitcode is None:
+                continue
+            p.join()
+            del running[slot]
+            if p.exitcode != 0:
+                failed.append(name)
+                log(f"{name} failed with exit code {p.exitcode}.")
+            else:
+                log(f"{name} finished.")
+        time.sleep(0.1)
+    return failed
+
+
+def _eval_results(evaldir):
+    results = []
+    for path in glob.glob(os.path.join(evaldir, '*.json')):
+        with open(path, 'r') as f:
+            results.append((int(os.path.basename(path)[:-5]), json.load(f)['mean_reward']))
+    return sorted(results)
+
+
+def summarize(logdir, names):
+    """
+    Returns one row per run (and per member of population runs) with the
+    timestep and mean reward of the last evaluation and the best mean reward,
+    read from the eval/*.json files of each run. Rows are sorted by the
+    reward of the last evaluation.
+    """
+    rows = []
+    for name in names:
+        evaldirs = [(name, os.path.join(logdir, name, 'eval'))]
+        for memberdir in sorted(glob.glob(os.path.join(logdir, name, 'member*'))):
+            evaldirs.append((os.path.join(name, os.path.basename(memberdir)), os.path.join(memberdir, 'eval')))
+        for run, evaldir in evaldirs:
+            results = _eval_results(evaldir)
+            if len(results) == 0:
+                continue
+            rows.append({'run': run, 't': results[-1][0], 'final_reward': results[-1][1],
+                         'best_reward': max(r for _, r in results)})
+    return sorted(rows, key=lambda row: -row['final_reward'])
+
+
+def format_table(rows):
+    header = ['run', 't', 'final_reward', 'best_reward']
+    lines = [[str(row[k]) if k in ['run', 't'] else '{:.3f}'.format(row[k]) for k in header] for row in rows]
+    widths = [max(len(x) for x in col) for col in zip(header, *lines)]
+    return '\n'.join('  '.join(x.ljust(w) for x, w in zip(line, widths)).rstrip() for line in [header] + lines)
+
+
+
+import unittest, shutil, tempfile
+
+def _write_eval(evaldir, t, reward):
+    os.makedirs(evaldir, exist_ok=True)
+    with open(os.path.join(evaldir, '{:09d}.json'.format(t)), 'w') as f:
+        json.dump({'mean_reward': reward}, f)
+
+class TestSweep(unittest.TestCase):
+    def test_space(self):
+        space = parse_space(['PPO.ent_coef=[0.01, 0.001]', 'atari_env.game_name=["Pong", "Breakout"]', 'PPO.lambda_=0.95'])
+        runs = grid(space)
+        assert len(runs) == 4
+        assert bindings(runs[0]) == ['PPO.ent_coef=0.01', "atari_env.game_name='Pong'", 'PPO.lambda_=0.95']
+        assert len(set(run_name(p) for p in runs)) == 4
+
+        space = parse_space(['optim.Adam.lr=loguniform(1e-5, 1e-3)', 'atari_env.seed=randint(0, 9)'])
+        runs = random_search(space, 10, seed=1)
+        assert runs == random_search(space, 10, seed=1)
+        for p in runs:
+            assert 1e-5 <= p['optim.Adam.lr'] <= 1e-3
+            assert p['atari_env.seed'] in range(10)
+
+    def test_slots(self):
+        assert core_slots(3, 2, cores=list(range(8))) == [[0, 1], [2, 3], [4, 5]]
+        assert core_slots(3, 3, cores=list(range(8))) == [None] * 3
+
+    def test_summary(self):
+        logdir = tempfile.mkdtemp()
+        _write_eval(os.path.join(logdir, 'a', 'eval'), 100, 1.)
+        _write_eval(os.path.join(logdir, 'a', 'eval'), 200, 0.5)
+        _write_eval(os.path.join(logdir, 'b', 'member0', 'eval'), 200, 2.)
+        rows = summarize(logdir, ['a', 'b', 'c'])
+        assert [row['run'] for row in rows] == [os.path.join('b', 'member0'), 'a']
+        assert rows[1] == {'run': 'a', 't': 200, 'final_reward': 0.5, 'best_reward': 1.}
+        assert len(format_table(rows).split('\n')) == 3
+        shutil.rmtree(logdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+"""
+Measure the time spent in the phases of training.
+"""
+from dl.util import logger
+import time, contextlib, threading
+import numpy as np
+import torch
+
+
+_disabled = contextlib.nullcontext()
+
+
+class _Phase(object):
+    __slots__ = ['timer', 'name', 'start']
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        if self.timer.synchronize:
+            torch.cuda.synchronize()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.timer.synchronize:
+            torch.cuda.synchronize()
+        self.timer.add(self.name, time.perf_counter() - self.start)
+
+
+class PhaseTimer(object):
+    """
+    Times named phases of training:
+        with timer('backward'):
+            loss.backward()
+    Keeps the total time and the latency of every call of each phase since
+    the last call to log(). Phases may be nested and may be timed from
+    several threads (e.g. an actor thread).
+    When disabled, timer(name) returns a shared no-op context manager.
+    Args:
+        enabled (bool):
+            Whether or not to time phases.
+        max_samples (int):
+            The maximum number of latencies kept per phase between logs.
+            Percentiles are computed from the most recent max_samples calls.
+        synchronize (bool):
+            Whether or not to wait for cuda kernels at the start and end of
+            each phase. Without it, asynchronous GPU work is attributed to the
+            phase that waits for its result.
+    """
+    def __init__(self, enabled=True, max_samples=10000, synchronize=False):
+        self.enabled = enabled
+        self.max_samples = max_samples
+        self.synchronize = synchronize and torch.cuda.is_available()
+        # phases may be added from other threads while stats are read.
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, name):
+        if not self.enabled:
+            return _disabled
+        return _Phase(self, name)
+
+    def add(self, name, seconds):
+        with self._lock:
+            if name not in self.samples:
+                self.samples[name] = []
+                self.totals[name] = 0.
+                self.counts[name] = 0
+            samples = self.samples[name]
+            if len(samples) >= self.max_samples:
+                samples[self.counts[name] % self.max_samples] = seconds
+            else:
+                samples.append(seconds)
+            self.totals[name] += seconds
+            self.counts[name] += 1
+
+    def reset(self):
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        # called with the lock held.
+        self.samples = {}
+        self.totals = {}
+        self.counts = {}
+        self._last_reset = time.perf_counter()
+
+    def stats(self, reset=True):
+        """
+        Returns a dict from phase to a dict with the total time (s), the
+        fraction of wall time, the number of calls and the p50 and p99
+        latencies (ms) of the phase since the last reset.
+        """
+        with self._lock:
+            elapsed = max(time.perf_counter() - self._last_reset, 1e-9)
+            samples = {name: list(x) for name, x in self.samples.items()}
+            totals, counts = dict(self.totals), dict(self.counts)
+            if reset:
+                self._reset()
+        stats = {}
+        for name in samples:
+            p50, p99 = np.percentile(samples[name], [50, 99]) * 1000.
+            stats[name] = {'total': totals[name], 'frac': totals[name] / elapsed,
+                           'count': counts[name], 'p50': p50, 'p99': p99}
+        return stats
+
+    def log(self, t):
+        """
+        Logs the stats of each phase with logger.logkv and to tensorboard.
+        """
+        if not self.enabled:
+            return
+        for name, s in self.stats().items():
+            logger.logkv(f'time - {name} (s)', s['total'])
+            logger.logkv(f'time - {name} p50 (ms)', s['p50'])
+            logger.logkv(f'time - {name} p99 (ms)', s['p99'])
+            for k in ['total', 'frac', 'p50', 'p99']:
+                logger.add_scalar(f'time/{name}/{k}', s[k], t, time.time())
+
+
+
+import unittest
+
+class TestPhaseTimer(unittest.TestCase):
+    def test(self):
+        timer = PhaseTimer(max_samples=5)
+        for i in range(10):
+            with timer('outer'):
+                with timer('inner'):
+                    time.sleep(0.001)
+        assert timer.counts == {'outer': 10, 'inner': 10}
+        assert len(timer.samples['inner']) == 5
+        stats = timer.stats()
+        assert stats['outer']['total'] >= stats['inner']['total'] >= 0.01
+        assert 0 < stats['inner']['frac'] <= 1
+        assert 1. <= stats['inner']['p50'] <= stats['inner']['p99']
+        assert timer.stats() == {}
+
+    def test_threads(self):
+        timer = PhaseTimer()
+        def add():
+            for _ in range(10000):
+                timer.add('a', 1e-6)
+        threads = [threading.Thread(target=add) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        count = 0
+        while any(thread.is_alive() for thread in threads):
+            count += timer.stats().get('a', {'count': 0})['count']
+        for thread in threads:
+            thread.join()
+        count += timer.stats().get('a', {'count': 0})['count']
+        assert count == 40000
+
+    def test_disabled(self):
+        timer = PhaseTimer(enabled=False)
+        with timer('a'):
+            pass
+        assert timer('a') is timer('b')
+        assert timer.stats() == {}
+
+
+if __name__ == '__main__':
+    unittest.main()